@@ -0,0 +1,292 @@
+#
+# Benchmarks of the binding against a local FakeTestRail server.
+#
+# Usage: python benchmark.py [--cases N] [--tests N] [--calls N] [--latency S]
+#                            [--error-rate F] [--records N] [--case-size N]
+#
+# Every benchmark runs in its own process so its peak RSS can be reported.
+#
+
+import argparse
+import base64
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib2
+
+import fake_server
+import testrail
+
+
+# The request path as it was before connection pooling: a new urllib2 request
+# (and connection) per call.
+def _legacy_send_get(url, user, password, uri):
+    request = urllib2.Request(url + 'index.php?/api/v2/' + uri)
+    auth = base64.encodestring('%s:%s' % (user, password)).strip()
+    request.add_header('Authorization', 'Basic %s' % auth)
+    request.add_header('Content-Type', 'application/json')
+    return json.loads(urllib2.urlopen(request).read())
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _client(server, **kwargs):
+    client = testrail.APIClient(server.url, backoff_factor=0.01, **kwargs)
+    client.user = 'chuck'
+    client.password = 'norris'
+    return client
+
+
+#
+# Runs fn calls times and returns the calls per second, latency percentiles
+# and records per second (fn returns the number of records it handled).
+#
+def _measure(fn, calls):
+    latencies = []
+    records = 0
+    start = time.time()
+    for _ in xrange(calls):
+        call_start = time.time()
+        records += fn()
+        latencies.append(time.time() - call_start)
+    elapsed = time.time() - start
+    return {
+        'requests/s': calls / elapsed,
+        'p50 ms': _percentile(latencies, 0.5) * 1000,
+        'p99 ms': _percentile(latencies, 0.99) * 1000,
+        'records/s': records / elapsed,
+    }
+
+
+def _isolated(target, *args):
+    def run(queue):
+        result = target(*args)
+        result['peak RSS MB'] = _peak_rss_mb()
+        queue.put(result)
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run, args=(queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _report(name, result):
+    print('%-44s %s' % (name, '  '.join('%s %9.1f' % (k, result[k]) for k in
+                                        ('requests/s', 'p50 ms', 'p99 ms', 'records/s', 'KB/response',
+                                         'peak RSS MB')
+                                        if k in result)))
+
+
+def bench_get_projects(server, calls):
+    def legacy():
+        return _measure(lambda: len(_legacy_send_get(server.url, 'chuck', 'norris', 'get_projects')), calls)
+
+    def pooled():
+        client = _client(server)
+        return _measure(lambda: len(client.get_projects()), calls)
+
+    _report('get_projects (urlopen per call)', _isolated(legacy))
+    _report('get_projects (keep-alive pool)', _isolated(pooled))
+
+
+def bench_get_cases(server, calls):
+    def get_cases():
+        suite = _client(server).get_projects()[0].get_suites()[0]
+        return _measure(lambda: len(suite.get_cases()), calls)
+
+    def stream_cases():
+        suite = _client(server).get_projects()[0].get_suites()[0]
+        return _measure(lambda: sum(1 for _ in suite.stream_cases()), calls)
+
+    _report('get_cases', _isolated(get_cases))
+    _report('get_cases (streamed)', _isolated(stream_cases))
+
+
+#
+# get_cases of large cases with and without gzip compressed responses, decoded
+# by the standard library's json and by the default (fastest installed) codec.
+#
+def bench_large_cases(args):
+    def get_cases(server, codec):
+        client = _client(server, codec=codec)
+        received = []
+        client.add_request_hook(after=lambda info: received.append(info['bytes']))
+        suite = client.get_projects()[0].get_suites()[0]
+        del received[:]
+        result = _measure(lambda: len(suite.get_cases()), args.calls)
+        result['KB/response'] = sum(received) / 1024.0 / len(received)
+        return result
+
+    codecs = [testrail.JSONCodec(json)]
+    if testrail.JSONCodec().name != 'json':
+        codecs.append(testrail.JSONCodec())
+    for compress in (False, True):
+        with fake_server.FakeTestRail(projects=1, suites=1, cases=args.cases, runs=1, tests=1,
+                                      latency=args.latency, compress=compress,
+                                      case_size=args.case_size) as server:
+            for codec in codecs:
+                _report('get_cases %dB cases (%s, %s)' % (args.case_size, 'gzip' if compress else 'identity',
+                                                         codec.name),
+                        _isolated(get_cases, server, codec))
+
+
+#
+# Exporting the server into a snapshot by one process and by ShardedExporter
+# with an increasing number of worker processes. Note that the fake server
+# itself runs in this process and competes for the same cores.
+#
+def bench_export(server):
+    handle, path = tempfile.mkstemp(suffix='.snapshot')
+    os.close(handle)
+    try:
+        def single():
+            client = _client(server)
+            with testrail.SnapshotWriter(path) as writer:
+                for project in client.get_projects():
+                    writer.export_project(client, project.id)
+
+        _report('export (one process)', _export_rate(server, single))
+        for processes in sorted(set([1, 2, multiprocessing.cpu_count()])):
+            exporter = testrail.ShardedExporter(server.url, 'chuck', 'norris', processes=processes)
+            _report('export (%d worker processes)' % processes, _export_rate(server, lambda: exporter.export(path)))
+    finally:
+        os.remove(path)
+
+
+def _export_rate(server, export):
+    start = time.time()
+    export()
+    return {'records/s': _export_records(server) / (time.time() - start)}
+
+
+def _export_records(server):
+    return server.projects * (1 + server.suites * (1 + server.cases) + server.runs * (1 + server.tests))
+
+
+def bench_get_tests(server, calls):
+    def get_tests():
+        run = _client(server).get_projects()[0].get_runs()[0]
+        return _measure(lambda: len(run.get_tests()), calls)
+
+    _report('get_tests', _isolated(get_tests))
+
+
+def bench_add_results(server, calls):
+    run = _client(server).get_projects()[0].get_runs()[0]
+    case_ids = [t.case_id for t in run.get_tests()][:100]
+
+    def one_by_one():
+        client = _client(server)
+
+        def post():
+            for case_id in case_ids:
+                client.send_post('add_result_for_case/%d/%d' % (run.id, case_id), {'status_id': 1})
+            return len(case_ids)
+        return _measure(post, calls)
+
+    def batched():
+        client = _client(server)
+
+        def post():
+            with testrail.ResultQueue(client, batch_size=len(case_ids)) as queue:
+                for case_id in case_ids:
+                    queue.add(run.id, case_id, 1)
+            return len(case_ids)
+        return _measure(post, calls)
+
+    _report('add_result_for_case x%d' % len(case_ids), _isolated(one_by_one))
+    _report('ResultQueue x%d' % len(case_ids), _isolated(batched))
+
+
+# A Test as it was before records used __slots__: every field copied into
+# the instance dict and custom fields decoded eagerly.
+class _LegacyTest(object):
+    def __init__(self, client, data_dict):
+        self._client = client
+        self.id = data_dict["id"]
+        for name in testrail.Test._fields:
+            setattr(self, name, data_dict[name])
+        self.custom = dict((k[7:], v) for k, v in data_dict.iteritems() if k.startswith("custom_"))
+
+
+def _test_dict(record_id):
+    return {
+        u'id': record_id, u'assignedto_id': None, u'status_id': 1, u'priority_id': 2,
+        u'title': u'Test %d' % record_id, u'refs': None, u'run_id': 1, u'case_id': record_id,
+        u'estimate_forecast': None, u'type_id': 6, u'estimate': None, u'milestone_id': None,
+        u'custom_steps': None, u'custom_preconds': None,
+    }
+
+
+# The size of a record and the containers it owns, not counting the field
+# values both variants share.
+def _record_bytes(record):
+    size = sys.getsizeof(record)
+    if hasattr(record, '__dict__'):
+        size += sys.getsizeof(record.__dict__) + sys.getsizeof(record.custom)
+    else:
+        size += sys.getsizeof(record._Test__custom_values[1])
+    return size
+
+
+def _peak_rss_per_record(record_class, count, result):
+    gc.collect()
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    body = json.dumps([_test_dict(i) for i in xrange(min(count, 1000))])
+    records = []
+    while len(records) < count:
+        records.extend(record_class(None, r) for r in json.loads(body))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result.put((peak - start) * 1024.0 / len(records))
+
+
+def bench_test_memory(count):
+    for label, record_class in (('instance dict', _LegacyTest), ('slots', testrail.Test)):
+        record = record_class(None, _test_dict(1))
+        result = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_peak_rss_per_record, args=(record_class, count, result))
+        process.start()
+        rss = result.get()
+        process.join()
+        print('Test memory: %6d bytes/record own, %6.0f bytes/record peak RSS for %d records (%s)'
+              % (_record_bytes(record), rss, count, label))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the TestRail binding against a fake server")
+    parser.add_argument('--cases', type=int, default=5000, help="cases per suite")
+    parser.add_argument('--tests', type=int, default=5000, help="tests per run")
+    parser.add_argument('--calls', type=int, default=20, help="calls per benchmark")
+    parser.add_argument('--latency', type=float, default=0.0, help="injected latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of HTTP 503 responses")
+    parser.add_argument('--records', type=int, default=1000000, help="records for the memory benchmark")
+    parser.add_argument('--case-size', type=int, default=4096, help="case size for the compression benchmark")
+    args = parser.parse_args(argv)
+
+    with fake_server.FakeTestRail(projects=1, suites=1, cases=args.cases, runs=1, tests=args.tests,
+                                  latency=args.latency, error_rate=args.error_rate) as server:
+        bench_get_projects(server, args.calls * 50)
+        bench_get_cases(server, args.calls)
+        bench_get_tests(server, args.calls)
+        bench_add_results(server, max(1, args.calls // 4))
+        bench_export(server)
+    bench_large_cases(args)
+    bench_test_memory(args.records)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,404 @@
+#
+# Fake TestRail server
+#
+# A local stand-in for the TestRail API v2 serving synthetic projects,
+# suites, cases, runs and tests, for benchmarks and end to end tests of the
+# binding. Records are generated deterministically from their ids. Latency
+# and error responses can be injected.
+#
+# Arguments:
+#
+# projects            The number of projects
+# suites              The number of suites per project
+# cases               The number of cases per suite
+# runs                The number of runs per project
+# tests               The number of tests per run
+# latency             The delay (in seconds) added to every response
+# error_rate          The fraction of requests answered with HTTP 503
+# seed                The seed of the random error injection
+# compress            gzip responses for clients accepting it
+# accept_compressed   Accept gzip compressed request bodies (HTTP 415
+#                     otherwise)
+# case_size           The size (in bytes) of the custom_steps of every case
+# page_size           Answer get_cases, get_runs and get_tests like TestRail
+#                     6.7 and later: at most page_size records per request,
+#                     in a dict with a link to the next page (plain lists of
+#                     all records if None)
+#
+# Example:
+#
+# with FakeTestRail(cases=10000) as server:
+#     client = testrail.APIClient(server.url)
+#
+
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+_STATUSES = [
+    (1, 'passed', 'Passed'),
+    (2, 'blocked', 'Blocked'),
+    (3, 'untested', 'Untested'),
+    (4, 'retest', 'Retest'),
+    (5, 'failed', 'Failed'),
+]
+
+_COUNT_FIELDS = {1: 'passed_count', 2: 'blocked_count', 3: 'untested_count',
+                 4: 'retest_count', 5: 'failed_count'}
+
+_CREATED_ON = 1399023029
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_GET(self):
+        self.__handle(None)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not self.server.accept_compressed:
+                self.__respond(415, {'error': 'Unsupported Content-Encoding'}, {})
+                return
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.__handle(body)
+
+    def __handle(self, body):
+        self.__respond(*self.server.handle_api(self.command, self.path, body))
+
+    def __respond(self, status, payload, headers):
+        data = json.dumps(payload)
+        if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTestRail(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, projects=2, suites=2, cases=100, runs=2, tests=100, latency=0.0,
+                 error_rate=0.0, seed=0, compress=False, accept_compressed=True, case_size=0,
+                 page_size=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+        self.projects = projects
+        self.suites = suites
+        self.cases = cases
+        self.runs = runs
+        self.tests = tests
+        self.latency = latency
+        self.error_rate = error_rate
+        self.compress = compress
+        self.accept_compressed = accept_compressed
+        self.case_size = case_size
+        self.page_size = page_size
+        self.requests = 0
+        self.connections = 0
+        self.__random = random.Random(seed)
+        self.__results = {}
+        self.__run_results = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/testrail/' % self.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def process_request(self, request, client_address):
+        with self.__lock:
+            self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    #
+    # Returns the status, JSON payload and extra headers for a request.
+    #
+    def handle_api(self, method, path, body):
+        with self.__lock:
+            self.requests += 1
+            failed = self.error_rate and self.__random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 503, {'error': 'Injected error'}, {'Retry-After': '0'}
+
+        match = re.match(r'.*/index\.php\?/api/v2/(\w+)((?:/\d+)*)(.*)$', path)
+        if match is None:
+            return 404, {'error': 'Unknown API path'}, {}
+
+        name = match.group(1)
+        args = [int(a) for a in match.group(2).split('/')[1:]]
+        params = dict(p.split('=', 1) for p in match.group(3).split('&') if '=' in p)
+        prefix = '_post_' if method == 'POST' else '_'
+        handler = getattr(self, prefix + name, None) if name.startswith(('get_', 'add_')) else None
+        if handler is None:
+            return 400, {'error': 'Unknown method %s' % name}, {}
+
+        try:
+            if method == 'POST':
+                result = handler(json.loads(body or '{}'), *args)
+            else:
+                result = handler(*args, **params)
+        except (LookupError, TypeError, ValueError) as err:
+            return 400, {'error': str(err)}, {}
+
+        return 200, result, {}
+
+    # Ids are derived from positions so any record can be generated on its own
+    def _suite_id(self, project_id, index):
+        return (project_id - 1) * self.suites + index + 1
+
+    def _run_id(self, project_id, index):
+        return (project_id - 1) * self.runs + index + 1
+
+    def _case_id(self, suite_id, index):
+        return (suite_id - 1) * self.cases + index + 1
+
+    def _test_id(self, run_id, index):
+        return (run_id - 1) * self.tests + index + 1
+
+    def _project_of_run(self, run_id):
+        return (run_id - 1) // self.runs + 1
+
+    def _check(self, record_id, count):
+        if not 1 <= record_id <= count:
+            raise LookupError('Unknown id %d' % record_id)
+
+    def project(self, project_id):
+        self._check(project_id, self.projects)
+        return {
+            'id': project_id, 'name': 'Project %d' % project_id, 'announcement': None,
+            'show_announcement': False, 'is_completed': False, 'completed_on': None,
+            'suite_mode': 3, 'url': 'fake_url',
+        }
+
+    def suite(self, suite_id):
+        self._check(suite_id, self.projects * self.suites)
+        return {
+            'id': suite_id, 'name': 'Suite %d' % suite_id, 'description': None,
+            'project_id': (suite_id - 1) // self.suites + 1, 'url': 'fake_url',
+        }
+
+    def case(self, case_id):
+        self._check(case_id, self.projects * self.suites * self.cases)
+        return {
+            'id': case_id, 'title': 'Case %d' % case_id, 'section_id': 1 + case_id % 10,
+            'suite_id': (case_id - 1) // self.cases + 1, 'type_id': 6, 'priority_id': 1 + case_id % 4,
+            'milestone_id': None, 'refs': 'REF-%d' % case_id, 'estimate': None,
+            'estimate_forecast': None, 'created_by': 1, 'created_on': _CREATED_ON,
+            'updated_by': 1, 'updated_on': _CREATED_ON + case_id % 1000, 'template_id': 1,
+            'custom_steps': self.__steps(case_id), 'custom_preconds': None, 'custom_expected': None,
+        }
+
+    def __steps(self, case_id):
+        steps = ['Step %d' % case_id]
+        size = len(steps[0])
+        while size < self.case_size:
+            step = '%d. Open page %d, enter %x and check the result.' % (
+                len(steps), case_id * 31 + len(steps), hash((case_id, len(steps))) & 0xffffff)
+            steps.append(step)
+            size += len(step) + 1
+        return '\n'.join(steps)[:max(self.case_size, len(steps[0]))]
+
+    def run(self, run_id):
+        self._check(run_id, self.projects * self.runs)
+        counts = dict((name, 0) for name in _COUNT_FIELDS.values())
+        counts['untested_count'] = self.tests
+        for test_id, status_id in self.__results.items():
+            if (test_id - 1) // self.tests + 1 == run_id:
+                counts['untested_count'] -= 1
+                counts[_COUNT_FIELDS[status_id]] += 1
+
+        run = {
+            'id': run_id, 'name': 'Run %d' % run_id, 'description': None,
+            'project_id': self._project_of_run(run_id),
+            'suite_id': self._suite_id(self._project_of_run(run_id), 0),
+            'milestone_id': None, 'assignedto_id': None, 'include_all': True, 'is_completed': False,
+            'completed_on': None, 'created_on': _CREATED_ON + run_id, 'created_by': 1,
+            'plan_id': None, 'config': None, 'config_ids': [], 'url': 'fake_url',
+            'custom_status1_count': 0,
+        }
+        run.update(counts)
+        return run
+
+    def test(self, test_id):
+        self._check(test_id, self.projects * self.runs * self.tests)
+        run_id = (test_id - 1) // self.tests + 1
+        index = (test_id - 1) % self.tests
+        project_id = self._project_of_run(run_id)
+        case_id = self._case_id(self._suite_id(project_id, 0), index % self.cases)
+        return {
+            'id': test_id, 'run_id': run_id, 'case_id': case_id, 'title': 'Case %d' % case_id,
+            'status_id': self.__results.get(test_id, 3), 'assignedto_id': None, 'type_id': 6,
+            'priority_id': 1 + case_id % 4, 'milestone_id': None, 'refs': None, 'estimate': None,
+            'estimate_forecast': None, 'custom_steps': None, 'custom_preconds': None,
+        }
+
+    # Returns the ids first to last (exclusive) limited by limit and offset
+    def _page(self, first, last, limit=None, offset=0):
+        first += int(offset)
+        if limit is not None:
+            last = min(last, first + int(limit))
+        return xrange(first, last)
+
+    # The limit of a list request, capped at page_size if set
+    def _limit(self, limit):
+        if self.page_size is None:
+            return limit
+        return self.page_size if limit is None else min(int(limit), self.page_size)
+
+    # Wraps a page of a list of total records in the paginated response of
+    # newer TestRail versions if page_size is set
+    def _response(self, key, records, total, limit, offset):
+        if self.page_size is None:
+            return records
+        end = int(offset) + limit
+        return {
+            'offset': int(offset), 'limit': limit, 'size': len(records),
+            '_links': {'next': '&limit=%d&offset=%d' % (limit, end) if end < total else None, 'prev': None},
+            key: records,
+        }
+
+    # Applies the filters of a get_cases, get_runs or get_tests request
+    def _filter(self, records, filters):
+        for name, value in filters.items():
+            if name.endswith('_after'):
+                records = [r for r in records if r[name.split('_')[0] + '_on'] > int(value)]
+            elif name.endswith('_before'):
+                records = [r for r in records if r[name.split('_')[0] + '_on'] < int(value)]
+            elif name == 'is_completed':
+                records = [r for r in records if r[name] == (value == '1')]
+            else:
+                values = set(int(v) for v in value.split(','))
+                records = [r for r in records if r[name] in values]
+        return records
+
+    def _get_projects(self, **params):
+        return [self.project(p) for p in xrange(1, self.projects + 1)]
+
+    def _get_project(self, project_id):
+        return self.project(project_id)
+
+    # Like TestRail, suites are not paginated and limit and offset are ignored
+    def _get_suites(self, project_id, **params):
+        self._check(project_id, self.projects)
+        return [self.suite(self._suite_id(project_id, i)) for i in xrange(self.suites)]
+
+    def _get_suite(self, suite_id):
+        return self.suite(suite_id)
+
+    def _get_cases(self, project_id, suite_id, limit=None, offset=0, **filters):
+        suite = self.suite(int(suite_id))
+        if suite['project_id'] != project_id:
+            raise LookupError('Suite %s is not part of project %d' % (suite_id, project_id))
+        limit = self._limit(limit)
+        ids = self._page(self._case_id(int(suite_id), 0), self._case_id(int(suite_id), self.cases), limit, offset)
+        return self._response('cases', self._filter([self.case(c) for c in ids], filters), self.cases, limit, offset)
+
+    def _get_case(self, case_id):
+        return self.case(case_id)
+
+    def _get_runs(self, project_id, limit=None, offset=0, **filters):
+        self._check(project_id, self.projects)
+        limit = self._limit(limit)
+        ids = self._page(self._run_id(project_id, 0), self._run_id(project_id, self.runs), limit, offset)
+        return self._response('runs', self._filter([self.run(r) for r in ids], filters), self.runs, limit, offset)
+
+    def _get_run(self, run_id):
+        return self.run(run_id)
+
+    def _get_tests(self, run_id, limit=None, offset=0, **filters):
+        self._check(run_id, self.projects * self.runs)
+        limit = self._limit(limit)
+        ids = self._page(self._test_id(run_id, 0), self._test_id(run_id, self.tests), limit, offset)
+        return self._response('tests', self._filter([self.test(t) for t in ids], filters), self.tests, limit, offset)
+
+    def _get_test(self, test_id):
+        return self.test(test_id)
+
+    # Newest first, as the API returns them
+    def _get_results_for_run(self, run_id, limit=None, offset=0, created_after=None):
+        self._check(run_id, self.projects * self.runs)
+        with self.__lock:
+            results = list(reversed(self.__run_results.get(run_id, [])))
+        if created_after is not None:
+            results = [r for r in results if r['created_on'] > int(created_after)]
+        return [results[i] for i in self._page(0, len(results), limit, offset)]
+
+    def _get_statuses(self):
+        return [{'id': status_id, 'name': name, 'label': label, 'color_bright': 0, 'color_dark': 0,
+                 'color_medium': 0, 'is_final': status_id != 3, 'is_system': True,
+                 'is_untested': status_id == 3} for status_id, name, label in _STATUSES]
+
+    def _get_priorities(self):
+        return [{'id': p, 'name': 'Priority %d' % p, 'short_name': 'P%d' % p, 'priority': p,
+                 'is_default': p == 2} for p in xrange(1, 5)]
+
+    def _get_case_types(self):
+        return [{'id': 6, 'name': 'Functional', 'is_default': True}]
+
+    def _get_users(self):
+        return [{'id': 1, 'name': 'Chuck Norris', 'email': 'chuck@example.com', 'is_active': True}]
+
+    def _post_add_result(self, data, test_id):
+        self.test(test_id)
+        return self.__add_result(test_id, data)
+
+    def _post_add_result_for_case(self, data, run_id, case_id):
+        return self.__add_result(self.__test_of_case(run_id, case_id), data)
+
+    def _post_add_results_for_cases(self, data, run_id):
+        return [self.__add_result(self.__test_of_case(run_id, r['case_id']), r) for r in data['results']]
+
+    # The first test of a run with a case, test i of a run is for case
+    # i % cases of the project's first suite
+    def __test_of_case(self, run_id, case_id):
+        self._check(run_id, self.projects * self.runs)
+        project_id = self._project_of_run(run_id)
+        index = case_id - self._case_id(self._suite_id(project_id, 0), 0)
+        if not 0 <= index < min(self.cases, self.tests):
+            raise LookupError('Case %d is not part of run %d' % (case_id, run_id))
+        return self._test_id(run_id, index)
+
+    def __add_result(self, test_id, data):
+        run_id = (test_id - 1) // self.tests + 1
+        with self.__lock:
+            self.__results[test_id] = data['status_id']
+            results = self.__run_results.setdefault(run_id, [])
+            result = dict(data, id=sum(len(r) for r in self.__run_results.values()) + 1, test_id=test_id,
+                          created_on=int(time.time()))
+            results.append(result)
+        return result
@@ -9,26 +9,914 @@
 # Copyright Gurock Software GmbH
 #
 
-import urllib2
+import array
+import httplib
 import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import random
+import re
 import base64
+import bisect
+import collections
+import copy
+import email.utils
+import errno
+import heapq
+import itertools
+import Queue
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urllib
+import urlparse
+import xml.etree.cElementTree as ElementTree
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
 
 class APIError(Exception):
     pass
 
-class APIClient:
-    def __init__(self, base_url):
+_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+#
+# Connection pool
+#
+# Keeps idle keep-alive connections to a single host so consecutive requests
+# do not pay for a new TCP (and TLS) handshake each time.
+#
+# Arguments:
+#
+# scheme              'http' or 'https'
+# host                The host name (optionally host:port)
+# size                The maximum number of idle connections kept around,
+#                     additional connections are closed when released
+# idle_timeout        Connections idle for longer than this (in seconds) are
+#                     discarded instead of reused
+# timeout             Socket timeout in seconds (None for the default)
+#
+class _ConnectionPool(object):
+    def __init__(self, scheme, host, size=4, idle_timeout=60.0, timeout=None):
+        if scheme == 'https':
+            self.__connection_class = httplib.HTTPSConnection
+        elif scheme == 'http':
+            self.__connection_class = httplib.HTTPConnection
+        else:
+            raise APIError("Unsupported URL scheme '%s'" % scheme)
+
+        self.host = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.timeout is None:
+            return self.__connection_class(self.host)
+        return self.__connection_class(self.host, timeout=self.timeout)
+
+    def acquire(self):
+        now = time.time()
+        with self.__lock:
+            while self.__idle:
+                connection, last_used = self.__idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return connection, True
+                connection.close()
+
+        return self._new_connection(), False
+
+    def release(self, connection):
+        with self.__lock:
+            if len(self.__idle) < self.size:
+                self.__idle.append((connection, time.time()))
+                return
+
+        connection.close()
+
+    def idle_count(self):
+        with self.__lock:
+            return len(self.__idle)
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+
+        for connection, _ in idle:
+            connection.close()
+
+    #
+    # Issues a single request and returns the response status, headers and
+    # body. A reused connection the server closed while it was idle is
+    # retried once on a fresh connection, but only if not a byte of the
+    # response arrived, so a request the server may have processed (e.g. a
+    # POST that timed out) is never sent twice. With stream set the body is
+    # returned as an unread _ResponseStream instead, which hands the
+    # connection back once it is closed.
+    #
+    def request(self, method, path, body, headers, stream=False):
+        connection, reused = self.acquire()
+        try:
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except (httplib.BadStatusLine, socket.error) as err:
+                if not reused or not _is_stale_connection(err):
+                    raise
+                connection.close()
+                connection = self._new_connection()
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            data = None if stream else response.read()
+        except:
+            connection.close()
+            raise
+
+        if stream:
+            return response.status, response.msg, _ResponseStream(self, connection, response)
+
+        self._finish(connection, response)
+        return response.status, response.msg, data
+
+    def _finish(self, connection, response):
+        if response.will_close or not response.isclosed():
+            connection.close()
+        else:
+            self.release(connection)
+
+#
+# Returns whether a request failed because the server had closed the idle
+# connection before it arrived: the connection was closed or reset without
+# any response. Timeouts do not count, the server may still be working on
+# the request.
+#
+def _is_stale_connection(err):
+    if isinstance(err, httplib.BadStatusLine):
+        return err.line in ('', "''")
+    return not isinstance(err, socket.timeout) and err.errno in (errno.ECONNRESET, errno.EPIPE)
+
+#
+# The unread body of a response. Closing it before the body was read
+# completely closes the connection, otherwise it is returned to the pool.
+#
+class _ResponseStream(object):
+    def __init__(self, pool, connection, response):
+        self.__pool = pool
+        self.__connection = connection
+        self.__response = response
+
+    def read(self, size=None):
+        if size is None:
+            return self.__response.read()
+        return self.__response.read(size)
+
+    def read_all(self):
+        try:
+            return self.__response.read()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__connection is not None:
+            connection, self.__connection = self.__connection, None
+            self.__pool._finish(connection, self.__response)
+
+#
+# Future
+#
+# The pending result of a request that runs on a worker thread. result()
+# blocks until the request finished and returns its result or raises its
+# error.
+#
+class Future(object):
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__error = None
+
+    def done(self):
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise APIError("Timed out waiting for the request to finish")
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+    def exception(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise APIError("Timed out waiting for the request to finish")
+        return self.__error
+
+    #
+    # Calls fn(future) once the future is done, immediately when it already
+    # is.
+    #
+    def add_done_callback(self, fn):
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(fn)
+                return
+        fn(self)
+
+    #
+    # Returns a new future resolving to fn(result), errors are passed on
+    # unchanged.
+    #
+    def then(self, fn):
+        future = Future()
+
+        def chain(done):
+            error = done.exception()
+            if error is not None:
+                future.set_exception(error)
+                return
+            try:
+                future.set_result(fn(done.result()))
+            except Exception as err:
+                future.set_exception(err)
+
+        self.add_done_callback(chain)
+        return future
+
+    def set_result(self, result):
+        self.__result = result
+        self.__finish()
+
+    def set_exception(self, error):
+        self.__error = error
+        self.__finish()
+
+    def __finish(self):
+        with self.__lock:
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+
+        for fn in callbacks:
+            fn(self)
+
+#
+# Gather
+#
+# Waits for all futures and returns their results in order. The first error
+# encountered is raised.
+#
+def gather(futures, timeout=None):
+    return [f.result(timeout) for f in futures]
+
+#
+# Fixed size pool of worker threads. Workers are started on first use.
+#
+class _ThreadPool(object):
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Thread pool size must be at least 1")
+        self.size = size
+        self.__tasks = Queue.Queue()
+        self.__workers = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise APIError("Thread pool is shut down")
+            if len(self.__workers) < self.size:
+                worker = threading.Thread(target=self.__work)
+                worker.daemon = True
+                worker.start()
+                self.__workers.append(worker)
+            self.__tasks.put((future, fn, args))
+        return future
+
+    def shutdown(self, wait=True):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            workers = list(self.__workers)
+            for _ in workers:
+                self.__tasks.put(None)
+
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            future, fn, args = task
+            try:
+                result = fn(*args)
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+#
+# Response cache
+#
+# A bounded in-memory cache for GET responses keyed by URI. Entries expire
+# after a per-endpoint time to live and the least recently used entries are
+# evicted once more than max_entries responses or max_bytes response bytes
+# are held. POST requests invalidate the cached responses they may change,
+# e.g. adding results to a run drops the cached tests and counters of that
+# run. Cached results are shared between callers and must not be modified.
+#
+# Arguments:
+#
+# default_ttl         The time to live (in seconds) of endpoints not in ttls
+# ttls                A dict of endpoint name (e.g. 'get_cases') to time to
+#                     live, overriding DEFAULT_TTLS. A ttl of 0 disables
+#                     caching for an endpoint.
+# max_entries         The maximum number of cached responses
+# max_bytes           The maximum total size of the cached response bodies
+#
+class ResponseCache(object):
+    DEFAULT_TTLS = {
+        'get_case_fields': 3600,
+        'get_case_types': 3600,
+        'get_configs': 3600,
+        'get_priorities': 3600,
+        'get_result_fields': 3600,
+        'get_statuses': 3600,
+        'get_templates': 3600,
+        'get_users': 600,
+    }
+
+    def __init__(self, default_ttl=60, ttls=None, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.default_ttl = default_ttl
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = collections.OrderedDict()
+        self.__by_endpoint = {}
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def size(self):
+        return self.__bytes
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.__entries),
+                'bytes': self.__bytes,
+            }
+
+    def get(self, uri):
+        with self.__lock:
+            entry = self.__entries.get(uri)
+            if entry is not None and entry[0] < time.time():
+                self.__remove(uri)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            self.hits += 1
+            del self.__entries[uri]
+            self.__entries[uri] = entry
+            return entry[1], True
+
+    def put(self, uri, result, size):
+        ttl = self.ttls.get(_endpoint(uri)[0], self.default_ttl)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+
+        with self.__lock:
+            if uri in self.__entries:
+                self.__remove(uri)
+            self.__entries[uri] = (time.time() + ttl, result, size)
+            self.__by_endpoint.setdefault(_endpoint(uri)[0], set()).add(uri)
+            self.__bytes += size
+            while len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    #
+    # Drops the cached responses a POST to uri may have changed.
+    #
+    def invalidate(self, uri):
+        name, args = _endpoint(uri)
+        rules = _CACHE_INVALIDATION.get(name)
+        with self.__lock:
+            if rules is None:
+                self.__clear()
+                return
+
+            for get_name, arg in rules:
+                uris = self.__by_endpoint.get(get_name, ())
+                if arg is None:
+                    stale = list(uris)
+                elif arg < len(args):
+                    stale = [u for u in uris if _endpoint(u)[1][:1] == [args[arg]]]
+                else:
+                    stale = []
+                for u in stale:
+                    self.__remove(u)
+
+    def clear(self):
+        with self.__lock:
+            self.__clear()
+
+    def __clear(self):
+        self.__entries.clear()
+        self.__by_endpoint.clear()
+        self.__bytes = 0
+
+    def __remove(self, uri):
+        _, _, size = self.__entries.pop(uri)
+        self.__bytes -= size
+        uris = self.__by_endpoint[_endpoint(uri)[0]]
+        uris.discard(uri)
+
+#
+# Splits an API uri like 'get_cases/1&suite_id=2' into the endpoint name and
+# its path arguments ('get_cases', ['1']).
+#
+def _endpoint(uri):
+    parts = uri.split('&', 1)[0].split('/')
+    return parts[0], parts[1:]
+
+_RUN_RESPONSES = (('get_run', None), ('get_runs', None), ('get_plan', None), ('get_plans', None),
+                  ('get_results', None), ('get_results_for_case', None), ('get_results_for_run', None))
+_CASE_RESPONSES = (('get_cases', None), ('get_tests', None), ('get_test', None))
+
+# POST endpoint name -> (GET endpoint name, index of the POST argument that
+# has to match the first GET argument or None to drop all responses of the
+# GET endpoint)
+_CACHE_INVALIDATION = {
+    'add_result': _RUN_RESPONSES + (('get_test', 0), ('get_tests', None)),
+    'add_results': _RUN_RESPONSES + (('get_tests', 0), ('get_test', None)),
+    'add_result_for_case': _RUN_RESPONSES + (('get_tests', 0), ('get_test', None)),
+    'add_results_for_cases': _RUN_RESPONSES + (('get_tests', 0), ('get_test', None)),
+    'add_run': _RUN_RESPONSES,
+    'update_run': _RUN_RESPONSES + (('get_tests', 0), ('get_test', None)),
+    'close_run': _RUN_RESPONSES + (('get_tests', 0), ('get_test', None)),
+    'delete_run': _RUN_RESPONSES + (('get_tests', 0), ('get_test', None)),
+    'add_case': _CASE_RESPONSES + (('get_sections', None),),
+    'update_case': _CASE_RESPONSES + (('get_case', 0),),
+    'update_cases': _CASE_RESPONSES + (('get_case', None),),
+    'delete_case': _CASE_RESPONSES + (('get_case', 0),),
+    'delete_cases': _CASE_RESPONSES + (('get_case', None),),
+    'add_suite': (('get_suites', None),),
+    'update_suite': (('get_suite', 0), ('get_suites', None)),
+    'delete_suite': (('get_suite', 0), ('get_suites', None), ('get_sections', None)) + _CASE_RESPONSES,
+    'add_section': (('get_sections', None),),
+    'update_section': (('get_section', 0), ('get_sections', None)),
+    'delete_section': (('get_section', 0), ('get_sections', None)) + _CASE_RESPONSES,
+}
+
+#
+# Request metrics
+#
+# Collects per endpoint request counts by status, latency histograms,
+# response sizes and JSON decode times, and per record class construction
+# counts and times. as_dict() returns a snapshot, prometheus() the same data
+# in the Prometheus text exposition format.
+#
+class RequestMetrics(object):
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.LATENCY_BUCKETS)
+        self.__endpoints = {}
+        self.__records = {}
+        self.__lock = threading.Lock()
+
+    def record_request(self, info):
+        status = info['status'] if info['status'] is not None else 'error'
+        with self.__lock:
+            endpoint = self.__endpoints.get(info['endpoint'])
+            if endpoint is None:
+                endpoint = self.__endpoints[info['endpoint']] = {
+                    'calls': 0,
+                    'statuses': {},
+                    'latency_buckets': [0] * (len(self.buckets) + 1),
+                    'latency_sum': 0.0,
+                    'bytes': 0,
+                    'decode_time': 0.0,
+                }
+            endpoint['calls'] += 1
+            endpoint['statuses'][status] = endpoint['statuses'].get(status, 0) + 1
+            endpoint['latency_buckets'][bisect.bisect_left(self.buckets, info['elapsed'])] += 1
+            endpoint['latency_sum'] += info['elapsed']
+            endpoint['bytes'] += info['bytes']
+            endpoint['decode_time'] += info['decode_time']
+
+    def record_construction(self, name, count, elapsed):
+        with self.__lock:
+            records = self.__records.setdefault(name, {'count': 0, 'time': 0.0})
+            records['count'] += count
+            records['time'] += elapsed
+
+    def as_dict(self):
+        with self.__lock:
+            return {
+                'buckets': list(self.buckets),
+                'endpoints': copy.deepcopy(self.__endpoints),
+                'records': copy.deepcopy(self.__records),
+            }
+
+    def prometheus(self):
+        data = self.as_dict()
+        endpoints = sorted(data['endpoints'].items())
+        records = sorted(data['records'].items())
+        lines = ['# TYPE testrail_requests_total counter']
+        for name, endpoint in endpoints:
+            for status, count in sorted(endpoint['statuses'].items()):
+                lines.append('testrail_requests_total{endpoint="%s",status="%s"} %d' % (name, status, count))
+
+        lines.append('# TYPE testrail_request_duration_seconds histogram')
+        for name, endpoint in endpoints:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), endpoint['latency_buckets']):
+                cumulative += count
+                lines.append('testrail_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                             % (name, bound, cumulative))
+            lines.append('testrail_request_duration_seconds_sum{endpoint="%s"} %r' % (name, endpoint['latency_sum']))
+            lines.append('testrail_request_duration_seconds_count{endpoint="%s"} %d' % (name, endpoint['calls']))
+
+        lines.append('# TYPE testrail_response_bytes_total counter')
+        for name, endpoint in endpoints:
+            lines.append('testrail_response_bytes_total{endpoint="%s"} %d' % (name, endpoint['bytes']))
+        lines.append('# TYPE testrail_decode_seconds_total counter')
+        for name, endpoint in endpoints:
+            lines.append('testrail_decode_seconds_total{endpoint="%s"} %r' % (name, endpoint['decode_time']))
+
+        lines.append('# TYPE testrail_records_total counter')
+        for name, record in records:
+            lines.append('testrail_records_total{record="%s"} %d' % (name, record['count']))
+        lines.append('# TYPE testrail_record_construction_seconds_total counter')
+        for name, record in records:
+            lines.append('testrail_record_construction_seconds_total{record="%s"} %r' % (name, record['time']))
+        return '\n'.join(lines) + '\n'
+
+#
+# Coalesces concurrent calls with the same key: while a call for a key is in
+# flight, further calls for that key wait for it and share its result or
+# error instead of running again. If the call is interrupted (e.g. by a
+# KeyboardInterrupt) the waiting calls raise an APIError.
+#
+class _SingleFlight(object):
+    def __init__(self):
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+        except Exception as err:
+            call.set_exception(err)
+            raise
+        except BaseException as err:
+            call.set_exception(APIError("Request was interrupted (%s)" % type(err).__name__))
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            self.__finish(key)
+
+    def __finish(self, key):
+        with self.__lock:
+            del self.__calls[key]
+
+#
+# Adaptive concurrency limiter
+#
+# Bounds the number of requests in flight and adapts the bound to the
+# server: the limit is halved whenever the server throttles a request
+# (HTTP 429) and grows by about one request per round trip while response
+# times stay within latency_tolerance times the best smoothed latency seen.
+# Requests in flight together usually hit the same rate limit window, so a
+# throttled request only halves the limit if it was issued after the last
+# decrease.
+#
+# Arguments:
+#
+# initial             The initial limit
+# minimum             The lowest limit the limiter shrinks to
+# maximum             The highest limit the limiter grows to
+# latency_tolerance   The factor over the best latency at which the limit
+#                     stops growing
+#
+class AdaptiveLimiter(object):
+    def __init__(self, initial=8, minimum=1, maximum=64, latency_tolerance=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.__limit = float(max(minimum, min(initial, maximum)))
+        self.__in_flight = 0
+        self.__latency = None
+        self.__best_latency = None
+        self.__decreases = 0
+        self.__condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self.__limit)
+
+    @property
+    def in_flight(self):
+        return self.__in_flight
+
+    #
+    # Takes a slot, waiting while the limit is reached. Returns a ticket to
+    # pass on to release().
+    #
+    def acquire(self):
+        with self.__condition:
+            while self.__in_flight >= int(self.__limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+            return self.__decreases
+
+    #
+    # Releases a slot taken by acquire() and reports how the request went.
+    # latency is None when the request failed without a response. Without
+    # the ticket of acquire() a throttled request always halves the limit.
+    #
+    def release(self, latency=None, throttled=False, ticket=None):
+        with self.__condition:
+            self.__in_flight -= 1
+            if throttled:
+                if ticket is None or ticket == self.__decreases:
+                    self.__limit = max(self.minimum, self.__limit / 2)
+                    self.__decreases += 1
+            elif latency is not None:
+                if self.__latency is None:
+                    self.__latency = latency
+                else:
+                    self.__latency = 0.8 * self.__latency + 0.2 * latency
+                if self.__best_latency is None or self.__latency < self.__best_latency:
+                    self.__best_latency = self.__latency
+                if self.__latency <= self.__best_latency * self.latency_tolerance:
+                    self.__limit = min(self.maximum, self.__limit + 1.0 / self.__limit)
+            self.__condition.notify_all()
+
+#
+# JSON codec
+#
+# Encodes request bodies and decodes response bodies. Without a module the
+# fastest JSON library installed is used: ujson, then simplejson, then the
+# standard library's json.
+#
+# Arguments:
+#
+# module              A module (or any object) with json compatible dumps
+#                     and loads functions
+#
+class JSONCodec(object):
+    def __init__(self, module=None):
+        if module is None:
+            module = ujson or simplejson or json
+        self.module = module
+        self.dumps = module.dumps
+        self.loads = module.loads
+
+    @property
+    def name(self):
+        return getattr(self.module, '__name__', type(self.module).__name__)
+
+_ACCEPT_ENCODING = 'gzip, deflate'
+
+# Request bodies smaller than this are not worth compressing
+_MIN_COMPRESSED_SIZE = 1024
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+#
+# Incrementally decompresses a gzip or deflate encoded body. Servers send
+# deflate both with and without the zlib header, a body the zlib format
+# rejects is retried as raw deflate.
+#
+class _Decompressor(object):
+    def __init__(self, encoding):
+        if encoding == 'gzip':
+            self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.__first = None
+        else:
+            self.__decompressor = zlib.decompressobj()
+            self.__first = ''
+
+    def decompress(self, data):
+        if self.__first is None:
+            return self.__decompress(data)
+
+        # The zlib header is checked once its two bytes arrived
+        self.__first += data
+        if len(self.__first) < 2:
+            return ''
+        data, self.__first = self.__first, None
+        try:
+            return self.__decompressor.decompress(data)
+        except zlib.error:
+            self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.__decompress(data)
+
+    def flush(self):
+        if self.__first:
+            return self.__decompress(self.__first) + self.__decompressor.flush()
+        return self.__decompressor.flush()
+
+    def __decompress(self, data):
+        try:
+            return self.__decompressor.decompress(data)
+        except zlib.error as err:
+            raise APIError("Failed to decompress response (%s)" % err)
+
+def _content_encoding(headers):
+    encoding = (headers.getheader('Content-Encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return 'gzip'
+    if encoding == 'deflate':
+        return encoding
+    return None
+
+def _decompress(data, encoding):
+    decompressor = _Decompressor(encoding)
+    return decompressor.decompress(data) + decompressor.flush()
+
+#
+# A _ResponseStream counting the bytes read into the info of its request.
+# The request is reported once the stream is closed, so its elapsed time
+# includes reading the body.
+#
+class _MeasuredStream(object):
+    def __init__(self, stream, info, report):
+        self.__stream = stream
+        self.__info = info
+        self.__report = report
+
+    def read(self, size=None):
+        data = self.__stream.read(size)
+        self.__info['bytes'] += len(data)
+        return data
+
+    def read_all(self):
+        try:
+            return self.read()
+        finally:
+            self.close()
+
+    def close(self):
+        self.__stream.close()
+        if self.__report is not None:
+            report, self.__report = self.__report, None
+            report()
+
+#
+# A _ResponseStream whose compressed body is decompressed while it is read.
+#
+class _DecompressingStream(object):
+    def __init__(self, stream, encoding, chunk_size=64 * 1024):
+        self.__stream = stream
+        self.__decompressor = _Decompressor(encoding)
+        self.__chunk_size = chunk_size
+        self.__buffer = ''
+        self.__eof = False
+
+    def read(self, size=None):
+        while not self.__eof and (size is None or len(self.__buffer) < size):
+            chunk = self.__stream.read(self.__chunk_size)
+            if chunk:
+                self.__buffer += self.__decompressor.decompress(chunk)
+            else:
+                self.__buffer += self.__decompressor.flush()
+                self.__eof = True
+
+        if size is None:
+            data, self.__buffer = self.__buffer, ''
+        else:
+            data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+    def read_all(self):
+        try:
+            return self.read()
+        finally:
+            self.close()
+
+    def close(self):
+        self.__stream.close()
+
+class APIClient(object):
+    #
+    # Arguments:
+    #
+    # base_url            The TestRail URL (e.g. http://myserver/testrail/)
+    # pool_size           The number of idle keep-alive connections kept per
+    #                     host
+    # idle_timeout        Idle connections older than this (in seconds) are
+    #                     not reused
+    # timeout             Socket timeout in seconds (None for the default)
+    # max_retries         The number of times a request is retried after a
+    #                     connection error or an HTTP 429/5xx response
+    # backoff_factor      The base delay (in seconds) of the exponential
+    #                     backoff between retries
+    # max_backoff         The maximum delay between retries
+    # retry_posts         Retry POST requests too (only GET requests are
+    #                     retried by default as POSTs are not idempotent)
+    # limiter             An optional AdaptiveLimiter bounding the number of
+    #                     concurrent requests
+    # cache               An optional ResponseCache for GET responses
+    # metrics             An optional RequestMetrics collecting request and
+    #                     record statistics
+    # single_flight       Let concurrent GET requests for the same URI share a
+    #                     single request and its result (the callers get the
+    #                     same object, which they must not modify)
+    # codec               The JSONCodec encoding and decoding request and
+    #                     response bodies (defaults to the fastest installed)
+    # compress_requests   Send larger POST bodies gzip compressed, this is
+    #                     turned off again if the server rejects them
+    #
+    def __init__(self, base_url, pool_size=4, idle_timeout=60.0, timeout=None,
+                 max_retries=3, backoff_factor=0.5, max_backoff=60.0,
+                 retry_posts=False, limiter=None, cache=None, metrics=None,
+                 single_flight=False, codec=None, compress_requests=False):
         self.user = ''
         self.password = ''
         if not base_url.endswith('/'):
             base_url += '/'
         self.__url = base_url + 'index.php?/api/v2/'
+        self.__pool_size = pool_size
+        self.__idle_timeout = idle_timeout
+        self.__timeout = timeout
+        self.__pool = None
+        self.__pool_lock = threading.Lock()
+        self.__auth = None
+        self.__reference = None
+        self.__reference_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_posts = retry_posts
+        self.limiter = limiter
+        self.cache = cache
+        self.metrics = metrics
+        self.codec = codec if codec is not None else JSONCodec()
+        self.compress_requests = compress_requests
+        self.__single_flight = _SingleFlight() if single_flight else None
+        self.__before_hooks = []
+        self.__after_hooks = []
+        self._sleep = time.sleep
 
     #
     # Send Get
     #
     # Issues a GET request (read) against the API and returns the result
-    # (as Python dict).
+    # (as Python dict). With single_flight set concurrent calls for the same
+    # URI share one request and return the same result (or raise the same
+    # APIError).
     #
     # Arguments:
     #
@@ -36,7 +924,9 @@ class APIClient:
     #                     (e.g. get_case/1)
     #
     def send_get(self, uri):
-        return self.__send_request('GET', uri, None)
+        if self.__single_flight is None:
+            return self.__cached_get(uri)
+        return self.__single_flight.do(uri, lambda: self.__cached_get(uri))
 
     #
     # Send POST
@@ -52,217 +942,2747 @@ class APIClient:
     #                     Python dict, strings must be UTF-8 encoded)
     #
     def send_post(self, uri, data):
-        return self.__send_request('POST', uri, data)
+        try:
+            return self.__send_request('POST', uri, data)[0]
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(uri)
+
+    #
+    # Add request hook
+    #
+    # Registers callbacks around every request. before is called as
+    # before(method, uri) ahead of the request, after as after(info) once it
+    # finished or failed. info is a dict with the method, uri, endpoint,
+    # status, attempts, bytes (of the response body as received), elapsed
+    # and decode_time (in seconds, including decompression) and error (the
+    # exception raised, if any). Streamed requests are reported once their
+    # stream is closed, their decode_time is not measured.
+    #
+    def add_request_hook(self, before=None, after=None):
+        if before is not None:
+            self.__before_hooks.append(before)
+        if after is not None:
+            self.__after_hooks.append(after)
+
+    def remove_request_hook(self, before=None, after=None):
+        if before in self.__before_hooks:
+            self.__before_hooks.remove(before)
+        if after in self.__after_hooks:
+            self.__after_hooks.remove(after)
+
+    #
+    # Send GET stream
+    #
+    # Issues a GET request whose result is a list and yields its items while
+    # the response body is still arriving, so the complete body is never held
+    # in memory. A paginated response (a dict with the items under key) is
+    # decoded a page at a time, following _links.next with an offset until
+    # the collection ends. Responses are not cached.
+    #
+    # Arguments:
+    #
+    # uri                 The API method to call including parameters
+    #                     (e.g. get_cases/1)
+    # key                 The name of the items in a paginated response
+    #                     (e.g. cases)
+    #
+    def send_get_stream(self, uri, key=None):
+        offset = 0
+        page_uri = uri
+        while True:
+            links = {}
+            start = offset
+            stream = self.__send_request('GET', page_uri, None, stream=True)[0]
+            try:
+                for item in _iter_json_array(stream, key, links=links):
+                    offset += 1
+                    yield item
+                stream.read()
+            finally:
+                stream.close()
+            if links.get('next') is None:
+                return
+            if offset == start:
+                raise APIError("Failed to decode response (no '%s' in paginated response)" % key)
+            page_uri = '%s&offset=%d' % (uri, offset)
 
-    def __send_request(self, method, uri, data):
+    #
+    # Asynchronous requests (and the *_async methods of records) need an
+    # AsyncAPIClient.
+    #
+    def send_get_async(self, uri):
+        raise APIError("Asynchronous requests need an AsyncAPIClient ('%s')" % uri)
+
+    def send_post_async(self, uri, data):
+        raise APIError("Asynchronous requests need an AsyncAPIClient ('%s')" % uri)
+
+    #
+    # Close
+    #
+    # Closes all idle connections. The client stays usable, new connections
+    # are opened on demand.
+    #
+    def close(self):
+        with self.__pool_lock:
+            pool, self.__pool = self.__pool, None
+
+        if pool is not None:
+            pool.close()
+
+    def __cached_get(self, uri):
+        cache = self.cache
+        if cache is None:
+            return self.__send_request('GET', uri, None)[0]
+
+        result, found = cache.get(uri)
+        if not found:
+            result, size = self.__send_request('GET', uri, None)
+            cache.put(uri, result, size)
+        return result
+
+    def _get_pool(self):
+        with self.__pool_lock:
+            if self.__pool is None:
+                parts = urlparse.urlsplit(self.__url)
+                if not parts.netloc:
+                    raise APIError("Invalid TestRail URL '%s'" % self.__url)
+                self.__pool = _ConnectionPool(parts.scheme, parts.netloc,
+                                              self.__pool_size, self.__idle_timeout,
+                                              self.__timeout)
+            return self.__pool
+
+    def __auth_header(self):
+        credentials = (self.user, self.password)
+        if self.__auth is None or self.__auth[0] != credentials:
+            auth = base64.b64encode('%s:%s' % credentials)
+            self.__auth = (credentials, 'Basic %s' % auth)
+
+        return self.__auth[1]
+
+    def __send_request(self, method, uri, data, stream=False):
+        for hook in self.__before_hooks:
+            hook(method, uri)
+
+        info = {
+            'method': method,
+            'uri': uri,
+            'endpoint': _endpoint(uri)[0],
+            'status': None,
+            'attempts': 0,
+            'bytes': 0,
+            'decode_time': 0.0,
+            'error': None,
+        }
+        start = time.time()
+
+        def report():
+            info['elapsed'] = time.time() - start
+            if self.metrics is not None:
+                self.metrics.record_request(info)
+            for hook in self.__after_hooks:
+                hook(info)
+
+        try:
+            result = self.__perform_request(method, uri, data, stream, info, report)
+        except Exception as err:
+            info['error'] = err
+            report()
+            raise
+
+        # A streamed request is reported once its stream is closed
+        if not stream:
+            report()
+        return result
+
+    def __perform_request(self, method, uri, data, stream, info, report):
         url = self.__url + uri
-        request = urllib2.Request(url)
+        parts = urlparse.urlsplit(url)
+        path = url[len(parts.scheme) + len(parts.netloc) + 3:]
+
+        headers = {
+            'Authorization': self.__auth_header(),
+            'Content-Type': 'application/json',
+            'Accept-Encoding': _ACCEPT_ENCODING
+        }
+        body = plain_body = None
         if method == 'POST':
-            request.add_data(json.dumps(data))
-        auth = base64.encodestring('%s:%s' % (self.user, self.password)).strip()
-        request.add_header('Authorization', 'Basic %s' % auth)
-        request.add_header('Content-Type', 'application/json')
+            body = plain_body = self.codec.dumps(data)
+            if self.compress_requests and len(body) >= _MIN_COMPRESSED_SIZE:
+                body = _gzip(body)
+                headers['Content-Encoding'] = 'gzip'
 
-        e = None
-        try:
-            response = urllib2.urlopen(request).read()
-        except urllib2.HTTPError as e:
-            response = e.read()
+        retries = self.max_retries if method == 'GET' or self.retry_posts else 0
+        attempt = 0
+        while True:
+            info['attempts'] = attempt + 1
+            try:
+                status, response_headers, response = self.__request_once(method, path, body, headers, stream)
+            except (httplib.HTTPException, socket.error):
+                if attempt >= retries:
+                    raise
+                delay = self.__backoff(attempt, None)
+            else:
+                if status == 415 and 'Content-Encoding' in headers:
+                    # The server does not accept compressed bodies
+                    self.compress_requests = False
+                    del headers['Content-Encoding']
+                    body = plain_body
+                    continue
+                if status not in _RETRY_STATUSES or attempt >= retries:
+                    break
+                if stream:
+                    response.close()
+                delay = self.__backoff(attempt, response_headers.getheader('Retry-After'))
+            attempt += 1
+            self._sleep(delay)
+
+        info['status'] = status
+        encoding = _content_encoding(response_headers)
+        if stream:
+            if 200 <= status < 300:
+                response = _MeasuredStream(response, info, report)
+                if encoding is not None:
+                    response = _DecompressingStream(response, encoding)
+                return response, None
+            response = response.read_all()
 
+        info['bytes'] = len(response)
+        decode_start = time.time()
+        if encoding is not None:
+            response = _decompress(response, encoding)
         if response:
-            result = json.loads(response)
+            result = self.codec.loads(response)
         else:
             result = {}
+        info['decode_time'] = time.time() - decode_start
 
-        if e is not None:
+        if status < 200 or status >= 300:
             if result and 'error' in result:
                 error = '"' + result['error'] + '"'
             else:
                 error = 'No additional error message received'
-            raise APIError('TestRail API returned HTTP %s (%s)' % (e.code, error))
+            raise APIError('TestRail API returned HTTP %s (%s)' % (status, error))
 
-        return result
+        return result, len(response)
+
+    def __request_once(self, method, path, body, headers, stream):
+        limiter = self.limiter
+        if limiter is None:
+            return self._get_pool().request(method, path, body, headers, stream)
+
+        ticket = limiter.acquire()
+        start = time.time()
+        try:
+            status, response_headers, response = self._get_pool().request(method, path, body, headers, stream)
+        except:
+            limiter.release(ticket=ticket)
+            raise
+
+        limiter.release(time.time() - start, status == 429, ticket)
+        return status, response_headers, response
+
+    def __backoff(self, attempt, retry_after):
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                date = email.utils.parsedate_tz(retry_after)
+                if date is not None:
+                    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+        delay = min(self.max_backoff, self.backoff_factor * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
 
     def get_projects(self):
         response = self.send_get('get_projects')
-        return map(lambda r: Project(self, r), response)
+        return _build_records(self, Project, response)
 
     def get_statuses(self):
         response = self.send_get('get_statuses')
-        return map(lambda r: Status(self, r), response)
+        return _build_records(self, Status, response)
 
+    def get_priorities(self):
+        response = self.send_get('get_priorities')
+        return _build_records(self, Priority, response)
 
-class _RecordBase(object):
-    def __init__(self, client, data_dict):
-        self._client = client
-        try:
-            self.__id = data_dict["id"]
-        except KeyError as err:
-            raise APIError("Failed to parse record data (%s)" % err)
+    def get_case_types(self):
+        response = self.send_get('get_case_types')
+        return _build_records(self, CaseType, response)
 
-    @property
-    def id(self):
-        return self.__id
+    def get_users(self):
+        response = self.send_get('get_users')
+        return _build_records(self, User, response)
 
-    def _load_custom_data(self, data_dict):
-        custom = {}
-        for key in data_dict:
-            if len(key) > 7 and key[:7] == "custom_":
-                custom[key[7:]] = data_dict[key]
+    def get_plan(self, plan_id):
+        return _get_plan(self, plan_id)
 
-        return custom
+    #
+    # Reference
+    #
+    # The client's shared ReferenceData for O(1) lookups of statuses,
+    # priorities, case types, users and milestones by id.
+    #
+    @property
+    def reference(self):
+        with self.__reference_lock:
+            if self.__reference is None:
+                self.__reference = ReferenceData(self)
+            return self.__reference
 
-class Project(_RecordBase):
-    def __init__(self, client, data_dict):
-        super(Project, self).__init__(client, data_dict)
+    #
+    # Crawl
+    #
+    # Walks all projects, their suites with cases and their runs with tests
+    # and yields the records in a fixed depth first order: each project is
+    # followed by its suites (each followed by its cases) and then its runs
+    # (each followed by its tests). Requests run on a pool of worker threads
+    # ahead of the consumer, records are yielded as soon as they and all
+    # records before them have arrived.
+    #
+    # Arguments:
+    #
+    # max_workers         The number of worker threads
+    # max_in_flight       The maximum number of requests submitted but not
+    #                     finished yet (defaults to max_workers * 4)
+    #
+    def crawl(self, max_workers=8, max_in_flight=None):
+        if max_in_flight is None:
+            max_in_flight = max_workers * 4
+        crawler = _Crawler(_ThreadPool(max_workers), max(1, max_in_flight))
         try:
-            self.announcement = data_dict["announcement"]
-            self.__completed_on = data_dict["completed_on"]
-            self.is_completed = data_dict["is_completed"]
-            self.show_announcement = data_dict["show_announcement"]
-            self.name = data_dict["name"]
-        except KeyError as err:
-            raise APIError("Failed to parse project data (%s)" % err)
+            for record in crawler.walk(self.get_projects):
+                yield record
+        finally:
+            crawler.close()
 
-    @property
-    def completed_on(self):
-        return self.__completed_on
+#
+# A pending list request of the crawler. Its key orders the requests the
+# way their records are emitted. Once done, children holds a (record, [child
+# nodes]) pair for each record the request returned, or error is set.
+#
+class _CrawlNode(object):
+    def __init__(self, fetch, key):
+        self.fetch = fetch
+        self.key = key
+        self.future = None
+        self.error = None
+        self.children = None
+
+def _crawl_children(record):
+    if isinstance(record, Project):
+        return [record.get_suites, record.get_runs]
+    if isinstance(record, Suite):
+        return [record.get_cases]
+    if isinstance(record, Run):
+        return [record.get_tests]
+    return []
+
+#
+# Pending requests are submitted in the order their records are emitted
+# (depth first), so the requests of the subtree being emitted go first.
+# Emitted records and their nodes are dropped right away, only the records
+# not emitted yet are held.
+#
+class _Crawler(object):
+    def __init__(self, workers, max_in_flight):
+        self.__workers = workers
+        self.__max_in_flight = max_in_flight
+        self.__pending = []
+        self.__finished = Queue.Queue()
+        self.__in_flight = 0
+
+    def walk(self, fetch):
+        root = _CrawlNode(fetch, ())
+        heapq.heappush(self.__pending, (root.key, root))
+        return self.__emit(root)
+
+    def close(self):
+        self.__workers.shutdown(wait=False)
+
+    def __emit(self, node):
+        self.__wait_for(node)
+        if node.error is not None:
+            raise node.error
+
+        children, node.children = node.children, ()
+        while children:
+            record, child_nodes = children.popleft()
+            yield record
+            while child_nodes:
+                for r in self.__emit(child_nodes.popleft()):
+                    yield r
+
+    def __wait_for(self, node):
+        while node.children is None:
+            self.__submit()
+            finished = self.__finished.get()
+            self.__in_flight -= 1
+            self.__expand(finished)
+
+    def __submit(self):
+        while self.__pending and self.__in_flight < self.__max_in_flight:
+            _, node = heapq.heappop(self.__pending)
+            self.__in_flight += 1
+            node.future = self.__workers.submit(node.fetch)
+            node.future.add_done_callback(lambda f, node=node: self.__finished.put(node))
+
+    def __expand(self, node):
+        future, node.future = node.future, None
+        node.error = future.exception()
+        children = collections.deque()
+        if node.error is None:
+            for i, record in enumerate(future.result()):
+                child_nodes = collections.deque(
+                    _CrawlNode(fetch, node.key + (i, j)) for j, fetch in enumerate(_crawl_children(record)))
+                for child in child_nodes:
+                    heapq.heappush(self.__pending, (child.key, child))
+                children.append((record, child_nodes))
+        node.children = children
+
+#
+# Async API client
+#
+# An APIClient whose requests can also be issued without blocking. The
+# *_async methods return a Future right away while the request runs on one
+# of max_concurrency worker threads, so at most max_concurrency requests are
+# in flight at any time. The *_async variants of the navigation methods of
+# records only work for records created by this client, for those of a plain
+# APIClient they raise an APIError.
+#
+# Arguments:
+#
+# base_url            The TestRail URL (e.g. http://myserver/testrail/)
+# max_concurrency     The maximum number of concurrent requests
+#
+class AsyncAPIClient(APIClient):
+    def __init__(self, base_url, max_concurrency=8, **kwargs):
+        kwargs.setdefault('pool_size', max_concurrency)
+        super(AsyncAPIClient, self).__init__(base_url, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.__workers = _ThreadPool(max_concurrency)
+
+    def send_get_async(self, uri):
+        return self.__workers.submit(self.send_get, uri)
+
+    def send_post_async(self, uri, data):
+        return self.__workers.submit(self.send_post, uri, data)
+
+    def get_projects_async(self):
+        return self.send_get_async('get_projects').then(
+            lambda response: _build_records(self, Project, response))
+
+    def get_statuses_async(self):
+        return self.send_get_async('get_statuses').then(
+            lambda response: _build_records(self, Status, response))
+
+    #
+    # Waits for the requests in flight and closes all idle connections. The
+    # client stays usable, new workers are started on demand.
+    #
+    def close(self):
+        workers, self.__workers = self.__workers, _ThreadPool(self.max_concurrency)
+        workers.shutdown()
+        super(AsyncAPIClient, self).close()
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+#
+# Decodes the top level array of a JSON document read from stream element by
+# element, reading chunk_size bytes at a time. A top level object is decoded
+# completely and the items under key are yielded, its _links are stored in
+# links if given.
+#
+def _iter_json_array(stream, key=None, chunk_size=64 * 1024, links=None):
+    decoder = json.JSONDecoder()
+    state = {'buffer': '', 'eof': False}
+
+    def fill():
+        chunk = stream.read(chunk_size)
+        if chunk:
+            state['buffer'] += chunk
+        else:
+            state['eof'] = True
+
+    def skip_whitespace(pos):
+        while True:
+            pos = _JSON_WHITESPACE.match(state['buffer'], pos).end()
+            if pos < len(state['buffer']) or state['eof']:
+                return pos
+            fill()
+
+    pos = skip_whitespace(0)
+    if pos == len(state['buffer']):
+        return
+    if state['buffer'][pos] == '{':
+        document = json.loads(state['buffer'][pos:] + stream.read())
+        if links is not None:
+            links.update(document.get('_links') or {})
+        for item in document.get(key, []) if key else []:
+            yield item
+        return
+    if state['buffer'][pos] != '[':
+        raise APIError("Failed to decode response (expected a JSON array)")
+
+    pos = skip_whitespace(pos + 1)
+    if state['buffer'][pos:pos + 1] == ']':
+        return
+    while True:
+        buffer = state['buffer']
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            item, end = None, None
+        # A value ending with the buffer may be cut short (e.g. a number)
+        if end is None or (end == len(buffer) and not state['eof']):
+            if state['eof']:
+                raise APIError("Failed to decode response (truncated JSON array)")
+            fill()
+            continue
+
+        yield item
+        pos = skip_whitespace(end)
+        separator = state['buffer'][pos:pos + 1]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise APIError("Failed to decode response (malformed JSON array)")
+        pos = skip_whitespace(pos + 1)
+        if pos > chunk_size:
+            state['buffer'] = state['buffer'][pos:]
+            pos = 0
+
+#
+# Yields the items of a collection page by page using limit and offset.
+# While the caller consumes one page the next one is already fetched on a
+# background thread, so at most two pages are held at a time. Both plain list
+# responses and paginated responses (a dict with the items under key and a
+# _links.next entry) are supported. A plain list is only followed by another
+# page if it holds exactly page_size items. Servers that ignore limit and
+# offset return the whole collection every time: a list longer than
+# page_size is taken as the complete collection, a page starting with the
+# first item again ends the collection.
+#
+def _iter_pages(client, uri, key, page_size, prefetch=True):
+    first = []
+
+    def fetch(offset):
+        response = client.send_get('%s&limit=%d&offset=%d' % (uri, page_size, offset))
+        if isinstance(response, dict):
+            return response.get(key, []), response.get('_links', {}).get('next') is not None
+        if offset == 0:
+            first.extend(item.get('id') for item in response[:1])
+        elif response and first and response[0].get('id') == first[0]:
+            return [], False
+        return response, len(response) == page_size
+
+    workers = _ThreadPool(1) if prefetch else None
+    try:
+        offset = 0
+        page, more = fetch(offset)
+        while True:
+            offset += len(page)
+            more = more and len(page) > 0
+            if more and workers is not None:
+                next_page = workers.submit(fetch, offset)
+            for item in page:
+                yield item
+            if not more:
+                return
+            page = None
+            page, more = next_page.result() if workers is not None else fetch(offset)
+    finally:
+        if workers is not None:
+            workers.shutdown(wait=False)
+
+#
+# Fetches a plan with its entries
+#
+def _get_plan(client, plan_id):
+    return Plan(client, client.send_get('get_plan/%d' % plan_id))
+
+#
+# Creates a record of record_class for every dict of response, reporting the
+# time taken to the client's RequestMetrics if it has one.
+#
+def _build_records(client, record_class, response, *args):
+    start = time.time()
+    records = [record_class(client, r, *args) for r in response]
+    metrics = getattr(client, 'metrics', None)
+    if metrics is not None:
+        metrics.record_construction(record_class.__name__, len(records), time.time() - start)
+    return records
+
+#
+# Yields a record of record_class for every dict of items like
+# _build_records(), reporting the time taken once the items are exhausted or
+# the generator is closed.
+#
+def _iter_records(client, record_class, items, *args):
+    metrics = getattr(client, 'metrics', None)
+    if metrics is None:
+        for item in items:
+            yield record_class(client, item, *args)
+        return
+
+    count, elapsed = 0, 0.0
+    try:
+        for item in items:
+            start = time.time()
+            record = record_class(client, item, *args)
+            elapsed += time.time() - start
+            count += 1
+            yield record
+    finally:
+        metrics.record_construction(record_class.__name__, count, elapsed)
+
+#
+# Query result
+#
+# The records returned by a filtered getter. pushed_down holds the filters
+# sent to the server as URI parameters and filtered_locally the filters the
+# binding applied to the response itself.
+#
+class QueryResult(list):
+    def __init__(self, records, pushed_down=None, filtered_locally=None):
+        super(QueryResult, self).__init__(records)
+        self.pushed_down = pushed_down or {}
+        self.filtered_locally = filtered_locally or {}
+
+# The filters the API supports per endpoint, those accepting a comma
+# separated list of values are marked True
+_SERVER_FILTERS = {
+    'get_cases': {
+        'created_after': False, 'created_before': False, 'created_by': True, 'milestone_id': True,
+        'priority_id': True, 'section_id': False, 'template_id': True, 'type_id': True,
+        'updated_after': False, 'updated_before': False, 'updated_by': True,
+    },
+    'get_runs': {
+        'created_after': False, 'created_before': False, 'created_by': True, 'is_completed': False,
+        'milestone_id': True, 'suite_id': True,
+    },
+    'get_tests': {
+        'status_id': True,
+    },
+}
+
+#
+# Splits keyword filters of a getter into URI parameters for the filters the
+# endpoint supports and client side filters on the fields of record_class.
+# A filter value matches a field value if it is equal, contains it (for
+# lists, tuples and sets) or returns True for it (for callables). None (e.g.
+# milestone_id=None for "no milestone") has no URI form and is always
+# filtered locally. Returns the URI suffix and both sets of filters.
+#
+def _split_filters(endpoint, record_class, filters):
+    supported = _SERVER_FILTERS.get(endpoint, {})
+    params = []
+    pushed_down = {}
+    filtered_locally = {}
+    for name, value in sorted(filters.items()):
+        many = isinstance(value, (list, tuple, set, frozenset))
+        unset = value is None or (many and None in value)
+        if name in supported and not callable(value) and not unset and (supported[name] or not many):
+            if many:
+                value = sorted(value)
+                param = ','.join(str(int(v)) for v in value)
+            elif isinstance(value, bool):
+                param = '1' if value else '0'
+            else:
+                param = urllib.quote(str(value), safe='')
+            params.append('&%s=%s' % (name, param))
+            pushed_down[name] = value
+        elif name == 'id' or name in record_class._fields:
+            filtered_locally[name] = value
+        else:
+            raise APIError("Unsupported %s filter '%s'" % (record_class.__name__.lower(), name))
+    return ''.join(params), pushed_down, filtered_locally
+
+def _filter_records(records, filters):
+    def matches(record):
+        for name, value in filters.iteritems():
+            field = getattr(record, name)
+            if callable(value):
+                if not value(field):
+                    return False
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                if field not in value:
+                    return False
+            elif field != value:
+                return False
+        return True
+
+    if not filters:
+        return records
+    return [record for record in records if matches(record)]
+
+#
+# Records store their fields in __slots__ rather than an instance dict.
+# Subclasses list the fields they parse in _fields, which also become their
+# slots.
+#
+class _RecordBase(object):
+    __slots__ = ('_client', '__id')
+    _fields = ()
+    _custom_shape = None
+
+    def __init__(self, client, data_dict):
+        self._client = client
+        try:
+            self.__id = data_dict["id"]
+        except KeyError as err:
+            raise APIError("Failed to parse record data (%s)" % err)
+
+    @property
+    def id(self):
+        return self.__id
+
+    def _load_fields(self, data_dict, kind):
+        try:
+            for name in self._fields:
+                setattr(self, name, data_dict[name])
+        except KeyError as err:
+            raise APIError("Failed to parse %s data (%s)" % (kind, err))
+
+    #
+    # Returns the custom field names and values of data_dict. Records of one
+    # response share their keys, so the names found for the previous record
+    # of a class are reused while the keys stay the same.
+    #
+    def _load_custom_values(self, data_dict):
+        cls = type(self)
+        shape = cls._custom_shape
+        if shape is None or data_dict.viewkeys() != shape[0]:
+            names = tuple(key for key in data_dict if len(key) > 7 and key[:7] == "custom_")
+            shape = (set(data_dict), names)
+            cls._custom_shape = shape
+
+        names = shape[1]
+        return names, tuple(data_dict[name] for name in names)
+
+class Project(_RecordBase):
+    _fields = ('announcement', 'is_completed', 'show_announcement', 'name')
+    __slots__ = _fields + ('__completed_on',)
+
+    def __init__(self, client, data_dict):
+        super(Project, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'project')
+        try:
+            self.__completed_on = data_dict["completed_on"]
+        except KeyError as err:
+            raise APIError("Failed to parse project data (%s)" % err)
+
+    @property
+    def completed_on(self):
+        return self.__completed_on
 
     def get_suites(self):
         response = self._client.send_get('get_suites/%d' % self.id)
-        return map(lambda r: Suite(self._client, r), response)
+        return _build_records(self._client, Suite, response)
 
-    def get_runs(self):
-        response = self._client.send_get('get_runs/%d' % self.id)
-        return map(lambda r: Run(self._client, r), response)
+    #
+    # Get runs
+    #
+    # Returns the project's runs, optionally filtered by keyword filters
+    # (e.g. is_completed=False, milestone_id=[1, 2]). Filters the API
+    # supports are sent to the server, others are applied to the run fields
+    # of the response. The result reports both in pushed_down and
+    # filtered_locally.
+    #
+    def get_runs(self, **filters):
+        params, pushed_down, filtered_locally = _split_filters('get_runs', Run, filters)
+        response = self._client.send_get('get_runs/%d%s' % (self.id, params))
+        runs = _build_records(self._client, Run, response)
+        return QueryResult(_filter_records(runs, filtered_locally), pushed_down, filtered_locally)
+
+    def get_milestones(self):
+        response = self._client.send_get('get_milestones/%d' % self.id)
+        return _build_records(self._client, Milestone, response)
+
+    #
+    # Returns the project's test plans, fetched page_size at a time. The plans
+    # do not include their entries, these are fetched when Plan.entries is
+    # first used.
+    #
+    def get_plans(self, page_size=250):
+        response = list(_iter_pages(self._client, 'get_plans/%d' % self.id, 'plans', page_size))
+        return _build_records(self._client, Plan, response)
+
+    def get_configs(self):
+        response = self._client.send_get('get_configs/%d' % self.id)
+        return _build_records(self._client, ConfigGroup, response)
+
+    #
+    # Iter runs
+    #
+    # Yields the project's runs while fetching them page_size at a time, with the
+    # next page requested in the background.
+    #
+    def iter_runs(self, page_size=250):
+        runs = _iter_pages(self._client, 'get_runs/%d' % self.id, 'runs', page_size)
+        return _iter_records(self._client, Run, runs)
+
+    def get_suites_async(self):
+        return self._client.send_get_async('get_suites/%d' % self.id).then(
+            lambda response: _build_records(self._client, Suite, response))
+
+    def get_runs_async(self):
+        return self._client.send_get_async('get_runs/%d' % self.id).then(
+            lambda response: _build_records(self._client, Run, response))
 
 class Suite(_RecordBase):
+    _fields = ('description', 'project_id', 'name')
+    __slots__ = _fields
+
     def __init__(self, client, data_dict):
         super(Suite, self).__init__(client, data_dict)
-        try:
-            self.description = data_dict["description"]
-            self.project_id = data_dict["project_id"]
-            self.name = data_dict["name"]
-        except KeyError as err:
-            raise APIError("Failed to parse suite data (%s)" % err)
+        self._load_fields(data_dict, 'suite')
+
+    #
+    # Get cases
+    #
+    # Returns the suite's cases, optionally filtered by keyword filters (e.g.
+    # section_id=5, priority_id=[3, 4], updated_after=1399023029). Filters
+    # the API supports are sent to the server, others are applied to the
+    # case fields of the response. The result reports both in pushed_down
+    # and filtered_locally.
+    #
+    def get_cases(self, **filters):
+        params, pushed_down, filtered_locally = _split_filters('get_cases', Case, filters)
+        response = self._client.send_get("get_cases/%d&suite_id=%d%s" % (self.project_id, self.id, params))
+        cases = _build_records(self._client, Case, response)
+        return QueryResult(_filter_records(cases, filtered_locally), pushed_down, filtered_locally)
+
+    #
+    # Iter cases
+    #
+    # Yields the suite's cases while fetching them page_size at a time, with the
+    # next page requested in the background.
+    #
+    def iter_cases(self, page_size=250):
+        uri = "get_cases/%d&suite_id=%d" % (self.project_id, self.id)
+        return _iter_records(self._client, Case, _iter_pages(self._client, uri, 'cases', page_size))
+
+    #
+    # Stream cases
+    #
+    # Yields the suite's cases while the response is still being received.
+    #
+    def stream_cases(self):
+        uri = "get_cases/%d&suite_id=%d" % (self.project_id, self.id)
+        return _iter_records(self._client, Case, self._client.send_get_stream(uri, 'cases'))
+
+    #
+    # Returns a CaseIndex holding all cases of the suite.
+    #
+    def get_case_index(self):
+        index = CaseIndex(self._client)
+        index.load_suite(self.project_id, self.id)
+        return index
+
+    def get_cases_async(self):
+        return self._client.send_get_async("get_cases/%d&suite_id=%d" % (self.project_id, self.id)).then(
+            lambda response: _build_records(self._client, Case, response))
+
+    def get_sections(self):
+        response = self._client.send_get("get_sections/%d&suite_id=%d" % (self.project_id, self.id))
+        return _build_records(self._client, Section, response)
 
-    def get_cases(self):
-        response = self._client.send_get("get_cases/%d&suite_id=%d" % (self.project_id, self.id))
-        return map(lambda r: Case(self._client, r), response)
+    #
+    # Get section tree
+    #
+    # Returns a SectionTree of the suite's sections. With with_cases set the
+    # suite's cases are fetched as well, for per section case lookups and
+    # counts.
+    #
+    def get_section_tree(self, with_cases=True):
+        return SectionTree(self.get_sections(), self.get_cases() if with_cases else None)
 
 class Case(_RecordBase):
+    _fields = ('custom_steps', 'updated_by', 'type_id', 'estimate', 'refs', 'priority_id',
+               'section_id', 'created_by', 'custom_preconds', 'created_on', 'custom_expected',
+               'suite_id', 'updated_on', 'title', 'milestone_id', 'estimate_forecast')
+    __slots__ = _fields
+
     def __init__(self, client, data_dict):
         super(Case, self).__init__(client, data_dict)
-        try:
-            self.custom_steps = data_dict['custom_steps']
-            self.updated_by = data_dict['updated_by']
-            self.type_id = data_dict['type_id']
-            self.estimate = data_dict['estimate']
-            self.refs = data_dict['refs']
-            self.priority_id = data_dict['priority_id']
-            self.section_id = data_dict['section_id']
-            self.created_by = data_dict['created_by']
-            self.custom_preconds = data_dict['custom_preconds']
-            self.created_on = data_dict['created_on']
-            self.custom_expected = data_dict['custom_expected']
-            self.suite_id = data_dict['suite_id']
-            self.updated_on = data_dict['updated_on']
-            self.title = data_dict['title']
-            self.milestone_id = data_dict['milestone_id']
-            self.estimate_forecast = data_dict['estimate_forecast']
-        except KeyError as err:
-            raise APIError("Failed to parse case data (%s)" % err)
+        self._load_fields(data_dict, 'case')
+
+class Section(_RecordBase):
+    _fields = ('depth', 'description', 'display_order', 'name', 'parent_id', 'suite_id')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(Section, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'section')
 
 class Run(_RecordBase):
+    _fields = ('include_all', 'is_completed', 'created_on', 'retest_count', 'plan_id',
+               'created_by', 'passed_count', 'project_id', 'config', 'failed_count',
+               'description', 'suite_id', 'milestone_id', 'name', 'assignedto_id',
+               'blocked_count', 'completed_on', 'config_ids', 'url', 'untested_count')
+    __slots__ = _fields + ('__custom_values', '__custom', '__case_index')
+
     def __init__(self, client, data_dict):
         super(Run, self).__init__(client, data_dict)
-        try:
-            self.include_all = data_dict ["include_all"]
-            self.is_completed = data_dict ["is_completed"]
-            self.created_on = data_dict ["created_on"]
-            self.retest_count = data_dict ["retest_count"]
-            self.plan_id = data_dict ["plan_id"]
-            self.created_by = data_dict ["created_by"]
-            self.passed_count = data_dict ["passed_count"]
-            self.project_id = data_dict ["project_id"]
-            self.config = data_dict ["config"]
-            self.failed_count = data_dict ["failed_count"]
-            self.description = data_dict ["description"]
-            self.suite_id = data_dict ["suite_id"]
-            self.milestone_id = data_dict ["milestone_id"]
-            self.name = data_dict ["name"]
-            self.assignedto_id = data_dict ["assignedto_id"]
-            self.blocked_count = data_dict ["blocked_count"]
-            self.completed_on = data_dict ["completed_on"]
-            self.config_ids = data_dict ["config_ids"]
-            self.url = data_dict ["url"]
-            self.untested_count = data_dict ["untested_count"]
-        except KeyError as err:
-            raise APIError("Failed to parse run data (%s)" % err)
-
-        self.__custom = self._load_custom_data(data_dict)
+        self._load_fields(data_dict, 'run')
+        self.__custom_values = self._load_custom_values(data_dict)
+        self.__custom = None
+        self.__case_index = None
 
     @property
     def custom(self):
+        if self.__custom is None:
+            names, values = self.__custom_values
+            self.__custom = dict((name[7:], value) for name, value in zip(names, values))
+            self.__custom_values = None
         return self.__custom
 
-    def get_tests(self):
-        response = self._client.send_get("get_tests/%d" % (self.id))
-        return map(lambda r: Test(self._client, r), response)
+    #
+    # Loads the cases of the run's suite into a CaseIndex with a single
+    # request. Tests returned by get_tests() afterwards resolve their case
+    # from this index.
+    #
+    def prefetch_cases(self):
+        index = CaseIndex(self._client)
+        index.load_suite(self.project_id, self.suite_id)
+        self.__case_index = index
+        return index
+
+    #
+    # Get tests
+    #
+    # Returns the run's tests, optionally filtered by keyword filters (e.g.
+    # status_id=[4, 5], assignedto_id=2). Filters the API supports are sent
+    # to the server, others are applied to the test fields of the response.
+    # The result reports both in pushed_down and filtered_locally.
+    #
+    # Arguments:
+    #
+    # case_index          An optional CaseIndex the tests resolve their case
+    #                     from (defaults to the index of prefetch_cases())
+    #
+    def get_tests(self, case_index=None, **filters):
+        params, pushed_down, filtered_locally = _split_filters('get_tests', Test, filters)
+        response = self._client.send_get("get_tests/%d%s" % (self.id, params))
+        tests = self.__to_tests(response, case_index)
+        return QueryResult(_filter_records(tests, filtered_locally), pushed_down, filtered_locally)
+
+    #
+    # Iter tests
+    #
+    # Yields the run's tests while fetching them page_size at a time, with the
+    # next page requested in the background.
+    #
+    def iter_tests(self, page_size=250, case_index=None):
+        index = case_index if case_index is not None else self.__case_index
+        tests = _iter_pages(self._client, "get_tests/%d" % (self.id), 'tests', page_size)
+        return _iter_records(self._client, Test, tests, index)
+
+    #
+    # Stream tests
+    #
+    # Yields the run's tests while the response is still being received.
+    #
+    def stream_tests(self, case_index=None):
+        index = case_index if case_index is not None else self.__case_index
+        tests = self._client.send_get_stream("get_tests/%d" % (self.id), 'tests')
+        return _iter_records(self._client, Test, tests, index)
+
+    def get_tests_async(self, case_index=None):
+        return self._client.send_get_async("get_tests/%d" % (self.id)).then(
+            lambda response: self.__to_tests(response, case_index))
+
+    def __to_tests(self, response, case_index):
+        index = case_index if case_index is not None else self.__case_index
+        return _build_records(self._client, Test, response, index)
+
+#
+# Test plan
+#
+# A plan groups runs into entries, one entry per suite with a run per
+# configuration. Plans listed by Project.get_plans() come without their
+# entries, they are fetched with get_plan on first use of entries.
+#
+class Plan(_RecordBase):
+    _fields = ('assignedto_id', 'blocked_count', 'completed_on', 'created_by', 'created_on',
+               'description', 'failed_count', 'is_completed', 'milestone_id', 'name',
+               'passed_count', 'project_id', 'retest_count', 'untested_count', 'url')
+    __slots__ = _fields + ('__entries',)
 
-class Test(_RecordBase):
     def __init__(self, client, data_dict):
-        super(Test, self).__init__(client, data_dict)
+        super(Plan, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'plan')
+        self.__entries = None
+        if 'entries' in data_dict:
+            self.__entries = [PlanEntry(client, e) for e in data_dict['entries']]
+
+    @property
+    def entries(self):
+        if self.__entries is None:
+            self.__entries = _get_plan(self._client, self.id).__entries or []
+        return self.__entries
+
+    #
+    # Returns the runs of all entries of the plan.
+    #
+    def get_runs(self):
+        return [run for entry in self.entries for run in entry.runs]
+
+    #
+    # Get tests
+    #
+    # Fetches the tests of all runs of the plan with up to max_workers
+    # requests at a time and returns them as PlanTests, indexed by run,
+    # configuration and case.
+    #
+    def get_tests(self, max_workers=8):
+        runs = self.get_runs()
+        if not runs:
+            return PlanTests([], [])
+
+        workers = _ThreadPool(min(max_workers, len(runs)))
+        try:
+            futures = [workers.submit(run.get_tests) for run in runs]
+            return PlanTests(runs, gather(futures))
+        finally:
+            workers.shutdown(wait=False)
+
+#
+# An entry of a plan: the runs of one suite, one per configuration (as Run
+# records, with config and config_ids set).
+#
+class PlanEntry(_RecordBase):
+    _fields = ('description', 'include_all', 'name', 'suite_id')
+    __slots__ = _fields + ('runs',)
+
+    def __init__(self, client, data_dict):
+        super(PlanEntry, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'plan entry')
+        try:
+            self.runs = _build_records(client, Run, data_dict['runs'])
+        except KeyError as err:
+            raise APIError("Failed to parse plan entry data (%s)" % err)
+
+class ConfigGroup(_RecordBase):
+    _fields = ('name', 'project_id')
+    __slots__ = _fields + ('configs',)
+
+    def __init__(self, client, data_dict):
+        super(ConfigGroup, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'configuration group')
         try:
-            self.assignedto_id = data_dict ["assignedto_id"]
-            self.status_id = data_dict ["status_id"]
-            self.priority_id = data_dict ["priority_id"]
-            self.title = data_dict ["title"]
-            self.refs = data_dict ["refs"]
-            self.run_id = data_dict ["run_id"]
-            self.case_id = data_dict ["case_id"]
-            self.estimate_forecast = data_dict ["estimate_forecast"]
-            self.type_id = data_dict ["type_id"]
-            self.estimate = data_dict ["estimate"]
-            self.milestone_id = data_dict ["milestone_id"]
+            self.configs = [Config(client, c) for c in data_dict['configs']]
         except KeyError as err:
-            raise APIError("Failed to parse test data (%s)" % err)
+            raise APIError("Failed to parse configuration group data (%s)" % err)
 
-        self.__custom = self._load_custom_data(data_dict)
+class Config(_RecordBase):
+    _fields = ('group_id', 'name')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(Config, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'configuration')
+
+#
+# Plan tests
+#
+# The tests of all runs of a plan, indexed by run id, configuration (both
+# the id of every configuration of a run and its combined name, e.g.
+# "Chrome, Windows") and case id.
+#
+class PlanTests(object):
+    def __init__(self, runs, tests):
+        self.runs = runs
+        self.__tests = []
+        self.__by_run = {}
+        self.__by_config = collections.defaultdict(list)
+        self.__by_case = collections.defaultdict(list)
+        self.__by_run_case = {}
+        for run, run_tests in zip(runs, tests):
+            self.__tests.extend(run_tests)
+            self.__by_run[run.id] = run_tests
+            configs = list(run.config_ids or ()) + ([run.config] if run.config else [])
+            for config in configs:
+                self.__by_config[config].extend(run_tests)
+            for test in run_tests:
+                self.__by_case[test.case_id].append(test)
+                self.__by_run_case[(run.id, test.case_id)] = test
+
+    def __len__(self):
+        return len(self.__tests)
+
+    def __iter__(self):
+        return iter(self.__tests)
+
+    def by_run(self, run_id):
+        return list(self.__by_run.get(run_id, ()))
+
+    def by_config(self, config):
+        return list(self.__by_config.get(config, ()))
+
+    def by_case(self, case_id):
+        return list(self.__by_case.get(case_id, ()))
+
+    def get(self, run_id, case_id):
+        return self.__by_run_case.get((run_id, case_id))
+
+class Test(_RecordBase):
+    _fields = ('assignedto_id', 'status_id', 'priority_id', 'title', 'refs', 'run_id',
+               'case_id', 'estimate_forecast', 'type_id', 'estimate', 'milestone_id')
+    __slots__ = _fields + ('__custom_values', '__custom', '__case_index')
+
+    def __init__(self, client, data_dict, case_index=None):
+        super(Test, self).__init__(client, data_dict)
+        self.__case_index = case_index
+        self._load_fields(data_dict, 'test')
+        self.__custom_values = self._load_custom_values(data_dict)
+        self.__custom = None
 
     @property
     def custom(self):
+        if self.__custom is None:
+            names, values = self.__custom_values
+            self.__custom = dict((name[7:], value) for name, value in zip(names, values))
+            self.__custom_values = None
         return self.__custom
 
+    #
+    # Returns the test's case. With a case index the case is taken from the
+    # index when present and added to it otherwise, so repeated calls return
+    # the same Case object.
+    #
     def get_case(self):
+        case = self.__indexed_case()
+        if case is not None:
+            return case
+
         response = self._client.send_get("get_case/%d" % (self.case_id))
+        return self.__to_case(response)
+
+    def get_case_async(self):
+        case = self.__indexed_case()
+        if case is not None:
+            future = Future()
+            future.set_result(case)
+            return future
+
+        return self._client.send_get_async("get_case/%d" % (self.case_id)).then(self.__to_case)
+
+    def __indexed_case(self):
+        if self.__case_index is None:
+            return None
+        return self.__case_index.get(self.case_id)
+
+    def __to_case(self, response):
         if(len(response) != 1):
             raise APIError("Invalid test case (test id %d, case id %d)" % (self.id, self.case_id))
 
-        return Case(self._client, response[0])
+        case = Case(self._client, response[0])
+        if self.__case_index is not None:
+            case = self.__case_index.add(case)
+        return case
 
-class Status(_RecordBase):
-    def __init__(self, client, data_dict):
-        super(Status, self).__init__(client, data_dict)
-        try:
-            self.color_bright = data_dict["color_bright"]
-            self.color_dark = data_dict["color_dark"]
-            self.color_medium = data_dict["color_medium"]
-            self.is_final = data_dict["is_final"]
-            self.is_system = data_dict["is_system"]
-            self.is_untested = data_dict["is_untested"]
-            self.label = data_dict["label"]
-            self.name = data_dict["name"]
-        except KeyError as err:
-            raise APIError("Failed to parse status data (%s)" % err)
+#
+# Case index
+#
+# An identity map of cases by id. Adding a case that is already present
+# returns the present Case object, so every lookup of an id yields the same
+# object.
+#
+class CaseIndex(object):
+    def __init__(self, client):
+        self.__client = client
+        self.__cases = {}
+        self.__lock = threading.Lock()
 
-class StatusMapper:
-    def __init__(self, statuses):
-        self.__statuses = statuses
+    def __len__(self):
+        return len(self.__cases)
 
-    def __getitem__(self, key):
-        for s in self.__statuses:
-            if (s.id == key):
-                return s
+    def __contains__(self, case_id):
+        return case_id in self.__cases
+
+    def get(self, case_id):
+        return self.__cases.get(case_id)
+
+    def add(self, case):
+        with self.__lock:
+            return self.__cases.setdefault(case.id, case)
+
+    #
+    # Adds all cases of a suite with a single get_cases request.
+    #
+    def load_suite(self, project_id, suite_id):
+        response = self.__client.send_get("get_cases/%d&suite_id=%d" % (project_id, suite_id))
+        for case in _build_records(self.__client, Case, response):
+            self.add(case)
+        return len(response)
+
+#
+# Section tree
+#
+# The sections of a suite indexed for subtree queries. Sections are numbered
+# in pre-order (children by display order), so the subtree of a section is
+# the range of numbers from its own to the number after its last
+# descendant. Cases are kept sorted by the number of their section with a
+# running total of cases per section, so the cases and case count of any
+# subtree are a slice and a difference away. Sections whose parent is
+# unknown are treated as roots, cases of unknown sections are ignored.
+#
+# Arguments:
+#
+# sections            The Section records of a suite
+# cases               The Case records of the suite (optional)
+#
+class SectionTree(object):
+    def __init__(self, sections, cases=None):
+        self.__sections = dict((section.id, section) for section in sections)
+        self.__children = collections.defaultdict(list)
+        roots = []
+        for section in sorted(self.__sections.itervalues(), key=lambda s: (s.display_order, s.id)):
+            if section.parent_id in self.__sections:
+                self.__children[section.parent_id].append(section)
+            else:
+                roots.append(section)
+        self.__roots = roots
+
+        # Iterative pre-order walk, sections can be nested deeper than the
+        # recursion limit
+        self.__order = []
+        self.__first = {}
+        self.__end = {}
+        stack = [(root, False) for root in reversed(roots)]
+        while stack:
+            section, visited = stack.pop()
+            if visited:
+                self.__end[section.id] = len(self.__order)
+                continue
+            self.__first[section.id] = len(self.__order)
+            self.__order.append(section)
+            stack.append((section, True))
+            stack.extend((child, False) for child in reversed(self.__children.get(section.id, ())))
+
+        self.__cases = []
+        self.__totals = [0] * (len(self.__order) + 1)
+        if cases is not None:
+            self.__cases = sorted((case for case in cases if case.section_id in self.__first),
+                                  key=lambda case: self.__first[case.section_id])
+            for case in self.__cases:
+                self.__totals[self.__first[case.section_id] + 1] += 1
+            for number in xrange(len(self.__order)):
+                self.__totals[number + 1] += self.__totals[number]
+
+    def __len__(self):
+        return len(self.__sections)
+
+    def __contains__(self, section_id):
+        return section_id in self.__sections
+
+    @property
+    def roots(self):
+        return list(self.__roots)
+
+    def get(self, section_id):
+        return self.__sections.get(section_id)
+
+    def parent(self, section_id):
+        return self.__sections.get(self.__section(section_id).parent_id)
+
+    def children(self, section_id):
+        self.__section(section_id)
+        return list(self.__children.get(section_id, ()))
+
+    #
+    # Returns whether a section is part of the subtree of another section
+    # (including the section itself).
+    #
+    def is_in_subtree(self, section_id, root_id):
+        self.__section(root_id)
+        number = self.__first.get(section_id)
+        return number is not None and self.__first[root_id] <= number < self.__end[root_id]
+
+    #
+    # Returns the sections of a subtree in pre-order, starting with its root.
+    #
+    def subtree(self, section_id):
+        self.__section(section_id)
+        return self.__order[self.__first[section_id]:self.__end[section_id]]
+
+    #
+    # Returns the cases of the sections of a subtree.
+    #
+    def subtree_cases(self, section_id):
+        self.__section(section_id)
+        first, end = self.__first[section_id], self.__end[section_id]
+        return self.__cases[self.__totals[first]:self.__totals[end]]
 
-        raise APIError("Failed to map status ID %d" % key)
+    #
+    # Returns the number of cases of the sections of a subtree.
+    #
+    def case_count(self, section_id, recursive=True):
+        self.__section(section_id)
+        first = self.__first[section_id]
+        end = self.__end[section_id] if recursive else first + 1
+        return self.__totals[end] - self.__totals[first]
+
+    def __section(self, section_id):
+        try:
+            return self.__sections[section_id]
+        except KeyError:
+            raise APIError("Unknown section %s" % section_id)
+
+class Status(_RecordBase):
+    _fields = ('color_bright', 'color_dark', 'color_medium', 'is_final', 'is_system',
+               'is_untested', 'label', 'name')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(Status, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'status')
+
+class Priority(_RecordBase):
+    _fields = ('is_default', 'name', 'priority', 'short_name')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(Priority, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'priority')
+
+class CaseType(_RecordBase):
+    _fields = ('is_default', 'name')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(CaseType, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'case type')
+
+class User(_RecordBase):
+    _fields = ('email', 'is_active', 'name')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(User, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'user')
+
+class Milestone(_RecordBase):
+    _fields = ('completed_on', 'description', 'due_on', 'is_completed', 'name', 'project_id',
+               'url')
+    __slots__ = _fields
+
+    def __init__(self, client, data_dict):
+        super(Milestone, self).__init__(client, data_dict)
+        self._load_fields(data_dict, 'milestone')
+
+class StatusMapper:
+    def __init__(self, statuses):
+        self.__statuses = dict((s.id, s) for s in statuses)
+
+    def __getitem__(self, key):
+        try:
+            return self.__statuses[key]
+        except KeyError:
+            raise APIError("Failed to map status ID %d" % key)
+
+#
+# Reference data
+#
+# Statuses, priorities, case types, users and milestones indexed by id. Each
+# table is loaded with a single request on first use and kept until
+# refresh(). Concurrent lookups in a table not loaded yet wait for one load,
+# different tables load in parallel. Milestones are loaded per project, a
+# milestone of a project not loaded yet is fetched on its own.
+#
+class ReferenceData(object):
+    def __init__(self, client):
+        self.__client = client
+        self.__tables = {}
+        self.__milestones = {}
+        self.__lock = threading.Lock()
+        self.__table_locks = dict((kind, threading.Lock()) for kind in _REFERENCE_TABLES)
+
+    def status(self, status_id):
+        return self.__lookup('status', status_id)
+
+    def priority(self, priority_id):
+        return self.__lookup('priority', priority_id)
+
+    def case_type(self, type_id):
+        return self.__lookup('case type', type_id)
+
+    def user(self, user_id):
+        return self.__lookup('user', user_id)
+
+    def milestone(self, milestone_id):
+        milestone = self.__milestones.get(milestone_id)
+        if milestone is None:
+            response = self.__client.send_get('get_milestone/%d' % milestone_id)
+            milestone = self.__milestones.setdefault(milestone_id, Milestone(self.__client, response))
+        return milestone
+
+    #
+    # Loads all milestones of a project with a single request.
+    #
+    def load_milestones(self, project_id):
+        response = self.__client.send_get('get_milestones/%d' % project_id)
+        milestones = dict((m.id, m) for m in map(lambda r: Milestone(self.__client, r), response))
+        with self.__lock:
+            self.__milestones.update(milestones)
+
+    #
+    # Returns the reference records of a Case, Run or Test by kind ('status',
+    # 'priority', 'type', 'assignedto' and 'milestone'), leaving out fields
+    # the record lacks or that are not set.
+    #
+    def resolve(self, record):
+        resolved = {}
+        for kind, field, lookup in (('status', 'status_id', self.status),
+                                    ('priority', 'priority_id', self.priority),
+                                    ('type', 'type_id', self.case_type),
+                                    ('assignedto', 'assignedto_id', self.user),
+                                    ('milestone', 'milestone_id', self.milestone)):
+            value = getattr(record, field, None)
+            if value is not None:
+                resolved[kind] = lookup(value)
+        return resolved
+
+    #
+    # Drops the loaded tables, they are reloaded on their next use.
+    #
+    def refresh(self):
+        with self.__lock:
+            self.__tables = {}
+            self.__milestones = {}
+
+    def __lookup(self, kind, record_id):
+        table = self.__tables.get(kind)
+        if table is None:
+            table = self.__load(kind)
+        try:
+            return table[record_id]
+        except KeyError:
+            raise APIError("Failed to map %s ID %d" % (kind, record_id))
+
+    def __load(self, kind):
+        with self.__table_locks[kind]:
+            table = self.__tables.get(kind)
+            if table is None:
+                uri, record_class = _REFERENCE_TABLES[kind]
+                response = self.__client.send_get(uri)
+                table = dict((r.id, r) for r in map(lambda r: record_class(self.__client, r), response))
+                with self.__lock:
+                    self.__tables[kind] = table
+            return table
+
+_REFERENCE_TABLES = {
+    'status': ('get_statuses', Status),
+    'priority': ('get_priorities', Priority),
+    'case type': ('get_case_types', CaseType),
+    'user': ('get_users', User),
+}
+
+#
+# Result queue
+#
+# Buffers test results and reports them per run in bulk through
+# add_results_for_cases on a background thread. A run's batch is sent once
+# it holds batch_size results or its oldest result waited flush_interval
+# seconds. add() blocks while max_pending results are waiting to be picked
+# up, so a producer cannot outrun the server indefinitely. close() (or
+# leaving a with block) sends everything still buffered and raises an
+# APIError if any batch failed, unless the with block raised an exception
+# itself.
+#
+# Arguments:
+#
+# client              The APIClient to report through
+# batch_size          The maximum number of results per request
+# flush_interval      The maximum time (in seconds) a result is buffered
+# max_pending         The maximum number of queued results before add()
+#                     blocks
+#
+class ResultQueue(object):
+    def __init__(self, client, batch_size=100, flush_interval=5.0, max_pending=1000):
+        self.__client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.__queue = Queue.Queue(max_pending)
+        self.__buffers = {}
+        self.__errors = []
+        self.__closed = False
+        self.__worker = threading.Thread(target=self.__work)
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def __enter__(self):
+        return self
+
+    # Errors of failed batches are only raised when the with block itself
+    # succeeded, so they do not mask its exception
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__shutdown()
+
+    #
+    # Queues a result for a test case of a run. Additional fields (comment,
+    # elapsed, defects, ...) are passed on as is.
+    #
+    def add(self, run_id, case_id, status_id, **fields):
+        if self.__closed:
+            raise APIError("Result queue is closed")
+        result = dict(fields)
+        result['case_id'] = case_id
+        result['status_id'] = status_id
+        self.__queue.put((run_id, result))
+
+    #
+    # Sends all results queued so far and waits until they are sent.
+    #
+    def flush(self):
+        if self.__closed:
+            raise APIError("Result queue is closed")
+        done = threading.Event()
+        self.__queue.put((None, done))
+        done.wait()
+
+    @property
+    def errors(self):
+        return list(self.__errors)
+
+    def close(self):
+        self.__shutdown()
+        if self.__errors:
+            raise APIError("Failed to report %d result batch(es): %s"
+                           % (len(self.__errors), self.__errors[0]))
+
+    def __shutdown(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__queue.put(None)
+            self.__worker.join()
+
+    def __work(self):
+        while True:
+            try:
+                item = self.__queue.get(timeout=self.__next_timeout())
+            except Queue.Empty:
+                self.__flush_expired()
+                continue
+
+            if item is None:
+                self.__flush_all()
+                return
+            run_id, result = item
+            if run_id is None:
+                self.__flush_all()
+                result.set()
+                continue
+
+            buffer = self.__buffers.setdefault(run_id, (time.time(), []))[1]
+            buffer.append(result)
+            if len(buffer) >= self.batch_size:
+                self.__flush_run(run_id)
+            self.__flush_expired()
+
+    def __next_timeout(self):
+        if not self.__buffers:
+            return None
+        oldest = min(started for started, _ in self.__buffers.itervalues())
+        return max(0, oldest + self.flush_interval - time.time())
+
+    def __flush_expired(self):
+        now = time.time()
+        for run_id, (started, _) in self.__buffers.items():
+            if now - started >= self.flush_interval:
+                self.__flush_run(run_id)
+
+    def __flush_all(self):
+        for run_id in self.__buffers.keys():
+            self.__flush_run(run_id)
+
+    def __flush_run(self, run_id):
+        _, results = self.__buffers.pop(run_id)
+        try:
+            self.__client.send_post('add_results_for_cases/%d' % run_id, {'results': results})
+        except Exception as err:
+            self.__errors.append(err)
+
+#
+# JUnit importer
+#
+# Reports the testcases of JUnit XML files as results of a run. Files are
+# parsed incrementally and every testcase is discarded once it is queued,
+# results are sent in bulk through a ResultQueue while parsing continues, so
+# memory use depends on batch_size rather than on the size of the file.
+#
+# Testcases are matched to cases by a case id in their name (e.g.
+# "test_login_C1234"), then by "classname.name" or name against the case
+# titles and references. Testcases without a matching case are counted as
+# unmatched and not reported.
+#
+# Arguments:
+#
+# client              The APIClient to report through
+# cases               The cases to match testcases against (e.g. the result
+#                     of Suite.get_cases())
+# statuses            Maps the outcomes passed, failure, error and skipped
+#                     to status ids (None to not report an outcome)
+# batch_size          The maximum number of results per request
+#
+# Example:
+#
+# importer = JUnitImporter(client, suite.get_cases())
+# importer.import_file('junit.xml', run.id)
+#
+class JUnitImporter(object):
+    DEFAULT_STATUSES = {
+        'passed': 1,
+        'failure': 5,
+        'error': 5,
+        'skipped': None,
+    }
+
+    def __init__(self, client, cases, statuses=None, batch_size=500):
+        self.__client = client
+        self.statuses = dict(self.DEFAULT_STATUSES)
+        if statuses:
+            self.statuses.update(statuses)
+        self.batch_size = batch_size
+        self.__case_ids = set()
+        self.__names = {}
+        for case in cases:
+            self.__case_ids.add(case.id)
+            self.__names.setdefault(case.title, case.id)
+            for ref in (case.refs or '').split(','):
+                if ref.strip():
+                    self.__names.setdefault(ref.strip(), case.id)
+
+    #
+    # Returns the id of the case matching a testcase or None.
+    #
+    def match(self, classname, name):
+        for case_id in _CASE_ID_PATTERN.findall(name):
+            if int(case_id) in self.__case_ids:
+                return int(case_id)
+        if classname:
+            case_id = self.__names.get('%s.%s' % (classname, name))
+            if case_id is not None:
+                return case_id
+        return self.__names.get(name)
+
+    #
+    # Reports the testcases of a JUnit XML file (a file name or file object)
+    # to a run and returns the number of testcases, reported, unmatched and
+    # skipped (not reported due to their status mapping) results as a dict.
+    #
+    def import_file(self, source, run_id):
+        counts = {'testcases': 0, 'reported': 0, 'unmatched': 0, 'skipped': 0}
+        with ResultQueue(self.__client, batch_size=self.batch_size, flush_interval=60.0,
+                         max_pending=self.batch_size) as queue:
+            for classname, name, outcome, fields in _iter_junit_testcases(source):
+                counts['testcases'] += 1
+                case_id = self.match(classname, name)
+                status_id = self.statuses.get(outcome)
+                if case_id is None:
+                    counts['unmatched'] += 1
+                elif status_id is None:
+                    counts['skipped'] += 1
+                else:
+                    queue.add(run_id, case_id, status_id, **fields)
+                    counts['reported'] += 1
+        return counts
+
+_CASE_ID_PATTERN = re.compile(r'(?<![A-Za-z0-9])C(\d+)(?![0-9])')
+
+# The longest failure message kept as the comment of a result
+_MAX_COMMENT_LENGTH = 4000
+
+#
+# Yields (classname, name, outcome, fields) for every testcase of a JUnit XML
+# file, clearing every testcase element once it has been read. fields holds
+# the elapsed time and the failure message as a comment.
+#
+def _iter_junit_testcases(source):
+    path = []
+    try:
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                path.append(element)
+                continue
+
+            path.pop()
+            if element.tag != 'testcase':
+                continue
+
+            outcome, comment = 'passed', None
+            for child in element:
+                if child.tag in ('failure', 'error', 'skipped'):
+                    outcome = child.tag
+                    text = (child.get('message') or '', (child.text or '').strip())
+                    comment = '\n\n'.join(t for t in text if t)[:_MAX_COMMENT_LENGTH]
+                    break
+
+            fields = {}
+            elapsed = float(element.get('time') or 0)
+            if elapsed > 0:
+                fields['elapsed'] = '%ds' % max(1, int(round(elapsed)))
+            if comment:
+                fields['comment'] = comment
+            yield element.get('classname'), element.get('name', ''), outcome, fields
+
+            element.clear()
+            if path:
+                path[-1].remove(element)
+    except SyntaxError as err:
+        raise APIError("Failed to parse JUnit XML (%s)" % err)
+
+#
+# Run watcher
+#
+# Follows the progress of runs without refetching their tests. Every poll of
+# a run fetches the run itself and compares its status counters with the
+# previous poll. Only if they changed are the run's new results fetched, with
+# a created_after query relative to the newest result seen. A run whose
+# counters changed is polled again after min_interval seconds, every quiet
+# poll multiplies its interval by backoff up to max_interval. Completed runs
+# are reported once more and then dropped.
+#
+# Changes are reported as RunEvents, to the callback passed and by events(),
+# which polls the runs as they become due until no run is left. A result
+# that leaves the counters as they were (e.g. a second failure of a failed
+# test) is reported with the next change of the run.
+#
+# Arguments:
+#
+# client              The APIClient to poll through
+# run_ids             The ids of the runs to watch
+# min_interval        The polling interval (in seconds) of active runs
+# max_interval        The longest polling interval of quiet runs
+# backoff             The factor the interval of a quiet run grows by
+# callback            Called with every RunEvent (optional)
+#
+# Example:
+#
+# watcher = RunWatcher(client, [run.id for run in project.get_runs(is_completed=False)])
+# for event in watcher.events():
+#     print event.run_id, event.changes, len(event.results)
+#
+class RunWatcher(object):
+    def __init__(self, client, run_ids=(), min_interval=5.0, max_interval=300.0, backoff=2.0,
+                 callback=None):
+        self.__client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.callback = callback
+        self.__runs = {}
+        self._sleep = time.sleep
+        self._time = time.time
+        for run_id in run_ids:
+            self.add(run_id)
+
+    def __len__(self):
+        return len(self.__runs)
+
+    def __contains__(self, run_id):
+        return run_id in self.__runs
+
+    #
+    # Starts watching a run. The first poll reports the run's counters and,
+    # with since (a timestamp) set, the results created after since.
+    #
+    def add(self, run_id, since=None):
+        if run_id not in self.__runs:
+            self.__runs[run_id] = _WatchedRun(since)
+
+    def remove(self, run_id):
+        self.__runs.pop(run_id, None)
+
+    #
+    # Polls the runs that are due (all runs with force set) and returns the
+    # RunEvents of the runs that changed.
+    #
+    def poll(self, force=False):
+        events = []
+        now = self._time()
+        for run_id, watched in sorted(self.__runs.items()):
+            if force or watched.due <= now:
+                event = self.__poll_run(run_id, watched)
+                if event is not None:
+                    events.append(event)
+                    if self.callback is not None:
+                        self.callback(event)
+        return events
+
+    #
+    # Yields the RunEvents of the watched runs, sleeping until the next run
+    # is due in between polls. Returns once no runs are left.
+    #
+    def events(self):
+        while self.__runs:
+            delay = min(watched.due for watched in self.__runs.itervalues()) - self._time()
+            if delay > 0:
+                self._sleep(delay)
+            for event in self.poll():
+                yield event
+
+    def __poll_run(self, run_id, watched):
+        run = Run(self.__client, self.__client.send_get('get_run/%d' % run_id))
+        counts = _run_counts(run)
+        first = watched.counts is None
+        changed = first or counts != watched.counts
+
+        results = []
+        if first and watched.since is None:
+            self.__skip_results(run_id, watched)
+        elif changed:
+            results = self.__new_results(run_id, watched)
+
+        if run.is_completed:
+            del self.__runs[run_id]
+        elif changed:
+            watched.interval = self.min_interval
+        else:
+            watched.interval = min(self.max_interval, watched.interval * self.backoff)
+        watched.due = self._time() + watched.interval
+
+        if not changed and not results and not run.is_completed:
+            return None
+        previous = watched.counts or dict.fromkeys(counts, 0)
+        changes = dict((name, count - previous.get(name, 0)) for name, count in counts.iteritems()
+                       if count != previous.get(name, 0))
+        watched.counts = counts
+        return RunEvent(run, counts, changes, results)
+
+    # Fetches the results created after the newest one seen, created_after
+    # is a whole second so results of that second are told apart by id
+    def __new_results(self, run_id, watched):
+        uri = 'get_results_for_run/%d' % run_id
+        if watched.since is not None:
+            uri += '&created_after=%d' % (watched.since - 1)
+        results = [r for r in _iter_pages(self.__client, uri, 'results', 250, prefetch=False)
+                   if r['id'] not in watched.seen
+                   and (watched.since is None or r['created_on'] >= watched.since)]
+        results.sort(key=lambda r: (r['created_on'], r['id']))
+        self.__mark_seen(watched, results)
+        return results
+
+    # Results are returned newest first, the newest one marks where the next
+    # fetch starts. All results of its second are marked seen, as the next
+    # fetch starts with that second.
+    def __skip_results(self, run_id, watched):
+        uri = 'get_results_for_run/%d' % run_id
+        response = self.__client.send_get(uri + '&limit=1')
+        if isinstance(response, dict):
+            response = response.get('results', [])
+        if not response:
+            return
+        newest = response[0]['created_on']
+        uri += '&created_after=%d' % (newest - 1)
+        results = [r for r in _iter_pages(self.__client, uri, 'results', 250, prefetch=False)
+                   if r['created_on'] == newest]
+        self.__mark_seen(watched, results or response[:1])
+
+    def __mark_seen(self, watched, results):
+        if not results:
+            return
+        newest = results[-1]['created_on']
+        if newest != watched.since:
+            watched.seen = set()
+        watched.since = newest
+        watched.seen.update(r['id'] for r in results if r['created_on'] == newest)
+
+class _WatchedRun(object):
+    def __init__(self, since):
+        self.since = since
+        self.seen = set()
+        self.counts = None
+        self.interval = 0
+        self.due = 0
+
+def _run_counts(run):
+    counts = dict((name, getattr(run, name)) for name in Run._fields if name.endswith('_count'))
+    counts.update((name, value) for name, value in run.custom.iteritems() if name.endswith('_count'))
+    return counts
+
+#
+# A change of a watched run: the Run as polled, its status counters, the
+# counters that changed (as differences to the previous poll, all counters on
+# the first poll) and the results created since the previous poll (as
+# Python dicts, oldest first).
+#
+class RunEvent(object):
+    def __init__(self, run, counts, changes, results):
+        self.run = run
+        self.counts = counts
+        self.changes = changes
+        self.results = results
+
+    @property
+    def run_id(self):
+        return self.run.id
+
+    @property
+    def completed(self):
+        return self.run.is_completed
+
+#
+# Status history
+#
+# An index of the results of every case across runs for finding flaky,
+# newly failing and fixed cases. Results are added run by run and kept
+# sorted per case by the creation time of their run. Changes between passed
+# and failed are additionally kept in one list sorted by time, so a query
+# about the results since a point in time only visits the changes after it.
+# Statuses that are neither passed nor failed (e.g. untested or blocked) are
+# ignored.
+#
+# Arguments:
+#
+# passed              The status ids counting as passed
+# failed              The status ids counting as failed
+#
+# Example:
+#
+# history = StatusHistory()
+# for run in project.get_runs():
+#     history.add_run(run)
+# history.newly_failing(since=last_check)
+#
+class StatusHistory(object):
+    def __init__(self, passed=(1,), failed=(5,)):
+        self.passed = frozenset(passed)
+        self.failed = frozenset(failed)
+        self.__cases = {}
+        self.__changes = []
+        self.__runs = set()
+
+    def __len__(self):
+        return len(self.__cases)
+
+    #
+    # Adds the results of a run's tests, once per run. Returns the number of
+    # results added.
+    #
+    # Arguments:
+    #
+    # run                 The Run
+    # tests               The tests of the run (fetched with get_tests() if
+    #                     omitted)
+    #
+    def add_run(self, run, tests=None):
+        if run.id in self.__runs:
+            return 0
+        if tests is None:
+            tests = run.get_tests()
+
+        added = 0
+        for test in tests:
+            added += self.add(test.case_id, run.id, run.created_on, test.status_id)
+        self.__runs.add(run.id)
+        return added
+
+    #
+    # Adds a single result and returns whether it counted as passed or
+    # failed.
+    #
+    def add(self, case_id, run_id, created_on, status_id):
+        if status_id in self.passed:
+            outcome = 'passed'
+        elif status_id in self.failed:
+            outcome = 'failed'
+        else:
+            return False
+
+        keys, outcomes = self.__cases.setdefault(case_id, ([], []))
+        index = bisect.bisect(keys, (created_on, run_id))
+        keys.insert(index, (created_on, run_id))
+        outcomes.insert(index, outcome)
+        self.__update_change(case_id, keys, outcomes, index)
+        if index + 1 < len(keys):
+            self.__update_change(case_id, keys, outcomes, index + 1)
+        return True
+
+    #
+    # Returns the (created_on, run_id, outcome) results of a case, oldest
+    # first.
+    #
+    def history(self, case_id):
+        keys, outcomes = self.__cases.get(case_id, ([], []))
+        return [key + (outcome,) for key, outcome in zip(keys, outcomes)]
+
+    #
+    # Returns the latest outcome of a case ('passed', 'failed' or None).
+    #
+    def latest(self, case_id):
+        outcomes = self.__cases.get(case_id, (None, None))[1]
+        return outcomes[-1] if outcomes else None
+
+    #
+    # Returns the ids of the cases that passed before and have failed in
+    # every run since their latest change at or after since (a timestamp).
+    #
+    def newly_failing(self, since=0):
+        return self.__changed_to('failed', since)
+
+    #
+    # Returns the ids of the cases that failed before and have passed in
+    # every run since their latest change at or after since (a timestamp).
+    #
+    def fixed_since(self, since=0):
+        return self.__changed_to('passed', since)
+
+    #
+    # Returns a dict of the ids of the cases that changed between passed and
+    # failed at least min_changes times at or after since (a timestamp) and
+    # their number of changes.
+    #
+    def flaky(self, since=0, min_changes=2):
+        counts = collections.Counter(change[2] for change in self.__changes_since(since))
+        return dict((case_id, count) for case_id, count in counts.iteritems() if count >= min_changes)
+
+    def __changes_since(self, since):
+        return itertools.islice(self.__changes, bisect.bisect_left(self.__changes, (since,)), None)
+
+    def __changed_to(self, outcome, since):
+        latest = {}
+        for change in self.__changes_since(since):
+            latest[change[2]] = change
+        return sorted(case_id for case_id in latest if self.latest(case_id) == outcome)
+
+    # Adds or removes the change to result index of a case, depending on
+    # whether its outcome differs from the previous result's
+    def __update_change(self, case_id, keys, outcomes, index):
+        change = keys[index] + (case_id,)
+        position = bisect.bisect_left(self.__changes, change)
+        present = position < len(self.__changes) and self.__changes[position] == change
+        changed = index > 0 and outcomes[index] != outcomes[index - 1]
+        if changed and not present:
+            self.__changes.insert(position, change)
+        elif present and not changed:
+            del self.__changes[position]
+
+#
+# Local store
+#
+# A persistent SQLite copy of cases, runs and tests that is kept up to date
+# with incremental syncs. Cases are fetched with updated_after and runs with
+# created_after, relative to the newest timestamps already stored. Both are
+# exclusive and in whole seconds, so the second of the newest timestamp is
+# fetched again and its records are replaced. All lists are fetched
+# page_size records at a time. Tests are only refetched for runs that were
+# still active, as completed runs no longer change. Active runs that can no
+# longer be fetched were deleted and are removed with their tests. Cases
+# deleted on the server are not detected by a delta sync, use
+# sync_cases(suite, full=True) to refetch a suite completely.
+#
+# Arguments:
+#
+# client              The APIClient to sync with and to create records for
+# path                The SQLite database file (':memory:' for a temporary
+#                     store)
+# page_size           The number of records fetched per request
+#
+class LocalStore(object):
+    def __init__(self, client, path, page_size=250):
+        self.__client = client
+        self.page_size = page_size
+        self.__db = sqlite3.connect(path)
+        self.__db.executescript('''
+            CREATE TABLE IF NOT EXISTS cases (
+                id INTEGER PRIMARY KEY, suite_id INTEGER, updated_on INTEGER, data TEXT);
+            CREATE INDEX IF NOT EXISTS cases_suite ON cases (suite_id);
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, project_id INTEGER, created_on INTEGER,
+                is_completed INTEGER, data TEXT);
+            CREATE INDEX IF NOT EXISTS runs_project ON runs (project_id);
+            CREATE TABLE IF NOT EXISTS tests (
+                id INTEGER PRIMARY KEY, run_id INTEGER, data TEXT);
+            CREATE INDEX IF NOT EXISTS tests_run ON tests (run_id);
+            CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER);
+        ''')
+
+    def close(self):
+        self.__db.close()
+
+    #
+    # Fetches the cases of a suite changed since the last sync and returns
+    # the number of cases stored.
+    #
+    def sync_cases(self, suite, full=False):
+        key = 'cases/%d' % suite.id
+        last = None if full else self.__get_state(key)
+        uri = "get_cases/%d&suite_id=%d" % (suite.project_id, suite.id)
+        if last is not None:
+            uri += "&updated_after=%d" % (last - 1)
+
+        cases = list(_iter_pages(self.__client, uri, 'cases', self.page_size))
+        with self.__db:
+            if full:
+                self.__db.execute('DELETE FROM cases WHERE suite_id = ?', (suite.id,))
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO cases (id, suite_id, updated_on, data) VALUES (?, ?, ?, ?)',
+                [(c['id'], suite.id, c['updated_on'], json.dumps(c)) for c in cases])
+            newest = max([c['updated_on'] for c in cases] + [last or 0])
+            self.__set_state(key, newest)
+
+        return len(cases)
+
+    #
+    # Fetches the runs of a project created since the last sync, refreshes the
+    # runs that were active and refetches their tests. Returns the number of
+    # runs stored.
+    #
+    def sync_runs(self, project):
+        key = 'runs/%d' % project.id
+        last = self.__get_state(key)
+        uri = 'get_runs/%d' % project.id
+        if last is not None:
+            uri += '&created_after=%d' % (last - 1)
+
+        runs = dict((r['id'], r) for r in _iter_pages(self.__client, uri, 'runs', self.page_size))
+        deleted = []
+        if last is not None:
+            uri = 'get_runs/%d&is_completed=0' % project.id
+            runs.update((r['id'], r) for r in _iter_pages(self.__client, uri, 'runs', self.page_size))
+            for (run_id,) in self.__db.execute(
+                    'SELECT id FROM runs WHERE project_id = ? AND is_completed = 0', (project.id,)):
+                if run_id not in runs:
+                    try:
+                        runs[run_id] = self.__client.send_get('get_run/%d' % run_id)
+                    except APIError:
+                        deleted.append(run_id)
+
+        completed = set(run_id for (run_id,) in self.__db.execute(
+            'SELECT id FROM runs WHERE project_id = ? AND is_completed = 1', (project.id,)))
+        tests = [(run_id, list(_iter_pages(self.__client, 'get_tests/%d' % run_id, 'tests', self.page_size)))
+                 for run_id in runs if run_id not in completed]
+
+        with self.__db:
+            for run_id in deleted:
+                self.__db.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+                self.__db.execute('DELETE FROM tests WHERE run_id = ?', (run_id,))
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO runs (id, project_id, created_on, is_completed, data) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(r['id'], project.id, r['created_on'], int(bool(r['is_completed'])), json.dumps(r))
+                 for r in runs.itervalues()])
+            for run_id, run_tests in tests:
+                self.__db.execute('DELETE FROM tests WHERE run_id = ?', (run_id,))
+                self.__db.executemany(
+                    'INSERT INTO tests (id, run_id, data) VALUES (?, ?, ?)',
+                    [(t['id'], run_id, json.dumps(t)) for t in run_tests])
+            newest = max([r['created_on'] for r in runs.itervalues()] + [last or 0])
+            self.__set_state(key, newest)
+
+        return len(runs)
+
+    def get_cases(self, suite_id):
+        rows = self.__db.execute('SELECT data FROM cases WHERE suite_id = ? ORDER BY id', (suite_id,))
+        return [Case(self.__client, json.loads(data)) for (data,) in rows]
+
+    def get_runs(self, project_id):
+        rows = self.__db.execute('SELECT data FROM runs WHERE project_id = ? ORDER BY id', (project_id,))
+        return [Run(self.__client, json.loads(data)) for (data,) in rows]
+
+    def get_tests(self, run_id):
+        rows = self.__db.execute('SELECT data FROM tests WHERE run_id = ? ORDER BY id', (run_id,))
+        return [Test(self.__client, json.loads(data)) for (data,) in rows]
+
+    def __get_state(self, key):
+        row = self.__db.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def __set_state(self, key, value):
+        self.__db.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+#
+# Snapshot writer
+#
+# Writes projects, suites, cases, runs and tests into a compact binary
+# snapshot file that SnapshotReader opens without contacting the server.
+# Records are marshalled and zlib compressed in blocks of up to block_size
+# records of one kind. An index of the blocks, the first record of every
+# block, the records of every parent and the ids of every kind follows the
+# blocks at the end of the file. If the with block raises, the unfinished
+# file is removed instead.
+#
+# Arguments:
+#
+# path                The snapshot file to write
+# block_size          The number of records compressed together
+#
+# Example:
+#
+# with SnapshotWriter('project.snapshot') as writer:
+#     writer.export_project(client, 1)
+#
+class SnapshotWriter(object):
+    def __init__(self, path, block_size=256):
+        self.block_size = block_size
+        self.__path = path
+        self.__file = open(path, 'wb')
+        self.__file.write(_SNAPSHOT_MAGIC)
+        self.__offsets = []
+        self.__kinds = dict((kind, _SnapshotKind()) for kind in _SNAPSHOT_RECORDS)
+        self.__children = {}
+        self.__last_parent = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    #
+    # Adds the data of a record of kind (project, suite, case, run or test).
+    # Records with the same parent (the project of a suite or run, the suite
+    # of a case, the run of a test) have to be added one after another.
+    #
+    def add(self, kind, parent_id, data_dict):
+        records = self.__kinds[kind]
+        self.__add_children(kind, parent_id, 1)
+        records.ids.append(data_dict['id'])
+        records.pending.append(data_dict)
+        if len(records.pending) >= self.block_size:
+            self.__write_block(records)
+
+    #
+    # Adds a block of records of kind with the same parent as made by
+    # _compress_block(): their ids and their compressed data, which is
+    # written as it is without being decoded.
+    #
+    def add_block(self, kind, parent_id, ids, data):
+        records = self.__kinds[kind]
+        if records.pending:
+            self.__write_block(records)
+        self.__add_children(kind, parent_id, len(ids))
+        self.__offsets.append(self.__file.tell())
+        records.blocks.append(len(self.__offsets) - 1)
+        records.starts.append(len(records.ids))
+        records.ids.extend(ids)
+        self.__file.write(data)
+
+    #
+    # Fetches a project with its suites, cases, runs and tests and adds them.
+    # Every list is fetched page_size records at a time, so at most two pages
+    # of cases or tests are held at a time.
+    #
+    def export_project(self, client, project_id, page_size=250):
+        self.add('project', None, client.send_get('get_project/%d' % project_id))
+        suites = list(_iter_pages(client, 'get_suites/%d' % project_id, 'suites', page_size))
+        for suite in suites:
+            self.add('suite', project_id, suite)
+        for suite in suites:
+            uri = 'get_cases/%d&suite_id=%d' % (project_id, suite['id'])
+            for case in _iter_pages(client, uri, 'cases', page_size):
+                self.add('case', suite['id'], case)
+
+        runs = list(_iter_pages(client, 'get_runs/%d' % project_id, 'runs', page_size))
+        for run in runs:
+            self.add('run', project_id, run)
+        for run in runs:
+            for test in _iter_pages(client, 'get_tests/%d' % run['id'], 'tests', page_size):
+                self.add('test', run['id'], test)
+
+    def close(self):
+        if self.__file is None:
+            return
+
+        for records in self.__kinds.values():
+            if records.pending:
+                self.__write_block(records)
+
+        index_offset = self.__file.tell()
+        self.__offsets.append(index_offset)
+        kinds = {}
+        for kind, records in self.__kinds.items():
+            # Ids sorted for a binary search, each followed by its record number
+            order = sorted(xrange(len(records.ids)), key=records.ids.__getitem__)
+            kinds[kind] = (len(records.ids), self.__file.tell(), _pack('<i', records.blocks),
+                           _pack('<i', records.starts))
+            for start in xrange(0, len(order), 65536):
+                numbers = order[start:start + 65536]
+                table = [value for number in numbers for value in (records.ids[number], number)]
+                self.__file.write(_pack('<q', table))
+
+        blocks_offset = self.__file.tell()
+        self.__file.write(_pack('<Q', self.__offsets))
+        index = {
+            'block_size': self.block_size,
+            'blocks': (blocks_offset, len(self.__offsets)),
+            'kinds': kinds,
+            'children': self.__children,
+        }
+        data = marshal.dumps(index)
+        self.__file.write(data)
+        self.__file.write(struct.pack(_SNAPSHOT_TRAILER, _SNAPSHOT_MAGIC, index_offset, len(data)))
+        self.__file.close()
+        self.__file = None
+
+    #
+    # Closes and removes the unfinished file, e.g. after a failed export.
+    #
+    def abort(self):
+        if self.__file is None:
+            return
+
+        self.__file.close()
+        self.__file = None
+        os.remove(self.__path)
+
+    def __add_children(self, kind, parent_id, count):
+        key = (kind, parent_id)
+        if self.__last_parent.get(kind, key) != key and key in self.__children:
+            raise APIError("Records of %s %s were not added consecutively" % (kind, parent_id))
+        self.__last_parent[kind] = key
+        first, previous = self.__children.get(key, (len(self.__kinds[kind].ids), 0))
+        self.__children[key] = (first, previous + count)
+
+    def __write_block(self, records):
+        self.__offsets.append(self.__file.tell())
+        records.blocks.append(len(self.__offsets) - 1)
+        records.starts.append(len(records.ids) - len(records.pending))
+        self.__file.write(_compress_block(records.pending))
+        records.pending = []
+
+class _SnapshotKind(object):
+    def __init__(self):
+        self.ids = array.array('l')
+        self.blocks = array.array('l')
+        self.starts = array.array('l')
+        self.pending = []
+
+def _compress_block(records):
+    return zlib.compress(marshal.dumps(records), 6)
+
+def _pack(code, values):
+    return struct.pack('%s%d%s' % (code[0], len(values), code[1]), *values)
+
+_SNAPSHOT_MAGIC = 'TRSNAP02'
+_SNAPSHOT_TRAILER = '<8sQQ'
+_SNAPSHOT_RECORDS = ('project', 'suite', 'case', 'run', 'test')
+
+#
+# Snapshot reader
+#
+# Opens a snapshot written by SnapshotWriter. The file is memory mapped and
+# only its index is read when it is opened, records are decompressed block by
+# block when they are first accessed. The reader answers the GET requests of
+# the records it creates (get_suites, get_cases, get_runs, get_tests, ...)
+# from the snapshot, so Project.get_suites(), Suite.get_cases(),
+# Run.get_tests() and Run.prefetch_cases() work offline.
+#
+# Arguments:
+#
+# path                The snapshot file
+# cached_blocks       The number of decompressed blocks kept in memory
+#
+# Example:
+#
+# with SnapshotReader('project.snapshot') as snapshot:
+#     for run in snapshot.get_projects()[0].get_runs():
+#         print run.name, len(run.get_tests())
+#
+class SnapshotReader(object):
+    def __init__(self, path, cached_blocks=16):
+        self.cached_blocks = cached_blocks
+        with open(path, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            trailer_size = struct.calcsize(_SNAPSHOT_TRAILER)
+            magic, index_offset, index_size = struct.unpack_from(
+                _SNAPSHOT_TRAILER, self.__map, len(self.__map) - trailer_size)
+            if magic != _SNAPSHOT_MAGIC or self.__map[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+                raise ValueError("bad magic")
+            start = len(self.__map) - trailer_size - index_size
+            index = marshal.loads(self.__map[start:start + index_size])
+        except (struct.error, ValueError, EOFError, TypeError) as err:
+            self.__map.close()
+            raise APIError("Failed to read snapshot %s (%s)" % (path, err))
+
+        self.block_size = index['block_size']
+        self.__blocks_offset, self.__block_count = index['blocks']
+        self.__kinds = index['kinds']
+        self.__starts = dict((kind, struct.unpack('<%di' % (len(entry[3]) // 4), entry[3]))
+                             for kind, entry in self.__kinds.items())
+        self.__children = index['children']
+        self.__cache = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.__map.close()
+
+    #
+    # Returns the number of records of a kind.
+    #
+    def count(self, kind):
+        return self.__kinds[kind][0]
+
+    #
+    # Returns the record of a kind with the given id or None.
+    #
+    def get(self, kind, record_id):
+        data = self.get_data(kind, record_id)
+        if data is None:
+            return None
+        return _SNAPSHOT_CLASSES[kind](self, data)
+
+    #
+    # Returns the data (as Python dict) of the record of a kind with the
+    # given id or None.
+    #
+    def get_data(self, kind, record_id):
+        count, table_offset = self.__kinds[kind][:2]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if struct.unpack_from('<q', self.__map, table_offset + middle * 16)[0] < record_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == count:
+            return None
+        found, number = struct.unpack_from('<qq', self.__map, table_offset + low * 16)
+        if found != record_id:
+            return None
+        return self.__record(kind, number)
+
+    #
+    # Yields the data of all records of a kind, or of the records of a kind
+    # with the given parent, in the order they were added.
+    #
+    def iter_data(self, kind, parent_id=None, limit=None, offset=0):
+        if parent_id is None:
+            first, count = 0, self.count(kind)
+        else:
+            first, count = self.__children.get((kind, parent_id), (0, 0))
+        start = first + min(offset, count)
+        end = first + count if limit is None else min(first + count, start + limit)
+        for number in xrange(start, end):
+            yield self.__record(kind, number)
+
+    def get_projects(self):
+        return self.__build('project', None)
+
+    #
+    # Answers a GET request of the binding from the snapshot. List requests
+    # support limit, offset and the filters the API supports for them (see
+    # _SERVER_FILTERS), other parameters raise an APIError.
+    #
+    def send_get(self, uri):
+        name, args = _endpoint(uri)
+        try:
+            args = [int(arg) for arg in args]
+            params = dict(p.split('=', 1) for p in uri.split('&')[1:] if '=' in p)
+            if name in _SNAPSHOT_LISTS:
+                kind = _SNAPSHOT_LISTS[name]
+                parent_id = None if kind == 'project' else args[0]
+                if kind == 'case':
+                    parent_id = int(params.pop('suite_id'))
+                limit = int(params.pop('limit')) if 'limit' in params else None
+                offset = int(params.pop('offset', 0))
+                if not params:
+                    return list(self.iter_data(kind, parent_id, limit, offset))
+                filters = [_snapshot_filter(name, param, value) for param, value in params.items()]
+                records = [data for data in self.iter_data(kind, parent_id) if all(f(data) for f in filters)]
+                return records[offset:] if limit is None else records[offset:offset + limit]
+            if name[4:] in _SNAPSHOT_RECORDS:
+                data = self.get_data(name[4:], args[0])
+                if data is not None:
+                    return data
+        except (KeyError, IndexError, ValueError):
+            pass
+        raise APIError("'%s' is not part of the snapshot" % uri)
+
+    def send_get_stream(self, uri, key=None):
+        return iter(self.send_get(uri))
+
+    def __build(self, kind, parent_id):
+        return [_SNAPSHOT_CLASSES[kind](self, data) for data in self.iter_data(kind, parent_id)]
+
+    def __record(self, kind, number):
+        starts = self.__starts[kind]
+        position = bisect.bisect_right(starts, number) - 1
+        block = struct.unpack_from('<i', self.__kinds[kind][2], position * 4)[0]
+        return self.__block(block)[number - starts[position]]
+
+    def __block(self, block):
+        with self.__lock:
+            records = self.__cache.pop(block, None)
+            if records is None:
+                start, end = struct.unpack_from('<QQ', self.__map, self.__blocks_offset + block * 8)
+                records = marshal.loads(zlib.decompress(self.__map[start:end]))
+                while len(self.__cache) >= self.cached_blocks:
+                    self.__cache.popitem(last=False)
+            self.__cache[block] = records
+            return records
+
+_SNAPSHOT_CLASSES = {
+    'project': Project,
+    'suite': Suite,
+    'case': Case,
+    'run': Run,
+    'test': Test,
+}
+
+_SNAPSHOT_LISTS = {
+    'get_projects': 'project',
+    'get_suites': 'suite',
+    'get_cases': 'case',
+    'get_runs': 'run',
+    'get_tests': 'test',
+}
+
+#
+# Returns a function telling whether the data of a record matches a filter
+# parameter of a list request, which must be one the API supports for it.
+#
+def _snapshot_filter(name, param, value):
+    if param not in _SERVER_FILTERS.get(name, {}):
+        raise APIError("Filter '%s' of '%s' is not supported by snapshots" % (param, name))
+    value = urllib.unquote(value)
+    if param.endswith('_after'):
+        field, after = param.split('_')[0] + '_on', int(value)
+        return lambda data: data.get(field) > after
+    if param.endswith('_before'):
+        field, before = param.split('_')[0] + '_on', int(value)
+        return lambda data: data.get(field) < before
+    if param == 'is_completed':
+        return lambda data: data.get(param) == (value == '1')
+    values = set(int(v) for v in value.split(','))
+    return lambda data: data.get(param) in values
+
+#
+# Sharded exporter
+#
+# Writes projects into a snapshot (see SnapshotWriter) with the cases of
+# every suite and the tests of every run fetched by a pool of worker
+# processes, so decoding and compressing them is not limited to one core by
+# the GIL. Every worker has its own APIClient. A worker pages through the
+# records of a suite or run and sends them back as finished snapshot blocks,
+# which the parent process writes as they are. Projects, suites and runs are
+# listed by the parent, the shards of all projects are handed to the pool as
+# soon as their suite or run is listed.
+#
+# Arguments:
+#
+# base_url            The TestRail URL (e.g. http://myserver/testrail/)
+# user                The user name
+# password            The password or API key
+# processes           The number of worker processes (defaults to the
+#                     number of CPUs)
+# client_options      Further keyword arguments of the APIClients (e.g.
+#                     timeout or max_retries)
+#
+# Example:
+#
+# exporter = ShardedExporter('http://myserver/testrail/', 'user', 'key')
+# exporter.export('instance.snapshot')
+#
+class ShardedExporter(object):
+    def __init__(self, base_url, user='', password='', processes=None, **client_options):
+        self.base_url = base_url
+        self.user = user
+        self.password = password
+        self.processes = processes
+        self.client_options = client_options
+
+    #
+    # Exports projects into a snapshot file and returns the number of records
+    # written per kind.
+    #
+    # Arguments:
+    #
+    # path                The snapshot file to write
+    # project_ids         The ids of the projects to export (all projects if
+    #                     omitted)
+    # block_size          The number of records compressed together
+    # page_size           The number of records requested at a time
+    #
+    def export(self, path, project_ids=None, block_size=256, page_size=250):
+        client = _shard_client(self.base_url, self.user, self.password, self.client_options)
+        counts = dict((kind, 0) for kind in _SNAPSHOT_RECORDS)
+        pool = multiprocessing.Pool(self.processes, _init_shard_worker,
+                                    (self.base_url, self.user, self.password, self.client_options))
+        try:
+            with SnapshotWriter(path, block_size) as writer:
+                shards = []
+                for project in _iter_pages(client, 'get_projects', 'projects', page_size):
+                    if project_ids is not None and project['id'] not in project_ids:
+                        continue
+                    writer.add('project', None, project)
+                    counts['project'] += 1
+                    for kind in ('suite', 'run'):
+                        uri = 'get_%ss/%d' % (kind, project['id'])
+                        for record in _iter_pages(client, uri, kind + 's', page_size):
+                            writer.add(kind, project['id'], record)
+                            counts[kind] += 1
+                            task = _shard_task(kind, project['id'], record['id'], block_size, page_size)
+                            shards.append(pool.apply_async(_export_shard, (task,)))
+
+                for shard in shards:
+                    kind, parent_id, blocks = shard.get()
+                    for ids, data in blocks:
+                        writer.add_block(kind, parent_id, ids, data)
+                        counts[kind] += len(ids)
+        finally:
+            pool.terminate()
+            pool.join()
+            client.close()
+        return counts
+
+def _shard_client(base_url, user, password, options):
+    client = APIClient(base_url, **options)
+    client.user = user
+    client.password = password
+    return client
+
+# The APIClient of a worker process
+_worker_client = None
+
+def _init_shard_worker(base_url, user, password, options):
+    global _worker_client
+    _worker_client = _shard_client(base_url, user, password, options)
+
+def _shard_task(kind, project_id, record_id, block_size, page_size):
+    if kind == 'suite':
+        uri, key = 'get_cases/%d&suite_id=%d' % (project_id, record_id), 'cases'
+    else:
+        uri, key = 'get_tests/%d' % record_id, 'tests'
+    return key[:-1], record_id, uri, key, block_size, page_size
+
+# Returns the records of a shard as (ids, compressed data) blocks
+def _export_shard(task):
+    kind, parent_id, uri, key, block_size, page_size = task
+    blocks = []
+    records = []
+    for record in _iter_pages(_worker_client, uri, key, page_size, prefetch=False):
+        records.append(record)
+        if len(records) == block_size:
+            blocks.append(([r['id'] for r in records], _compress_block(records)))
+            records = []
+    if records:
+        blocks.append(([r['id'] for r in records], _compress_block(records)))
+    return kind, parent_id, blocks
+
+#
+# Column tables
+#
+# Column oriented NumPy copies of runs or tests for vectorized aggregation.
+# Each field becomes an array with one element per record. Ids that are not
+# set are stored as -1. Status and priority ids are categorical: the column
+# holds small integer codes into the sorted array of distinct ids in
+# categories. NumPy has to be installed to create column tables.
+#
+class ColumnTable(object):
+    def __init__(self, columns, categories):
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self):
+        return len(next(self.columns.itervalues())) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    #
+    # Returns the values of a column, translating the codes of a categorical
+    # column back to ids.
+    #
+    def values(self, name):
+        if name in self.categories:
+            return self.categories[name][self.columns[name]]
+        return self.columns[name]
+
+_RUN_COLUMNS = ('id', 'project_id', 'suite_id', 'milestone_id', 'plan_id', 'created_on',
+                'completed_on', 'passed_count', 'failed_count', 'blocked_count',
+                'retest_count', 'untested_count')
+_TEST_COLUMNS = ('id', 'run_id', 'case_id', 'assignedto_id', 'milestone_id', 'type_id')
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("NumPy is required for column tables")
+
+def _id_column(records, name):
+    values = (getattr(r, name) for r in records)
+    return numpy.fromiter((-1 if v is None else v for v in values), numpy.int64, len(records))
+
+def _categorical_column(records, name):
+    ids = _id_column(records, name)
+    categories, codes = numpy.unique(ids, return_inverse=True)
+    return codes.astype(numpy.int32), categories
+
+#
+# Returns a ColumnTable of runs with their ids, timestamps and status counts
+# plus an is_completed column.
+#
+def runs_to_columns(runs):
+    _require_numpy()
+    runs = list(runs)
+    columns = dict((name, _id_column(runs, name)) for name in _RUN_COLUMNS)
+    columns['is_completed'] = numpy.fromiter((bool(r.is_completed) for r in runs), numpy.bool_, len(runs))
+    return ColumnTable(columns, {})
+
+#
+# Returns a ColumnTable of tests with their ids and the categorical
+# status_id and priority_id columns.
+#
+def tests_to_columns(tests):
+    _require_numpy()
+    tests = list(tests)
+    columns = dict((name, _id_column(tests, name)) for name in _TEST_COLUMNS)
+    categories = {}
+    for name in ('status_id', 'priority_id'):
+        columns[name], categories[name] = _categorical_column(tests, name)
+    return ColumnTable(columns, categories)
+
+#
+# Returns a dict of value to the number of records with that value of a
+# (categorical) column.
+#
+def count_values(table, name):
+    if name in table.categories:
+        counts = numpy.bincount(table[name], minlength=len(table.categories[name]))
+        return dict(zip(table.categories[name].tolist(), counts.tolist()))
+    values, counts = numpy.unique(table[name], return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+#
+# Returns the distinct values of the key column and the sums of the value
+# column per key.
+#
+def group_sum(table, key, value):
+    keys, inverse = numpy.unique(table.values(key), return_inverse=True)
+    return keys, numpy.bincount(inverse, weights=table[value], minlength=len(keys))
+
+#
+# Returns the pass rate of each run of a runs table: passed tests divided by
+# the tests with a result. Runs without results have a pass rate of NaN.
+#
+def pass_rates(runs):
+    executed = runs['passed_count'] + runs['failed_count'] + runs['blocked_count'] + runs['retest_count']
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(executed > 0, runs['passed_count'] / executed.astype(numpy.float64), numpy.nan)
+
+#
+# Returns the distinct values of the key column (e.g. milestone_id) of a runs
+# table and the pass rate over all runs per key.
+#
+def group_pass_rates(runs, key='milestone_id'):
+    keys, passed = group_sum(runs, key, 'passed_count')
+    executed = runs['passed_count'] + runs['failed_count'] + runs['blocked_count'] + runs['retest_count']
+    table = ColumnTable({key: runs[key], 'executed': executed}, {})
+    _, executed = group_sum(table, key, 'executed')
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return keys, numpy.where(executed > 0, passed / executed, numpy.nan)
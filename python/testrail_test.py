@@ -1,7 +1,23 @@
 import unittest
 import mock
 import testrail
+import fake_server
 import time
+import collections
+import json
+import StringIO
+import threading
+import tempfile
+import os
+import zlib
+import BaseHTTPServer
+import SocketServer
+import httplib
+import socket
+import re
+
+
+_CREATED_ON = fake_server._CREATED_ON
 
 
 def _dummy_project(name, record_id):
@@ -109,6 +125,139 @@ def _dummy_status(record_id):
     }
 
 
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.headers, None))
+        self._reply()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.command, self.path, self.headers, body))
+        self._reply()
+
+    def _reply(self):
+        response = self.server.responses.pop(0) if self.server.responses else (200, [])
+        status, payload = response[:2]
+        body = json.dumps(payload)
+        self.send_response(status)
+        for name, value in (response[2] if len(response) > 2 else {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StubHandler)
+        self.requests = []
+        self.responses = []
+        self.connections = 0
+        self.__thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/testrail' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _dummy_priority(record_id):
+    return {
+        "id": record_id,
+        "is_default": False,
+        "name": "4 - Must Test",
+        "priority": 4,
+        "short_name": "4 - Must"
+    }
+
+
+def _dummy_user(record_id):
+    return {
+        "email": "chuck@example.com",
+        "id": record_id,
+        "is_active": True,
+        "name": "Chuck Norris"
+    }
+
+
+def _dummy_milestone(record_id):
+    return {
+        "completed_on": None,
+        "description": None,
+        "due_on": 1391968184,
+        "id": record_id,
+        "is_completed": False,
+        "name": "Release 1.5",
+        "project_id": 2,
+        "url": "fake_url"
+    }
+
+
+def _dummy_section(record_id, parent_id=None, display_order=1):
+    return {
+        "depth": 0,
+        "description": None,
+        "display_order": display_order,
+        "id": record_id,
+        "name": "Section %d" % record_id,
+        "parent_id": parent_id,
+        "suite_id": 3
+    }
+
+
+def _dummy_plan(record_id, entries=None):
+    plan = {
+        "assignedto_id": None,
+        "blocked_count": 0,
+        "completed_on": None,
+        "created_by": 1,
+        "created_on": 1393845644,
+        "description": None,
+        "failed_count": 2,
+        "id": record_id,
+        "is_completed": False,
+        "milestone_id": None,
+        "name": "System test",
+        "passed_count": 5,
+        "project_id": 123,
+        "retest_count": 1,
+        "untested_count": 6,
+        "url": "fake_url"
+    }
+    if entries is not None:
+        plan["entries"] = entries
+    return plan
+
+
+def _dummy_plan_entry(entry_id, suite_id, runs):
+    return {
+        "description": None,
+        "id": entry_id,
+        "include_all": True,
+        "name": "Entry %s" % entry_id,
+        "runs": runs,
+        "suite_id": suite_id
+    }
+
+
 class TestRailTestCase(unittest.TestCase):
     def test_get_projects_request(self):
         client = testrail.APIClient("server_url")
@@ -151,6 +300,1637 @@ class TestRailTestCase(unittest.TestCase):
         self.assertEqual(3, statuses[1].id)
 
 
+class SendRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = _StubServer()
+        self.__client = testrail.APIClient(self.__server.url)
+        self.__client.user = 'chuck'
+        self.__client.password = 'norris'
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def test_send_get(self):
+        self.__server.responses.append((200, [{'id': 1}]))
+        self.assertEqual([{'id': 1}], self.__client.send_get('get_projects'))
+
+        method, path, headers, _ = self.__server.requests[0]
+        self.assertEqual('GET', method)
+        self.assertEqual('/testrail/index.php?/api/v2/get_projects', path)
+        self.assertEqual('Basic Y2h1Y2s6bm9ycmlz', headers['Authorization'])
+
+    def test_send_post(self):
+        self.__client.send_post('add_result/1', {'status_id': 1})
+
+        method, path, _, body = self.__server.requests[0]
+        self.assertEqual('POST', method)
+        self.assertEqual('/testrail/index.php?/api/v2/add_result/1', path)
+        self.assertEqual({'status_id': 1}, json.loads(body))
+
+    def test_connection_is_reused(self):
+        for _ in range(5):
+            self.__client.send_get('get_statuses')
+
+        self.assertEqual(5, len(self.__server.requests))
+        self.assertEqual(1, self.__server.connections)
+
+    def test_send_get_stream(self):
+        self.__server.responses.append((200, [_dummy_case(i) for i in range(100)]))
+        self.__server.responses.append((200, []))
+
+        cases = list(self.__client.send_get_stream('get_cases/1&suite_id=2'))
+        self.assertEqual(range(100), [c['id'] for c in cases])
+        self.__client.send_get('get_statuses')
+        self.assertEqual(1, self.__server.connections)
+
+    def test_send_get_stream_error_raises_apierror(self):
+        self.__server.responses.append((403, {'error': 'No access'}))
+        with self.assertRaises(testrail.APIError):
+            list(self.__client.send_get_stream('get_cases/1'))
+
+    def test_send_get_stream_follows_next_links(self):
+        self.__server.responses.append((200, {'cases': [_dummy_case(1), _dummy_case(2)],
+                                              '_links': {'next': '/api/v2/get_cases/1&limit=2&offset=2'}}))
+        self.__server.responses.append((200, {'cases': [_dummy_case(3)], '_links': {'next': None}}))
+
+        cases = list(self.__client.send_get_stream('get_cases/1&suite_id=2', 'cases'))
+        self.assertEqual([1, 2, 3], [c['id'] for c in cases])
+        self.assertEqual('/testrail/index.php?/api/v2/get_cases/1&suite_id=2&offset=2',
+                         self.__server.requests[1][1])
+
+    def test_stream_tests(self):
+        self.__server.responses.append((200, {'tests': [_dummy_test(7)], '_links': {'next': None}}))
+        run = testrail.Run(self.__client, _dummy_run(5))
+        self.assertEqual([7], [t.id for t in run.stream_tests()])
+
+    def test_changed_credentials_update_auth_header(self):
+        self.__client.send_get('get_statuses')
+        self.__client.password = 'other'
+        self.__client.send_get('get_statuses')
+
+        self.assertNotEqual(self.__server.requests[0][2]['Authorization'],
+                            self.__server.requests[1][2]['Authorization'])
+
+    def test_error_raises_apierror(self):
+        self.__server.responses.append((400, {'error': 'Field :case_id is not a valid test case.'}))
+        with self.assertRaises(testrail.APIError) as ctx:
+            self.__client.send_get('get_case/1')
+
+        self.assertIn('HTTP 400', str(ctx.exception))
+        self.assertIn('Field :case_id', str(ctx.exception))
+        self.assertEqual(1, len(self.__server.requests))
+
+    def test_throttled_get_is_retried(self):
+        self.__client._sleep = mock.Mock()
+        self.__server.responses.extend([(429, {}, {'Retry-After': '7'}), (503, {}), (200, [{'id': 1}])])
+
+        self.assertEqual([{'id': 1}], self.__client.send_get('get_projects'))
+        self.assertEqual(3, len(self.__server.requests))
+        self.assertEqual(mock.call(7.0), self.__client._sleep.call_args_list[0])
+        self.assertTrue(self.__client._sleep.call_args_list[1][0][0] <= 1.0)
+
+    def test_retries_are_limited(self):
+        self.__client._sleep = mock.Mock()
+        self.__client.max_retries = 2
+        self.__server.responses.extend([(500, {})] * 3)
+
+        self.assertRaises(testrail.APIError, self.__client.send_get, 'get_projects')
+        self.assertEqual(3, len(self.__server.requests))
+
+    def test_post_is_retried_only_when_enabled(self):
+        self.__client._sleep = mock.Mock()
+        self.__server.responses.extend([(503, {}), (503, {}), (200, {})])
+        self.assertRaises(testrail.APIError, self.__client.send_post, 'add_result/1', {})
+        self.assertEqual(1, len(self.__server.requests))
+
+        self.__client.retry_posts = True
+        self.assertEqual({}, self.__client.send_post('add_result/1', {}))
+        self.assertEqual(3, len(self.__server.requests))
+
+    def test_limiter_shrinks_on_throttling(self):
+        self.__client._sleep = mock.Mock()
+        self.__client.limiter = testrail.AdaptiveLimiter(initial=8)
+        self.__server.responses.extend([(429, {}), (200, [])])
+
+        self.__client.send_get('get_projects')
+        self.assertEqual(4, self.__client.limiter.limit)
+        self.assertEqual(0, self.__client.limiter.in_flight)
+
+
+class ReferenceDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__responses = {
+            "get_statuses": [_dummy_status(1), _dummy_status(3)],
+            "get_priorities": [_dummy_priority(4)],
+            "get_case_types": [{"id": 6, "is_default": False, "name": "Functional"}],
+            "get_users": [_dummy_user(2)],
+            "get_milestones/2": [_dummy_milestone(8)],
+            "get_milestone/9": _dummy_milestone(9),
+        }
+        self.__client = testrail.APIClient("")
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: self.__responses[uri])
+
+    def test_tables_are_loaded_once(self):
+        reference = self.__client.reference
+        self.assertIs(reference, self.__client.reference)
+        self.assertEqual(3, reference.status(3).id)
+        self.assertEqual(1, reference.status(1).id)
+        self.assertEqual("4 - Must", reference.priority(4).short_name)
+        self.assertEqual(2, self.__client.send_get.call_count)
+
+    def test_unknown_id_raises_apierror(self):
+        self.assertRaises(testrail.APIError, self.__client.reference.user, 5)
+
+    def test_resolve(self):
+        reference = self.__client.reference
+        reference.load_milestones(2)
+        test = testrail.Test(self.__client, dict(_dummy_test(5), assignedto_id=2, milestone_id=8))
+
+        resolved = reference.resolve(test)
+        self.assertEqual(3, resolved['status'].id)
+        self.assertEqual(4, resolved['priority'].id)
+        self.assertEqual("Functional", resolved['type'].name)
+        self.assertEqual("Chuck Norris", resolved['assignedto'].name)
+        self.assertEqual("Release 1.5", resolved['milestone'].name)
+
+    def test_missing_milestone_is_fetched(self):
+        self.assertEqual(9, self.__client.reference.milestone(9).id)
+        self.assertIs(self.__client.reference.milestone(9), self.__client.reference.milestone(9))
+        self.__client.send_get.assert_called_once_with("get_milestone/9")
+
+    def test_refresh_reloads_tables(self):
+        reference = self.__client.reference
+        reference.status(1)
+        reference.refresh()
+        reference.status(1)
+        self.assertEqual(2, self.__client.send_get.call_count)
+
+    def test_tables_load_in_parallel(self):
+        statuses_requested = threading.Event()
+        users_loaded = threading.Event()
+        waited = []
+
+        def send_get(uri):
+            if uri == "get_statuses":
+                statuses_requested.set()
+                waited.append(users_loaded.wait(1))
+            return self.__responses[uri]
+
+        self.__client.send_get = send_get
+        reference = self.__client.reference
+        thread = threading.Thread(target=reference.status, args=(1,))
+        thread.start()
+        self.assertTrue(statuses_requested.wait(1))
+        self.assertEqual(2, reference.user(2).id)
+        users_loaded.set()
+        thread.join()
+        self.assertEqual([True], waited)
+        self.assertEqual(1, reference.status(1).id)
+
+
+class RequestMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = _StubServer()
+        self.__metrics = testrail.RequestMetrics()
+        self.__client = testrail.APIClient(self.__server.url, metrics=self.__metrics)
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def test_hooks(self):
+        before = mock.Mock()
+        after = mock.Mock()
+        self.__client.add_request_hook(before, after)
+        self.__server.responses.append((200, [_dummy_project("p", 1)]))
+        self.__client.send_get('get_projects')
+
+        before.assert_called_once_with('GET', 'get_projects')
+        info = after.call_args[0][0]
+        self.assertEqual('get_projects', info['endpoint'])
+        self.assertEqual(200, info['status'])
+        self.assertEqual(1, info['attempts'])
+        self.assertTrue(info['bytes'] > 0)
+        self.assertIsNone(info['error'])
+
+        self.__client.remove_request_hook(before, after)
+        self.__client.send_get('get_projects')
+        self.assertEqual(1, before.call_count)
+
+    def test_after_hook_receives_error(self):
+        after = mock.Mock()
+        self.__client.add_request_hook(after=after)
+        self.__server.responses.append((400, {'error': 'bad'}))
+        self.assertRaises(testrail.APIError, self.__client.send_get, 'get_case/1')
+        self.assertIsInstance(after.call_args[0][0]['error'], testrail.APIError)
+
+    def test_metrics(self):
+        self.__server.responses.extend([(200, [_dummy_case(1), _dummy_case(2)]), (404, {})])
+        suite = testrail.Suite(self.__client, _dummy_suite("suite", 3))
+        suite.get_cases()
+        self.assertRaises(testrail.APIError, self.__client.send_get, 'get_cases/1&suite_id=9')
+
+        data = self.__metrics.as_dict()
+        endpoint = data['endpoints']['get_cases']
+        self.assertEqual(2, endpoint['calls'])
+        self.assertEqual({200: 1, 404: 1}, endpoint['statuses'])
+        self.assertEqual(2, sum(endpoint['latency_buckets']))
+        self.assertTrue(endpoint['bytes'] > 0)
+        self.assertEqual(2, data['records']['Case']['count'])
+
+    def test_iterated_and_streamed_records_are_counted(self):
+        self.__server.responses.extend([(200, [_dummy_case(i) for i in range(3)]),
+                                        (200, [_dummy_case(i) for i in range(5)])])
+        suite = testrail.Suite(self.__client, _dummy_suite("suite", 3))
+        self.assertEqual(3, len(list(suite.iter_cases())))
+        cases = suite.stream_cases()
+        next(cases)
+        cases.close()
+        self.assertEqual(4, self.__metrics.as_dict()['records']['Case']['count'])
+
+    def test_streamed_requests_are_reported_when_closed(self):
+        after = mock.Mock()
+        self.__client.add_request_hook(after=after)
+        self.__server.responses.append((200, [_dummy_case(i) for i in range(100)]))
+        cases = self.__client.send_get_stream('get_cases/1&suite_id=2')
+        next(cases)
+        self.assertFalse(after.called)
+
+        self.assertEqual(99, len(list(cases)))
+        info = after.call_args[0][0]
+        self.assertEqual(200, info['status'])
+        self.assertTrue(info['bytes'] > 100 * 100)
+        self.assertEqual(info['bytes'], self.__metrics.as_dict()['endpoints']['get_cases']['bytes'])
+
+    def test_prometheus(self):
+        self.__server.responses.append((200, [_dummy_status(1)]))
+        self.__client.get_statuses()
+
+        text = self.__metrics.prometheus()
+        self.assertIn('testrail_requests_total{endpoint="get_statuses",status="200"} 1\n', text)
+        self.assertIn('testrail_request_duration_seconds_bucket{endpoint="get_statuses",le="+Inf"} 1\n', text)
+        self.assertIn('testrail_request_duration_seconds_count{endpoint="get_statuses"} 1\n', text)
+        self.assertIn('testrail_records_total{record="Status"} 1\n', text)
+
+    def test_prometheus_groups_samples_by_metric(self):
+        self.__server.responses.append((200, [_dummy_status(1)]))
+        self.__server.responses.append((200, [_dummy_priority(1)]))
+        self.__client.get_statuses()
+        self.__client.get_priorities()
+
+        families = []
+        for line in self.__metrics.prometheus().splitlines():
+            if line.startswith('# TYPE'):
+                name = line.split()[2]
+            else:
+                name = re.sub(r'_(bucket|sum|count)$', '', line.split('{')[0])
+            if not families or families[-1] != name:
+                families.append(name)
+        self.assertEqual(len(set(families)), len(families))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = _StubServer()
+        self.__cache = testrail.ResponseCache(default_ttl=60)
+        self.__client = testrail.APIClient(self.__server.url, cache=self.__cache)
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def test_get_is_served_from_cache(self):
+        self.__server.responses.append((200, [_dummy_status(1)]))
+        self.assertEqual(1, self.__client.get_statuses()[0].id)
+        self.assertEqual(1, self.__client.get_statuses()[0].id)
+
+        self.assertEqual(1, len(self.__server.requests))
+        stats = self.__cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+    def test_expired_entries_are_refetched(self):
+        self.__cache.ttls['get_projects'] = 0.01
+        self.__client.send_get('get_projects')
+        time.sleep(0.02)
+        self.__client.send_get('get_projects')
+        self.assertEqual(2, len(self.__server.requests))
+
+    def test_zero_ttl_disables_caching(self):
+        self.__cache.ttls['get_projects'] = 0
+        self.__client.send_get('get_projects')
+        self.__client.send_get('get_projects')
+        self.assertEqual(2, len(self.__server.requests))
+        self.assertEqual(0, len(self.__cache))
+
+    def test_post_invalidates_affected_responses(self):
+        for uri in ['get_tests/1', 'get_tests/2', 'get_run/1', 'get_cases/3&suite_id=4']:
+            self.__client.send_get(uri)
+        self.__client.send_post('add_results_for_cases/1', {'results': []})
+
+        self.__client.send_get('get_tests/1')
+        self.__client.send_get('get_tests/2')
+        self.__client.send_get('get_run/1')
+        self.__client.send_get('get_cases/3&suite_id=4')
+        self.assertEqual(['get_tests/1', 'get_run/1'],
+                         [r[1].split('/api/v2/')[1] for r in self.__server.requests[5:]])
+
+    def test_unknown_post_clears_cache(self):
+        self.__client.send_get('get_projects')
+        self.__client.send_post('add_something/1', {})
+        self.assertEqual(0, len(self.__cache))
+
+    def test_lru_eviction_by_count(self):
+        cache = testrail.ResponseCache(max_entries=2)
+        cache.put('get_case/1', {}, 10)
+        cache.put('get_case/2', {}, 10)
+        cache.get('get_case/1')
+        cache.put('get_case/3', {}, 10)
+
+        self.assertTrue(cache.get('get_case/1')[1])
+        self.assertFalse(cache.get('get_case/2')[1])
+        self.assertEqual(1, cache.evictions)
+
+    def test_lru_eviction_by_size(self):
+        cache = testrail.ResponseCache(max_bytes=25)
+        cache.put('get_case/1', {}, 10)
+        cache.put('get_case/2', {}, 10)
+        cache.put('get_case/3', {}, 10)
+
+        self.assertEqual(20, cache.size)
+        self.assertFalse(cache.get('get_case/1')[1])
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(latency=0.1)
+        self.__server.start()
+
+    def tearDown(self):
+        self.__server.stop()
+
+    def __get_concurrently(self, client, uri, count=5):
+        results = [None] * count
+
+        def get(index):
+            try:
+                results[index] = client.send_get(uri)
+            except testrail.APIError as err:
+                results[index] = err
+
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_gets_share_one_request(self):
+        client = testrail.APIClient(self.__server.url, single_flight=True)
+        results = self.__get_concurrently(client, 'get_statuses')
+        client.close()
+
+        self.assertEqual(1, self.__server.requests)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_concurrent_gets_share_errors(self):
+        client = testrail.APIClient(self.__server.url, single_flight=True)
+        results = self.__get_concurrently(client, 'get_run/99')
+        client.close()
+
+        self.assertEqual(1, self.__server.requests)
+        self.assertIsInstance(results[0], testrail.APIError)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_sequential_gets_are_not_shared(self):
+        client = testrail.APIClient(self.__server.url, single_flight=True)
+        client.send_get('get_statuses')
+        client.send_get('get_statuses')
+        client.close()
+        self.assertEqual(2, self.__server.requests)
+
+    def test_single_flight_is_off_by_default(self):
+        client = testrail.APIClient(self.__server.url)
+        self.__get_concurrently(client, 'get_statuses', count=3)
+        client.close()
+        self.assertEqual(3, self.__server.requests)
+
+    def test_interrupted_call_releases_waiting_calls(self):
+        flight = testrail._SingleFlight()
+        started = threading.Event()
+        results = []
+
+        def interrupted():
+            started.set()
+            time.sleep(0.05)
+            raise KeyboardInterrupt()
+
+        def leader():
+            try:
+                flight.do('key', interrupted)
+            except KeyboardInterrupt as err:
+                results.append(err)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+        self.assertRaises(testrail.APIError, flight.do, 'key', lambda: 1)
+        thread.join()
+        self.assertIsInstance(results[0], KeyboardInterrupt)
+        self.assertEqual(2, flight.do('key', lambda: 2))
+
+
+class AdaptiveLimiterTestCase(unittest.TestCase):
+    def test_limit_grows_while_latency_is_stable(self):
+        limiter = testrail.AdaptiveLimiter(initial=2, maximum=4)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(4, limiter.limit)
+
+    def test_limit_does_not_grow_while_latency_is_high(self):
+        limiter = testrail.AdaptiveLimiter(initial=2, latency_tolerance=1.5)
+        limiter.acquire()
+        limiter.release(0.1)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(1.0)
+        self.assertEqual(2, limiter.limit)
+
+    def test_limit_halves_on_throttling(self):
+        limiter = testrail.AdaptiveLimiter(initial=8, minimum=3)
+        limiter.acquire()
+        limiter.release(0.1, throttled=True)
+        self.assertEqual(4, limiter.limit)
+        limiter.acquire()
+        limiter.release(0.1, throttled=True)
+        self.assertEqual(3, limiter.limit)
+
+    def test_concurrent_throttling_halves_once(self):
+        limiter = testrail.AdaptiveLimiter(initial=8)
+        tickets = [limiter.acquire() for _ in range(8)]
+        for ticket in tickets:
+            limiter.release(0.1, True, ticket)
+        self.assertEqual(4, limiter.limit)
+
+        ticket = limiter.acquire()
+        limiter.release(0.1, True, ticket)
+        self.assertEqual(2, limiter.limit)
+
+    def test_acquire_blocks_at_limit(self):
+        limiter = testrail.AdaptiveLimiter(initial=1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire).start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(0.1)
+        self.assertTrue(acquired.wait(1))
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(projects=1, suites=1, cases=50, runs=1, tests=50,
+                                                 compress=True, case_size=2000)
+        self.__server.start()
+        self.__client = testrail.APIClient(self.__server.url)
+        self.__received = []
+        self.__client.add_request_hook(after=lambda info: self.__received.append(info['bytes']))
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def test_gzip_responses_are_decoded(self):
+        cases = self.__client.send_get('get_cases/1&suite_id=1')
+        self.assertEqual(50, len(cases))
+        self.assertEqual(self.__server.case(50), cases[-1])
+        self.assertTrue(self.__received[0] < len(json.dumps(cases)) / 2)
+
+    def test_gzip_responses_are_streamed(self):
+        cases = list(self.__client.send_get_stream('get_cases/1&suite_id=1'))
+        self.assertEqual([c['id'] for c in self.__server._get_cases(1, 1)], [c['id'] for c in cases])
+
+    def test_gzip_error_responses_are_decoded(self):
+        with self.assertRaises(testrail.APIError) as context:
+            self.__client.send_get('get_run/99')
+        self.assertIn('Unknown id 99', str(context.exception))
+
+    def test_compressed_request_bodies(self):
+        self.__client.compress_requests = True
+        results = [{'case_id': c, 'status_id': 1, 'comment': 'x' * 100} for c in range(1, 21)]
+        self.__client.send_post('add_results_for_cases/1', {'results': results})
+        self.assertEqual(20, self.__client.send_get('get_run/1')['passed_count'])
+        self.assertTrue(self.__client.compress_requests)
+
+    def test_rejected_compressed_bodies_are_resent_plain(self):
+        self.__server.accept_compressed = False
+        self.__client.compress_requests = True
+        results = [{'case_id': c, 'status_id': 5, 'comment': 'x' * 100} for c in range(1, 21)]
+        self.__client.send_post('add_results_for_cases/1', {'results': results})
+        self.assertEqual(20, self.__client.send_get('get_run/1')['failed_count'])
+        self.assertFalse(self.__client.compress_requests)
+
+    def test_decompressor_handles_all_deflate_variants(self):
+        data = json.dumps([{'id': i} for i in range(100)])
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        gzip = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for encoding, body in (('deflate', zlib.compress(data)),
+                               ('deflate', raw.compress(data) + raw.flush()),
+                               ('gzip', gzip.compress(data) + gzip.flush())):
+            decompressor = testrail._Decompressor(encoding)
+            decoded = ''.join(decompressor.decompress(body[i:i + 1]) for i in range(len(body)))
+            self.assertEqual(data, decoded + decompressor.flush())
+
+    def test_corrupt_response_raises_apierror(self):
+        self.assertRaises(testrail.APIError, testrail._decompress, '\x1f\x8bnot gzip', 'gzip')
+
+
+class JSONCodecTestCase(unittest.TestCase):
+    def test_default_codec_is_the_fastest_installed(self):
+        expected = testrail.ujson or testrail.simplejson or json
+        self.assertIs(expected, testrail.JSONCodec().module)
+        self.assertIsInstance(testrail.APIClient('http://localhost/').codec, testrail.JSONCodec)
+
+    def test_client_uses_codec(self):
+        server = fake_server.FakeTestRail(projects=1)
+        server.start()
+        module = mock.Mock(dumps=mock.Mock(side_effect=json.dumps), loads=mock.Mock(side_effect=json.loads))
+        client = testrail.APIClient(server.url, codec=testrail.JSONCodec(module))
+        try:
+            self.assertEqual(1, len(client.get_projects()))
+            client.send_post('add_result/1', {'status_id': 1})
+        finally:
+            client.close()
+            server.stop()
+
+        module.dumps.assert_called_once_with({'status_id': 1})
+        self.assertEqual(2, module.loads.call_count)
+
+
+class FilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(projects=1, suites=1, cases=40, runs=3, tests=40)
+        self.__server.start()
+        self.__client = testrail.APIClient(self.__server.url)
+        self.__uris = []
+        self.__client.add_request_hook(before=lambda method, uri: self.__uris.append(uri))
+        self.__project = testrail.Project(self.__client, self.__server.project(1))
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def test_no_filters_keep_the_uri(self):
+        cases = testrail.Suite(self.__client, self.__server.suite(1)).get_cases()
+        self.assertEqual(['get_cases/1&suite_id=1'], self.__uris)
+        self.assertEqual(40, len(cases))
+        self.assertEqual({}, cases.pushed_down)
+        self.assertEqual({}, cases.filtered_locally)
+
+    def test_case_filters(self):
+        suite = testrail.Suite(self.__client, self.__server.suite(1))
+        cases = suite.get_cases(section_id=3, priority_id=[1, 4], title=lambda t: t.startswith('Case 1'))
+        self.assertEqual(['get_cases/1&suite_id=1&priority_id=1,4&section_id=3'], self.__uris)
+        self.assertEqual({'priority_id': [1, 4], 'section_id': 3}, cases.pushed_down)
+        self.assertEqual(['title'], list(cases.filtered_locally))
+        self.assertEqual([12], [c.id for c in cases])
+
+    def test_run_filters(self):
+        runs = self.__project.get_runs(is_completed=False, created_after=_CREATED_ON + 1, name='Run 3')
+        self.assertEqual(['get_runs/1&created_after=%d&is_completed=0' % (_CREATED_ON + 1)], self.__uris)
+        self.assertEqual({'name': 'Run 3'}, runs.filtered_locally)
+        self.assertEqual([3], [r.id for r in runs])
+
+    def test_test_filters(self):
+        self.__client.send_post('add_result/5', {'status_id': 5})
+        self.__client.send_post('add_result/7', {'status_id': 4})
+        run = self.__project.get_runs()[0]
+        del self.__uris[:]
+
+        tests = run.get_tests(status_id=(4, 5), case_id=[5, 6])
+        self.assertEqual(['get_tests/1&status_id=4,5'], self.__uris)
+        self.assertEqual({'case_id': [5, 6]}, tests.filtered_locally)
+        self.assertEqual([5], [t.id for t in tests])
+
+    def test_unsupported_values_are_filtered_locally(self):
+        runs = self.__project.get_runs(is_completed=[False])
+        self.assertEqual(['get_runs/1'], self.__uris)
+        self.assertEqual({'is_completed': [False]}, runs.filtered_locally)
+        self.assertEqual(3, len(runs))
+
+    def test_none_values_are_filtered_locally(self):
+        suite = testrail.Suite(self.__client, self.__server.suite(1))
+        cases = suite.get_cases(milestone_id=None, priority_id=[1, None])
+        self.assertEqual(['get_cases/1&suite_id=1'], self.__uris)
+        self.assertEqual({'milestone_id': None, 'priority_id': [1, None]}, cases.filtered_locally)
+        self.assertEqual(10, len(cases))
+
+    def test_pushed_down_values_are_quoted(self):
+        params, pushed_down, _ = testrail._split_filters('get_cases', testrail.Case, {'section_id': '1&suite_id=2'})
+        self.assertEqual('&section_id=1%26suite_id%3D2', params)
+        self.assertEqual({'section_id': '1&suite_id=2'}, pushed_down)
+
+    def test_unknown_filter_raises_apierror(self):
+        run = self.__project.get_runs()[0]
+        self.assertRaises(testrail.APIError, run.get_tests, created_after=1)
+        self.assertRaises(testrail.APIError, self.__project.get_runs, colour='red')
+
+
+class JSONStreamTestCase(unittest.TestCase):
+    def __decode(self, document, chunk_size, key=None):
+        return list(testrail._iter_json_array(StringIO.StringIO(document), key, chunk_size))
+
+    def test_decodes_across_chunk_boundaries(self):
+        items = [{u"id": i, u"title": u"Caf\xe9 %d" % i, u"refs": None, u"steps": [1.5, True]}
+                 for i in range(20)] + [12345, u"text"]
+        document = json.dumps(items, indent=1)
+        for chunk_size in (1, 2, 3, 7, 64, 100000):
+            self.assertEqual(items, self.__decode(document, chunk_size))
+
+    def test_empty_array(self):
+        self.assertEqual([], self.__decode(" [ ] ", 1))
+        self.assertEqual([], self.__decode("", 1))
+
+    def test_object_is_decoded_by_key(self):
+        self.assertEqual([1, 2], self.__decode('{"cases": [1, 2]}', 4, "cases"))
+
+    def test_truncated_array_raises_apierror(self):
+        self.assertRaises(testrail.APIError, self.__decode, '[{"id": 1}, {"id": ', 4)
+        self.assertRaises(testrail.APIError, self.__decode, '[1 2]', 4)
+
+
+class FakeServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(projects=2, suites=2, cases=5, runs=2, tests=4)
+        self.__server.start()
+        self.__client = testrail.APIClient(self.__server.url)
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def test_crawl(self):
+        records = list(self.__client.crawl(max_workers=4))
+        counts = collections.Counter(type(r).__name__ for r in records)
+        self.assertEqual({'Project': 2, 'Suite': 4, 'Case': 20, 'Run': 4, 'Test': 16}, dict(counts))
+
+    def test_paged_and_streamed_cases_match(self):
+        suite = self.__client.get_projects()[1].get_suites()[0]
+        expected = [c.id for c in suite.get_cases()]
+        self.assertEqual(expected, [c.id for c in suite.iter_cases(page_size=2)])
+        self.assertEqual(expected, [c.id for c in suite.stream_cases()])
+
+    def test_streamed_cases_follow_pages(self):
+        server = fake_server.FakeTestRail(projects=1, suites=1, cases=30, page_size=10)
+        server.start()
+        try:
+            suite = testrail.APIClient(server.url).get_projects()[0].get_suites()[0]
+            self.assertEqual(range(1, 31), [c.id for c in suite.stream_cases()])
+        finally:
+            server.stop()
+
+    def test_results_update_run_counters(self):
+        run = self.__client.get_projects()[0].get_runs()[0]
+        with testrail.ResultQueue(self.__client) as queue:
+            for test in run.get_tests():
+                queue.add(run.id, test.case_id, 5 if test.id % 2 else 1)
+
+        run = self.__client.get_projects()[0].get_runs()[0]
+        self.assertEqual((2, 2, 0), (run.passed_count, run.failed_count, run.untested_count))
+
+    def test_injected_errors_are_retried(self):
+        self.__client._sleep = mock.Mock()
+        self.__server.error_rate = 0.3
+        for _ in range(10):
+            self.assertEqual(2, len(self.__client.get_projects()))
+        self.assertTrue(self.__client._sleep.called)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__pool = testrail._ConnectionPool('http', 'localhost', size=2, idle_timeout=10)
+        self.__pool._new_connection = mock.Mock(side_effect=lambda: mock.Mock())
+
+    def test_unsupported_scheme_raises_apierror(self):
+        self.assertRaises(testrail.APIError, testrail._ConnectionPool, 'ftp', 'localhost')
+
+    def test_released_connection_is_reused(self):
+        connection, reused = self.__pool.acquire()
+        self.assertFalse(reused)
+        self.__pool.release(connection)
+
+        self.assertEqual((connection, True), self.__pool.acquire())
+
+    def test_pool_size_limits_idle_connections(self):
+        connections = [self.__pool.acquire()[0] for _ in range(3)]
+        for c in connections:
+            self.__pool.release(c)
+
+        self.assertEqual(2, self.__pool.idle_count())
+        connections[2].close.assert_called_once_with()
+
+    def test_expired_connection_is_discarded(self):
+        connection, _ = self.__pool.acquire()
+        self.__pool.release(connection)
+        self.__pool.idle_timeout = -1
+
+        new_connection, reused = self.__pool.acquire()
+        self.assertFalse(reused)
+        self.assertIsNot(connection, new_connection)
+        connection.close.assert_called_once_with()
+
+    def test_stale_connection_is_retried(self):
+        connection, _ = self.__pool.acquire()
+        connection.getresponse.side_effect = httplib.BadStatusLine('')
+        self.__pool.release(connection)
+
+        self.__pool.request('POST', '/add_result/1', '{}', {})
+        connection.close.assert_called_once_with()
+        self.assertEqual(2, self.__pool._new_connection.call_count)
+
+    def test_timed_out_request_is_not_resent(self):
+        connection, _ = self.__pool.acquire()
+        connection.getresponse.side_effect = socket.timeout('timed out')
+        self.__pool.release(connection)
+
+        self.assertRaises(socket.timeout, self.__pool.request, 'POST', '/add_result/1', '{}', {})
+        connection.request.assert_called_once_with('POST', '/add_result/1', '{}', {})
+        self.assertEqual(1, self.__pool._new_connection.call_count)
+
+
+class CrawlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__client = testrail.APIClient("")
+        self.__responses = {
+            "get_projects": [_dummy_project("p1", 1), _dummy_project("p2", 2)],
+            "get_suites/1": [_dummy_suite("s1", 10)],
+            "get_suites/2": [],
+            "get_cases/123&suite_id=10": [_dummy_case(100), _dummy_case(101)],
+            "get_runs/1": [_dummy_run(20)],
+            "get_runs/2": [_dummy_run(21)],
+            "get_tests/20": [_dummy_test(200)],
+            "get_tests/21": [_dummy_test(210), _dummy_test(211)],
+        }
+
+    def __send_get(self, uri):
+        # Answer later requests sooner to shuffle completion order
+        time.sleep(0.02 / (1 + len(uri)))
+        return self.__responses[uri]
+
+    def test_crawl_order_is_deterministic(self):
+        self.__client.send_get = self.__send_get
+
+        records = [(type(r).__name__, r.id) for r in self.__client.crawl(max_workers=4)]
+        self.assertEqual([
+            ("Project", 1), ("Suite", 10), ("Case", 100), ("Case", 101), ("Run", 20), ("Test", 200),
+            ("Project", 2), ("Run", 21), ("Test", 210), ("Test", 211),
+        ], records)
+
+    def test_crawl_respects_max_in_flight(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def send_get(uri):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            return self.__responses[uri]
+
+        self.__client.send_get = send_get
+        records = list(self.__client.crawl(max_workers=8, max_in_flight=2))
+        self.assertEqual(10, len(records))
+        self.assertTrue(state['peak'] <= 2)
+
+    def test_requests_are_submitted_in_emission_order(self):
+        uris = []
+
+        def send_get(uri):
+            uris.append(uri)
+            return self.__responses[uri]
+
+        self.__client.send_get = send_get
+        list(self.__client.crawl(max_workers=1, max_in_flight=1))
+        self.assertEqual(["get_projects", "get_suites/1", "get_cases/123&suite_id=10", "get_runs/1",
+                          "get_tests/20", "get_suites/2", "get_runs/2", "get_tests/21"], uris)
+
+    def test_crawl_raises_apierror(self):
+        def send_get(uri):
+            if uri == "get_runs/1":
+                raise testrail.APIError("failed")
+            return self.__responses[uri]
+
+        self.__client.send_get = send_get
+        with self.assertRaises(testrail.APIError):
+            list(self.__client.crawl())
+
+
+@unittest.skipIf(testrail.numpy is None, "NumPy is not installed")
+class ColumnTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__client = mock.Mock()
+
+    def __run(self, record_id, milestone_id, passed, failed, untested=0):
+        return testrail.Run(self.__client, dict(_dummy_run(record_id), milestone_id=milestone_id,
+                                                passed_count=passed, failed_count=failed,
+                                                untested_count=untested))
+
+    def test_tests_to_columns(self):
+        tests = [
+            testrail.Test(self.__client, dict(_dummy_test(1), status_id=5, priority_id=None)),
+            testrail.Test(self.__client, dict(_dummy_test(2), status_id=1)),
+            testrail.Test(self.__client, dict(_dummy_test(3), status_id=5)),
+        ]
+        table = testrail.tests_to_columns(tests)
+
+        self.assertEqual(3, len(table))
+        self.assertEqual([1, 2, 3], table['id'].tolist())
+        self.assertEqual([1, 5], table.categories['status_id'].tolist())
+        self.assertEqual([1, 0, 1], table['status_id'].tolist())
+        self.assertEqual([5, 1, 5], table.values('status_id').tolist())
+        self.assertEqual([-1, 4, 4], table.values('priority_id').tolist())
+        self.assertEqual([-1, -1, -1], table['milestone_id'].tolist())
+        self.assertEqual({1: 1, 5: 2}, testrail.count_values(table, 'status_id'))
+
+    def test_pass_rates(self):
+        runs = testrail.runs_to_columns([
+            self.__run(1, 7, passed=3, failed=1),
+            self.__run(2, 7, passed=1, failed=3),
+            self.__run(3, None, passed=0, failed=0, untested=5),
+        ])
+
+        rates = testrail.pass_rates(runs)
+        self.assertEqual([0.75, 0.25], rates[:2].tolist())
+        self.assertTrue(testrail.numpy.isnan(rates[2]))
+
+        keys, rates = testrail.group_pass_rates(runs)
+        self.assertEqual([-1, 7], keys.tolist())
+        self.assertTrue(testrail.numpy.isnan(rates[0]))
+        self.assertEqual(0.5, rates[1])
+
+    def test_group_sum(self):
+        runs = testrail.runs_to_columns([
+            self.__run(1, 7, passed=3, failed=1),
+            self.__run(2, 8, passed=1, failed=3),
+            self.__run(3, 7, passed=2, failed=0),
+        ])
+
+        keys, sums = testrail.group_sum(runs, 'milestone_id', 'passed_count')
+        self.assertEqual([7, 8], keys.tolist())
+        self.assertEqual([5, 1], sums.tolist())
+
+
+class FutureTestCase(unittest.TestCase):
+    def test_result(self):
+        future = testrail.Future()
+        future.set_result(5)
+        self.assertTrue(future.done())
+        self.assertEqual(5, future.result())
+
+    def test_exception_is_raised_by_result(self):
+        future = testrail.Future()
+        future.set_exception(testrail.APIError("failed"))
+        self.assertRaises(testrail.APIError, future.result)
+
+    def test_then(self):
+        future = testrail.Future()
+        doubled = future.then(lambda r: r * 2)
+        future.set_result(4)
+        self.assertEqual(8, doubled.result(1))
+
+    def test_then_passes_errors_on(self):
+        future = testrail.Future()
+        chained = future.then(lambda r: r * 2)
+        future.set_exception(testrail.APIError("failed"))
+        self.assertRaises(testrail.APIError, chained.result, 1)
+
+    def test_result_timeout_raises_apierror(self):
+        self.assertRaises(testrail.APIError, testrail.Future().result, 0.01)
+
+
+class AsyncAPIClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__client = testrail.AsyncAPIClient("server_url", max_concurrency=2)
+
+    def tearDown(self):
+        self.__client.close()
+
+    def test_get_projects_async(self):
+        response = [
+            _dummy_project("project 1", 1),
+            _dummy_project("project 2", 2)
+        ]
+        self.__client.send_get = mock.Mock(return_value=response)
+
+        projects = self.__client.get_projects_async().result(1)
+        self.__client.send_get.assert_called_once_with("get_projects")
+        self.assertEqual([1, 2], [p.id for p in projects])
+
+    def test_navigation_async(self):
+        self.__client.send_get = mock.Mock(return_value=[_dummy_case(5)])
+        suite = testrail.Suite(self.__client, _dummy_suite("suite", 3))
+
+        cases = suite.get_cases_async().result(1)
+        self.__client.send_get.assert_called_once_with("get_cases/123&suite_id=3")
+        self.assertEqual(5, cases[0].id)
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def send_get(uri):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            return []
+
+        self.__client.send_get = send_get
+        testrail.gather([self.__client.send_get_async('get_tests/%d' % i) for i in range(10)], 5)
+        self.assertEqual(2, state['peak'])
+
+    def test_error_is_raised_from_result(self):
+        self.__client.send_get = mock.Mock(side_effect=testrail.APIError("failed"))
+        self.assertRaises(testrail.APIError, self.__client.get_statuses_async().result, 1)
+
+    def test_client_stays_usable_after_close(self):
+        self.__client.send_get = mock.Mock(return_value=[_dummy_status(1)])
+        self.__client.get_statuses_async().result(1)
+        self.__client.close()
+        self.assertEqual(1, self.__client.get_statuses_async().result(1)[0].id)
+
+    def test_records_of_a_blocking_client_raise_apierror(self):
+        suite = testrail.Suite(testrail.APIClient("server_url"), _dummy_suite("suite", 3))
+        self.assertRaises(testrail.APIError, suite.get_cases_async)
+
+
+class ResultQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__client = mock.Mock()
+
+    def test_results_are_batched_per_run(self):
+        with testrail.ResultQueue(self.__client, batch_size=2, flush_interval=60) as queue:
+            queue.add(1, 10, 1)
+            queue.add(2, 20, 5, comment="broken")
+            queue.add(1, 11, 1)
+
+        self.assertEqual([
+            mock.call('add_results_for_cases/1',
+                      {'results': [{'case_id': 10, 'status_id': 1}, {'case_id': 11, 'status_id': 1}]}),
+            mock.call('add_results_for_cases/2',
+                      {'results': [{'case_id': 20, 'status_id': 5, 'comment': "broken"}]}),
+        ], self.__client.send_post.call_args_list)
+
+    def test_flush(self):
+        queue = testrail.ResultQueue(self.__client, batch_size=100, flush_interval=60)
+        queue.add(1, 10, 1)
+        queue.flush()
+        self.__client.send_post.assert_called_once_with(
+            'add_results_for_cases/1', {'results': [{'case_id': 10, 'status_id': 1}]})
+        queue.close()
+
+    def test_flush_interval(self):
+        queue = testrail.ResultQueue(self.__client, batch_size=100, flush_interval=0.01)
+        queue.add(1, 10, 1)
+        time.sleep(0.2)
+        self.assertEqual(1, self.__client.send_post.call_count)
+        queue.close()
+        self.assertEqual(1, self.__client.send_post.call_count)
+
+    def test_close_flushes_remaining_results(self):
+        queue = testrail.ResultQueue(self.__client, batch_size=100, flush_interval=60)
+        for case_id in range(5):
+            queue.add(3, case_id, 1)
+        queue.close()
+
+        self.__client.send_post.assert_called_once_with(
+            'add_results_for_cases/3', {'results': [{'case_id': i, 'status_id': 1} for i in range(5)]})
+        self.assertRaises(testrail.APIError, queue.add, 3, 6, 1)
+
+    def test_close_raises_on_failed_batches(self):
+        self.__client.send_post.side_effect = testrail.APIError("failed")
+        queue = testrail.ResultQueue(self.__client)
+        queue.add(1, 10, 1)
+        self.assertRaises(testrail.APIError, queue.close)
+        self.assertEqual(1, len(queue.errors))
+
+    def test_flush_after_close_raises_apierror(self):
+        queue = testrail.ResultQueue(self.__client)
+        queue.close()
+        self.assertRaises(testrail.APIError, queue.flush)
+
+    def test_failed_batches_do_not_mask_errors_of_the_with_block(self):
+        self.__client.send_post.side_effect = testrail.APIError("failed")
+        with self.assertRaises(KeyError):
+            with testrail.ResultQueue(self.__client) as queue:
+                queue.add(1, 10, 1)
+                raise KeyError(10)
+        self.assertEqual(1, len(queue.errors))
+
+
+class JUnitImporterTestCase(unittest.TestCase):
+    _REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="login" tests="5">
+    <testcase classname="login.Form" name="test_valid_user_C1" time="0.2"/>
+    <testcase classname="login.Form" name="test_wrong_password" time="3.6">
+      <failure message="expected 401">Traceback: line 12</failure>
+    </testcase>
+    <testcase classname="login.Form" name="test_reset" time="0"><error message="boom"/></testcase>
+    <testcase classname="login.Form" name="test_sso"><skipped/></testcase>
+    <testcase classname="login.Form" name="test_unknown_C99"/>
+  </testsuite>
+</testsuites>
+"""
+
+    def setUp(self):
+        self.__client = mock.Mock()
+        cases = [dict(_dummy_case(1), title=u'Valid user'),
+                 dict(_dummy_case(2), title=u'Wrong password', refs=u'LOGIN-1, login.Form.test_wrong_password'),
+                 dict(_dummy_case(3), title=u'test_reset'),
+                 dict(_dummy_case(4), title=u'SSO', refs=u'test_sso')]
+        self.__cases = [testrail.Case(self.__client, c) for c in cases]
+
+    def test_match(self):
+        importer = testrail.JUnitImporter(self.__client, self.__cases)
+        self.assertEqual(1, importer.match('login.Form', 'test_valid_user_C1'))
+        self.assertEqual(2, importer.match('login.Form', 'test_wrong_password'))
+        self.assertEqual(2, importer.match(None, 'LOGIN-1'))
+        self.assertEqual(3, importer.match('other', 'test_reset'))
+        self.assertEqual(None, importer.match('login.Form', 'test_C99'))
+        self.assertEqual(None, importer.match('login.Form', 'test_ABC1'))
+
+    def test_import_file(self):
+        importer = testrail.JUnitImporter(self.__client, self.__cases)
+        counts = importer.import_file(StringIO.StringIO(self._REPORT), 7)
+
+        self.assertEqual({'testcases': 5, 'reported': 3, 'unmatched': 1, 'skipped': 1}, counts)
+        self.__client.send_post.assert_called_once_with('add_results_for_cases/7', {'results': [
+            {'case_id': 1, 'status_id': 1, 'elapsed': '1s'},
+            {'case_id': 2, 'status_id': 5, 'elapsed': '4s', 'comment': 'expected 401\n\nTraceback: line 12'},
+            {'case_id': 3, 'status_id': 5, 'comment': 'boom'},
+        ]})
+
+    def test_status_mapping(self):
+        importer = testrail.JUnitImporter(self.__client, self.__cases, statuses={'skipped': 2, 'error': None})
+        counts = importer.import_file(StringIO.StringIO(self._REPORT), 7)
+        self.assertEqual({'testcases': 5, 'reported': 3, 'unmatched': 1, 'skipped': 1}, counts)
+        results = self.__client.send_post.call_args[0][1]['results']
+        self.assertEqual([(1, 1), (2, 5), (4, 2)], [(r['case_id'], r['status_id']) for r in results])
+
+    def test_results_are_uploaded_in_batches(self):
+        report = '<testsuite>%s</testsuite>' % ''.join(
+            '<testcase classname="c" name="test_C%d"/>' % (i % 4 + 1) for i in range(10))
+        importer = testrail.JUnitImporter(self.__client, self.__cases, batch_size=4)
+        importer.import_file(StringIO.StringIO(report), 7)
+        self.assertEqual([4, 4, 2], [len(c[0][1]['results']) for c in self.__client.send_post.call_args_list])
+
+    def test_malformed_xml_raises_apierror(self):
+        importer = testrail.JUnitImporter(self.__client, self.__cases)
+        self.assertRaises(testrail.APIError, importer.import_file, StringIO.StringIO('<testsuite><testcase'), 7)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(projects=2, suites=2, cases=30, runs=2, tests=20)
+        self.__server.start()
+        self.__client = testrail.APIClient(self.__server.url)
+        handle, self.__path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(handle)
+        with testrail.SnapshotWriter(self.__path, block_size=8) as writer:
+            writer.export_project(self.__client, 2)
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+
+    def test_snapshot_answers_requests_like_the_server(self):
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            for uri in ['get_suites/2', 'get_cases/2&suite_id=4', 'get_runs/2', 'get_tests/4',
+                        'get_case/100', 'get_test/80', 'get_run/3', 'get_cases/2&suite_id=3&limit=5&offset=25']:
+                self.assertEqual(self.__client.send_get(uri), snapshot.send_get(uri), uri)
+            self.assertEqual([self.__server.project(2)], snapshot.send_get('get_projects'))
+            self.assertRaises(testrail.APIError, snapshot.send_get, 'get_case/1')
+            self.assertRaises(testrail.APIError, snapshot.send_get, 'get_users')
+
+    def test_snapshot_applies_filters(self):
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            for uri in ['get_cases/2&suite_id=4&priority_id=1,3', 'get_cases/2&suite_id=4&section_id=5',
+                        'get_cases/2&suite_id=4&updated_after=%d' % (fake_server._CREATED_ON + 100),
+                        'get_runs/2&is_completed=0', 'get_runs/2&created_before=%d' % (fake_server._CREATED_ON + 4)]:
+                self.assertEqual(self.__client.send_get(uri), snapshot.send_get(uri), uri)
+            cases = snapshot.send_get('get_cases/2&suite_id=4&priority_id=3&limit=2&offset=1')
+            self.assertEqual([98, 102], [c['id'] for c in cases])
+            self.assertRaises(testrail.APIError, snapshot.send_get, 'get_tests/4&assignedto_id=1')
+
+            suite = snapshot.get_projects()[0].get_suites()[1]
+            cases = suite.get_cases(priority_id=1)
+            self.assertEqual({'priority_id': 1}, cases.pushed_down)
+            self.assertEqual(range(92, 121, 4), [c.id for c in cases])
+
+    def test_records_work_offline(self):
+        requests = self.__server.requests
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            project = snapshot.get_projects()[0]
+            self.assertEqual('Project 2', project.name)
+            suite = project.get_suites()[1]
+            self.assertEqual(range(91, 121), [c.id for c in suite.iter_cases(page_size=7)])
+
+            run = project.get_runs()[0]
+            run.prefetch_cases()
+            test = run.get_tests()[3]
+            self.assertEqual(44, test.id)
+            self.assertEqual(test.case_id, test.get_case().id)
+        self.assertEqual(requests, self.__server.requests)
+
+    def test_get_and_count(self):
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            self.assertEqual({'project': 1, 'suite': 2, 'case': 60, 'run': 2, 'test': 40},
+                             dict((k, snapshot.count(k)) for k in ('project', 'suite', 'case', 'run', 'test')))
+            self.assertEqual('Case 77', snapshot.get('case', 77).title)
+            self.assertIsInstance(snapshot.get('run', 4), testrail.Run)
+            self.assertIsNone(snapshot.get('case', 1))
+            self.assertIsNone(snapshot.get('test', 1000))
+
+    def test_blocks_are_read_lazily(self):
+        with testrail.SnapshotReader(self.__path, cached_blocks=2) as snapshot:
+            with mock.patch.object(testrail.zlib, 'decompress', wraps=zlib.decompress) as decompress:
+                snapshot.get('test', 61)
+                snapshot.get('test', 62)
+                self.assertEqual(1, decompress.call_count)
+                for case_id in range(61, 121):
+                    snapshot.get('case', case_id)
+                snapshot.get('test', 61)
+                self.assertEqual(10, decompress.call_count)
+
+    def test_compressed_blocks_are_added_as_they_are(self):
+        with testrail.SnapshotWriter(self.__path, block_size=2) as writer:
+            for case_id in range(1, 4):
+                writer.add('case', 1, _dummy_case(case_id))
+            cases = [_dummy_case(case_id) for case_id in range(4, 9)]
+            writer.add_block('case', 2, [4, 5, 6, 7, 8], testrail._compress_block(cases))
+            writer.add('case', 3, _dummy_case(9))
+
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            self.assertEqual(range(1, 10), [c['id'] for c in snapshot.iter_data('case')])
+            self.assertEqual([4, 5, 6, 7, 8], [c['id'] for c in snapshot.iter_data('case', 2)])
+            self.assertEqual(7, snapshot.get('case', 7).id)
+            self.assertEqual(9, snapshot.get('case', 9).id)
+
+    def test_records_of_a_parent_must_be_consecutive(self):
+        with testrail.SnapshotWriter(self.__path) as writer:
+            writer.add('case', 1, _dummy_case(1))
+            writer.add('case', 2, _dummy_case(2))
+            self.assertRaises(testrail.APIError, writer.add, 'case', 1, _dummy_case(3))
+
+    def test_invalid_file_raises_apierror(self):
+        with open(self.__path, 'wb') as f:
+            f.write('not a snapshot' * 10)
+        self.assertRaises(testrail.APIError, testrail.SnapshotReader, self.__path)
+
+    def test_export_follows_paginated_responses(self):
+        server = fake_server.FakeTestRail(projects=1, suites=1, cases=30, runs=1, tests=30, page_size=10)
+        server.start()
+        try:
+            with testrail.SnapshotWriter(self.__path) as writer:
+                writer.export_project(testrail.APIClient(server.url), 1)
+        finally:
+            server.stop()
+
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            self.assertEqual(range(1, 31), [c['id'] for c in snapshot.send_get('get_cases/1&suite_id=1')])
+            self.assertEqual(range(1, 31), [t['id'] for t in snapshot.send_get('get_tests/1')])
+
+    def test_failed_export_leaves_no_snapshot(self):
+        self.__server._get_tests = mock.Mock(side_effect=LookupError('Run is gone'))
+        with self.assertRaises(testrail.APIError):
+            with testrail.SnapshotWriter(self.__path) as writer:
+                writer.export_project(self.__client, 2)
+        self.assertFalse(os.path.exists(self.__path))
+
+
+class RunWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(projects=1, suites=1, cases=10, runs=2, tests=10)
+        self.__server.start()
+        self.__client = testrail.APIClient(self.__server.url)
+        self.__now = [1000.0]
+        self.__watcher = testrail.RunWatcher(self.__client, [1, 2], min_interval=5, max_interval=20)
+        self.__watcher._time = lambda: self.__now[0]
+        self.__watcher._sleep = self.__sleep
+
+    def tearDown(self):
+        self.__client.close()
+        self.__server.stop()
+
+    def __sleep(self, delay):
+        self.__now[0] += delay
+
+    def test_first_poll_reports_counters(self):
+        self.__client.send_post('add_result/3', {'status_id': 5})
+        events = self.__watcher.poll()
+        self.assertEqual([1, 2], [e.run_id for e in events])
+        self.assertEqual({'failed_count': 1, 'untested_count': 9}, events[0].changes)
+        self.assertEqual([], events[0].results)
+
+    def test_only_new_results_are_fetched(self):
+        self.__watcher.poll()
+        self.__client.send_post('add_result/3', {'status_id': 5})
+        self.__client.send_post('add_result/4', {'status_id': 1})
+        self.__client.send_post('add_result/13', {'status_id': 1})
+
+        events = self.__watcher.poll(force=True)
+        self.assertEqual({'failed_count': 1, 'passed_count': 1, 'untested_count': -2}, events[0].changes)
+        self.assertEqual([3, 4], [r['test_id'] for r in events[0].results])
+        self.assertEqual([13], [r['test_id'] for r in events[1].results])
+
+        self.__client.send_post('add_result/5', {'status_id': 1})
+        events = self.__watcher.poll(force=True)
+        self.assertEqual([1], [e.run_id for e in events])
+        self.assertEqual([5], [r['test_id'] for r in events[0].results])
+
+    def test_results_before_the_first_poll_are_skipped(self):
+        self.__client.send_post('add_result/1', {'status_id': 5})
+        self.__client.send_post('add_result/2', {'status_id': 1})
+        self.__watcher.poll()
+        self.__client.send_post('add_result/3', {'status_id': 1})
+
+        events = self.__watcher.poll(force=True)
+        self.assertEqual([3], [r['test_id'] for r in events[0].results])
+
+    def test_quiet_runs_are_polled_less_often(self):
+        self.__watcher.remove(1)
+        self.__watcher.poll()
+        polls = []
+        self.__client.add_request_hook(
+            before=lambda method, uri: polls.append(self.__now[0]) if uri.startswith('get_run/') else None)
+        for _ in range(60):
+            self.__sleep(1)
+            self.__watcher.poll()
+        self.assertEqual([1005, 1015, 1035, 1055], polls)
+
+        self.__client.send_post('add_result/13', {'status_id': 1})
+        self.__now[0] = 1075
+        self.assertEqual(1, len(self.__watcher.poll()))
+        self.__now[0] = 1080
+        self.assertEqual([], self.__watcher.poll())
+        self.assertEqual([1005, 1015, 1035, 1055, 1075, 1080], polls)
+
+    def test_completed_runs_are_dropped(self):
+        client = mock.Mock()
+        run = _dummy_run(7)
+        results = [{'id': 3, 'created_on': 100, 'status_id': 1}]
+        responses = {
+            'get_run/7': [run, dict(run, passed_count=run['passed_count'] + 1),
+                          dict(run, passed_count=run['passed_count'] + 1, is_completed=True)],
+            'get_results_for_run/7&limit=1': [results],
+            'get_results_for_run/7&created_after=99&limit=250&offset=0': [results, [
+                {'id': 5, 'created_on': 100, 'status_id': 1}] + results],
+        }
+        client.send_get.side_effect = lambda uri: responses[uri].pop(0)
+        received = []
+        watcher = testrail.RunWatcher(client, [7], callback=received.append)
+        watcher._time = lambda: self.__now[0]
+        watcher._sleep = self.__sleep
+
+        events = list(watcher.events())
+        self.assertEqual(received, events)
+        self.assertEqual([{'id': 5, 'created_on': 100, 'status_id': 1}], events[1].results)
+        self.assertEqual({'passed_count': 1}, events[1].changes)
+        self.assertTrue(events[2].completed)
+        self.assertEqual(0, len(watcher))
+
+
+class StatusHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__history = testrail.StatusHistory()
+        # case id -> statuses of runs 1 to 5, created at 100, 200, ... 500
+        statuses = {
+            1: [1, 1, 1, 5, 5],
+            2: [5, 5, 1, 1, 1],
+            3: [1, 5, 1, 5, 1],
+            4: [1, 1, 1, 1, 1],
+            5: [1, 3, 2, 5, 3],
+        }
+        for run_id in range(1, 6):
+            for case_id, history in statuses.items():
+                self.__history.add(case_id, run_id, run_id * 100, history[run_id - 1])
+
+    def test_newly_failing(self):
+        self.assertEqual([1, 5], self.__history.newly_failing())
+        self.assertEqual([1, 5], self.__history.newly_failing(since=400))
+        self.assertEqual([], self.__history.newly_failing(since=401))
+
+    def test_fixed_since(self):
+        self.assertEqual([2, 3], self.__history.fixed_since())
+        self.assertEqual([3], self.__history.fixed_since(since=400))
+
+    def test_flaky(self):
+        self.assertEqual({3: 4}, self.__history.flaky())
+        self.assertEqual({3: 2}, self.__history.flaky(since=400))
+        self.assertEqual({1: 1, 2: 1, 3: 3, 5: 1}, self.__history.flaky(since=300, min_changes=1))
+
+    def test_results_added_out_of_order(self):
+        history = testrail.StatusHistory()
+        history.add(1, 3, 300, 1)
+        history.add(1, 1, 100, 1)
+        history.add(1, 2, 200, 5)
+        self.assertEqual([(100, 1, 'passed'), (200, 2, 'failed'), (300, 3, 'passed')], history.history(1))
+        self.assertEqual({1: 2}, history.flaky())
+        self.assertEqual([1], history.fixed_since(200))
+
+        history.add(1, 4, 250, 5)
+        self.assertEqual({1: 2}, history.flaky())
+        self.assertEqual([1], history.fixed_since(300))
+        self.assertEqual([], history.fixed_since(301))
+
+    def test_add_run(self):
+        client = mock.Mock()
+        client.send_get.return_value = [dict(_dummy_test(1), case_id=1, status_id=5),
+                                        dict(_dummy_test(2), case_id=4, status_id=1)]
+        run = testrail.Run(client, dict(_dummy_run(6), created_on=600))
+
+        self.assertEqual(2, self.__history.add_run(run))
+        self.assertEqual(0, self.__history.add_run(run))
+        client.send_get.assert_called_once_with('get_tests/6')
+        self.assertEqual([1, 5], self.__history.newly_failing(since=400))
+        self.assertEqual(5, len(self.__history))
+        self.assertEqual('passed', self.__history.latest(4))
+        self.assertEqual(None, self.__history.latest(9))
+
+
+class ShardedExporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__server = fake_server.FakeTestRail(projects=2, suites=2, cases=30, runs=2, tests=20)
+        self.__server.start()
+        handle, self.__path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(handle)
+
+    def tearDown(self):
+        self.__server.stop()
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+
+    def test_export_matches_the_server(self):
+        exporter = testrail.ShardedExporter(self.__server.url, 'chuck', 'norris', processes=2)
+        counts = exporter.export(self.__path, block_size=16)
+        self.assertEqual({'project': 2, 'suite': 4, 'case': 120, 'run': 4, 'test': 80}, counts)
+
+        client = testrail.APIClient(self.__server.url)
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            for uri in ['get_projects', 'get_suites/1', 'get_runs/2', 'get_cases/1&suite_id=2',
+                        'get_cases/2&suite_id=3', 'get_tests/1', 'get_tests/4', 'get_test/33']:
+                self.assertEqual(client.send_get(uri), snapshot.send_get(uri), uri)
+        client.close()
+
+    def test_export_pages_through_shards(self):
+        counts = testrail.ShardedExporter(self.__server.url, processes=2).export(
+            self.__path, block_size=4, page_size=7)
+        self.assertEqual({'project': 2, 'suite': 4, 'case': 120, 'run': 4, 'test': 80}, counts)
+
+        client = testrail.APIClient(self.__server.url)
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            for uri in ['get_suites/2', 'get_runs/1', 'get_cases/2&suite_id=4', 'get_tests/3']:
+                self.assertEqual(client.send_get(uri), snapshot.send_get(uri), uri)
+        client.close()
+
+    def test_export_follows_paginated_responses(self):
+        server = fake_server.FakeTestRail(projects=1, suites=1, cases=30, runs=2, tests=20, page_size=8)
+        server.start()
+        try:
+            counts = testrail.ShardedExporter(server.url, processes=2).export(self.__path)
+        finally:
+            server.stop()
+        self.assertEqual({'project': 1, 'suite': 1, 'case': 30, 'run': 2, 'test': 40}, counts)
+
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            self.assertEqual([server.case(i) for i in range(1, 31)], snapshot.send_get('get_cases/1&suite_id=1'))
+            self.assertEqual(range(21, 41), [t['id'] for t in snapshot.send_get('get_tests/2')])
+
+    def test_export_selected_projects(self):
+        counts = testrail.ShardedExporter(self.__server.url, processes=2).export(self.__path, [2])
+        self.assertEqual({'project': 1, 'suite': 2, 'case': 60, 'run': 2, 'test': 40}, counts)
+        with testrail.SnapshotReader(self.__path) as snapshot:
+            self.assertEqual([2], [p.id for p in snapshot.get_projects()])
+
+    def test_worker_errors_are_raised(self):
+        self.__server._get_tests = mock.Mock(side_effect=LookupError('Run is gone'))
+        exporter = testrail.ShardedExporter(self.__server.url, processes=2)
+        with self.assertRaises(testrail.APIError) as context:
+            exporter.export(self.__path)
+        self.assertIn('Run is gone', str(context.exception))
+        self.assertFalse(os.path.exists(self.__path))
+
+
+class LocalStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__client = mock.Mock()
+        self.__store = testrail.LocalStore(self.__client, ':memory:')
+        self.__suite = testrail.Suite(self.__client, _dummy_suite("suite", 3))
+        self.__project = testrail.Project(self.__client, _dummy_project("project", 2))
+
+    def tearDown(self):
+        self.__store.close()
+
+    def test_sync_cases_fetches_deltas(self):
+        case = _dummy_case(5)
+        self.__client.send_get = mock.Mock(return_value=[case, _dummy_case(6)])
+        self.assertEqual(2, self.__store.sync_cases(self.__suite))
+        self.__client.send_get.assert_called_with("get_cases/123&suite_id=3&limit=250&offset=0")
+
+        changed = dict(case, title=u'Changed', updated_on=1500000000)
+        self.__client.send_get = mock.Mock(return_value=[changed])
+        self.assertEqual(1, self.__store.sync_cases(self.__suite))
+        self.__client.send_get.assert_called_with(
+            "get_cases/123&suite_id=3&updated_after=1399023028&limit=250&offset=0")
+
+        cases = self.__store.get_cases(3)
+        self.assertEqual([5, 6], [c.id for c in cases])
+        self.assertEqual(u'Changed', cases[0].title)
+
+    def test_sync_cases_refetches_the_second_of_the_last_sync(self):
+        self.__client.send_get = mock.Mock(return_value=[_dummy_case(5)])
+        self.__store.sync_cases(self.__suite)
+
+        # Updated in the same second as case 5, after the previous sync
+        self.__client.send_get = mock.Mock(return_value=[_dummy_case(5), _dummy_case(6)])
+        self.assertEqual(2, self.__store.sync_cases(self.__suite))
+        self.__client.send_get.assert_called_with(
+            "get_cases/123&suite_id=3&updated_after=1399023028&limit=250&offset=0")
+        self.assertEqual([5, 6], [c.id for c in self.__store.get_cases(3)])
+
+    def test_sync_runs_refreshes_active_runs_only(self):
+        completed = dict(_dummy_run(7), is_completed=True)
+        active = _dummy_run(8)
+        responses = {
+            "get_runs/2": [completed, active],
+            "get_tests/7": [_dummy_test(70)],
+            "get_tests/8": [_dummy_test(80)],
+        }
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: responses[uri.replace("&limit=250&offset=0", "")])
+        self.assertEqual(2, self.__store.sync_runs(self.__project))
+
+        new_run = dict(_dummy_run(9), created_on=1500000000)
+        # Created in the same second as runs 7 and 8, after the previous sync
+        same_second = dict(_dummy_run(10), is_completed=True)
+        responses.update({
+            "get_runs/2&created_after=1399024613": [completed, dict(active, is_completed=True),
+                                                    same_second, new_run],
+            "get_runs/2&is_completed=0": [new_run],
+            "get_run/8": dict(active, is_completed=True),
+            "get_tests/8": [_dummy_test(80), _dummy_test(81)],
+            "get_tests/9": [_dummy_test(90)],
+            "get_tests/10": [_dummy_test(100)],
+        })
+        self.__client.send_get.reset_mock()
+        self.assertEqual(4, self.__store.sync_runs(self.__project))
+
+        requested = set(c[0][0] for c in self.__client.send_get.call_args_list)
+        self.assertNotIn("get_tests/7", requested)
+        self.assertEqual([7, 8, 9, 10], [r.id for r in self.__store.get_runs(2)])
+        self.assertEqual([100], [t.id for t in self.__store.get_tests(10)])
+        self.assertEqual([70], [t.id for t in self.__store.get_tests(7)])
+        self.assertEqual([80, 81], [t.id for t in self.__store.get_tests(8)])
+        self.assertTrue(self.__store.get_runs(2)[1].is_completed)
+
+    def test_sync_runs_removes_deleted_runs(self):
+        responses = {
+            "get_runs/2": [_dummy_run(7), _dummy_run(8)],
+            "get_runs/2&created_after=1399024613": [],
+            "get_runs/2&is_completed=0": [_dummy_run(8)],
+            "get_tests/7": [_dummy_test(70)],
+            "get_tests/8": [_dummy_test(80)],
+        }
+
+        def send_get(uri):
+            if uri == "get_run/7":
+                raise testrail.APIError('TestRail API returned HTTP 400 ("Field :run_id is not a valid test run.")')
+            return responses[uri.replace("&limit=250&offset=0", "")]
+
+        self.__client.send_get = mock.Mock(side_effect=send_get)
+        self.__store.sync_runs(self.__project)
+        self.assertEqual(1, self.__store.sync_runs(self.__project))
+        self.assertEqual([8], [r.id for r in self.__store.get_runs(2)])
+        self.assertEqual([], self.__store.get_tests(7))
+
+    def test_sync_pages_through_paginated_responses(self):
+        server = fake_server.FakeTestRail(projects=1, suites=1, cases=30, runs=1, tests=30, page_size=10)
+        server.start()
+        try:
+            client = testrail.APIClient(server.url)
+            store = testrail.LocalStore(client, ':memory:')
+            project = client.get_projects()[0]
+            self.assertEqual(30, store.sync_cases(project.get_suites()[0]))
+            self.assertEqual(1, store.sync_runs(project))
+            self.assertEqual(range(1, 31), [t.id for t in store.get_tests(1)])
+            store.close()
+        finally:
+            server.stop()
+
+
+class PlanTestCase(unittest.TestCase):
+    def setUp(self):
+        chrome = dict(_dummy_run(1), config="Chrome, Windows", config_ids=[10, 20])
+        firefox = dict(_dummy_run(2), config="Firefox, Windows", config_ids=[11, 20])
+        other = dict(_dummy_run(3), config=None, config_ids=[])
+        self.__responses = {
+            "get_plan/7": _dummy_plan(7, [_dummy_plan_entry("3933d74b", 3, [chrome, firefox]),
+                                          _dummy_plan_entry("a1b2c3d4", 4, [other])]),
+            "get_plans/123&limit=250&offset=0": [_dummy_plan(7), _dummy_plan(8)],
+            "get_tests/1": [dict(_dummy_test(11), case_id=100), dict(_dummy_test(12), case_id=101)],
+            "get_tests/2": [dict(_dummy_test(21), case_id=100), dict(_dummy_test(22), case_id=101)],
+            "get_tests/3": [dict(_dummy_test(31), case_id=200)],
+        }
+        self.__client = mock.Mock()
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: self.__responses[uri])
+        self.__project = testrail.Project(self.__client, _dummy_project("project", 123))
+
+    def test_plans_load_entries_on_demand(self):
+        plans = self.__project.get_plans()
+        self.assertEqual([7, 8], [p.id for p in plans])
+        self.assertEqual(5, plans[0].passed_count)
+        self.__client.send_get.assert_called_once_with("get_plans/123&limit=250&offset=0")
+
+        entries = plans[0].entries
+        self.assertEqual(["3933d74b", "a1b2c3d4"], [e.id for e in entries])
+        self.assertEqual([1, 2], [r.id for r in entries[0].runs])
+        self.assertEqual("Chrome, Windows", entries[0].runs[0].config)
+        plans[0].entries
+        self.assertEqual(2, self.__client.send_get.call_count)
+
+    def test_get_plans_pages_through_plans(self):
+        self.__responses.update({
+            "get_plans/123&limit=2&offset=0": {"plans": [_dummy_plan(7), _dummy_plan(8)],
+                                              "_links": {"next": "&limit=2&offset=2"}},
+            "get_plans/123&limit=2&offset=2": {"plans": [_dummy_plan(9)], "_links": {"next": None}},
+        })
+        self.assertEqual([7, 8, 9], [p.id for p in self.__project.get_plans(page_size=2)])
+
+    def test_plan_without_entries(self):
+        self.__responses["get_plan/8"] = _dummy_plan(8)
+        plan = testrail.Plan(self.__client, _dummy_plan(8))
+        self.assertEqual([], plan.entries)
+        self.__client.send_get.assert_called_once_with("get_plan/8")
+
+    def test_get_plan(self):
+        client = testrail.APIClient("http://localhost/")
+        client.send_get = self.__client.send_get
+        plan = client.get_plan(7)
+        self.assertEqual([1, 2, 3], [r.id for r in plan.get_runs()])
+        self.__client.send_get.assert_called_once_with("get_plan/7")
+
+    def test_get_tests_indexes_by_run_config_and_case(self):
+        plan = testrail.Plan(self.__client, self.__responses["get_plan/7"])
+        tests = plan.get_tests(max_workers=2)
+
+        self.assertEqual([11, 12, 21, 22, 31], [t.id for t in tests])
+        self.assertEqual(5, len(tests))
+        self.assertEqual([21, 22], [t.id for t in tests.by_run(2)])
+        self.assertEqual([11, 12, 21, 22], [t.id for t in tests.by_config(20)])
+        self.assertEqual([21, 22], [t.id for t in tests.by_config("Firefox, Windows")])
+        self.assertEqual([11, 21], [t.id for t in tests.by_case(100)])
+        self.assertEqual(22, tests.get(2, 101).id)
+        self.assertIsNone(tests.get(3, 100))
+        self.assertEqual([], tests.by_run(9))
+
+    def test_get_tests_raises_errors(self):
+        def send_get(uri):
+            if uri == "get_tests/2":
+                raise testrail.APIError("TestRail API returned HTTP 400")
+            return self.__responses[uri]
+
+        self.__client.send_get.side_effect = send_get
+        plan = testrail.Plan(self.__client, self.__responses["get_plan/7"])
+        self.assertRaises(testrail.APIError, plan.get_tests)
+
+    def test_get_configs(self):
+        self.__client.send_get.side_effect = None
+        self.__client.send_get.return_value = [{"id": 1, "name": "Browsers", "project_id": 123, "configs": [
+            {"id": 10, "name": "Chrome", "group_id": 1}, {"id": 11, "name": "Firefox", "group_id": 1}]}]
+        groups = self.__project.get_configs()
+        self.__client.send_get.assert_called_once_with("get_configs/123")
+        self.assertEqual("Browsers", groups[0].name)
+        self.assertEqual(["Chrome", "Firefox"], [c.name for c in groups[0].configs])
+
+    def test_incomplete_json_raises_exception(self):
+        self.assertRaises(testrail.APIError, testrail.Plan, self.__client, {"id": 1})
+        self.assertRaises(testrail.APIError, testrail.PlanEntry, self.__client,
+                          {"id": "x", "description": None, "include_all": True, "name": "n", "suite_id": 1})
+
+
 class ProjectTestCase(unittest.TestCase):
     def setUp(self):
         self.__client = mock.Mock()
@@ -202,6 +1982,65 @@ class ProjectTestCase(unittest.TestCase):
         self.assertEqual(3, runs[0].id)
         self.assertEqual(4, runs[1].id)
 
+    def test_iter_runs(self):
+        self.__client.send_get = mock.Mock(return_value=[_dummy_run(3)])
+
+        project = testrail.Project(self.__client, self.__dict_data)
+        self.assertEqual([3], [r.id for r in project.iter_runs()])
+        self.__client.send_get.assert_called_once_with("get_runs/3&limit=250&offset=0")
+
+
+class SectionTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.__client = mock.Mock()
+        # 1 -> (3 -> 5, 2 -> 4), 6
+        sections = [_dummy_section(1), _dummy_section(2, 1, 2), _dummy_section(3, 1, 1),
+                    _dummy_section(4, 2), _dummy_section(5, 3), _dummy_section(6, None, 2),
+                    _dummy_section(7, 99)]
+        cases = [dict(_dummy_case(case_id), section_id=section_id) for case_id, section_id in
+                 [(10, 4), (11, 1), (12, 5), (13, 4), (14, 6), (15, 42)]]
+        self.__client.send_get = mock.Mock(side_effect=[sections, cases])
+        self.__suite = testrail.Suite(self.__client, _dummy_suite("suite", 3))
+        self.__tree = self.__suite.get_section_tree()
+
+    def test_requests(self):
+        self.assertEqual([mock.call("get_sections/123&suite_id=3"), mock.call("get_cases/123&suite_id=3")],
+                         self.__client.send_get.call_args_list)
+        self.assertIsInstance(self.__tree.get(3), testrail.Section)
+        self.assertEqual(7, len(self.__tree))
+
+    def test_parents_and_children(self):
+        self.assertEqual([1, 7, 6], [s.id for s in self.__tree.roots])
+        self.assertEqual([3, 2], [s.id for s in self.__tree.children(1)])
+        self.assertEqual(1, self.__tree.parent(2).id)
+        self.assertIsNone(self.__tree.parent(1))
+        self.assertEqual([1, 3, 5, 2, 4], [s.id for s in self.__tree.subtree(1)])
+        self.assertRaises(testrail.APIError, self.__tree.children, 99)
+
+    def test_is_in_subtree(self):
+        self.assertTrue(self.__tree.is_in_subtree(4, 1))
+        self.assertTrue(self.__tree.is_in_subtree(2, 2))
+        self.assertFalse(self.__tree.is_in_subtree(4, 3))
+        self.assertFalse(self.__tree.is_in_subtree(6, 1))
+        self.assertFalse(self.__tree.is_in_subtree(99, 1))
+
+    def test_subtree_cases(self):
+        self.assertEqual([11, 12, 10, 13], [c.id for c in self.__tree.subtree_cases(1)])
+        self.assertEqual([10, 13], [c.id for c in self.__tree.subtree_cases(2)])
+        self.assertEqual([], self.__tree.subtree_cases(7))
+        self.assertEqual(4, self.__tree.case_count(1))
+        self.assertEqual(1, self.__tree.case_count(1, recursive=False))
+        self.assertEqual(1, self.__tree.case_count(6))
+
+    def test_deep_tree(self):
+        sections = [testrail.Section(self.__client, _dummy_section(1))]
+        sections += [testrail.Section(self.__client, _dummy_section(i, i - 1)) for i in range(2, 5001)]
+        cases = [testrail.Case(self.__client, dict(_dummy_case(i), section_id=i)) for i in range(1, 5001)]
+        tree = testrail.SectionTree(sections, cases)
+        self.assertEqual(5000, tree.case_count(1))
+        self.assertEqual(1, tree.case_count(5000))
+        self.assertTrue(tree.is_in_subtree(5000, 2500))
+
 
 class SuiteTestCase(unittest.TestCase):
     def setUp(self):
@@ -238,6 +2077,54 @@ class SuiteTestCase(unittest.TestCase):
         self.assertEqual(5, cases[0].id)
         self.assertEqual(6, cases[1].id)
 
+    def test_iter_cases_pages_through_list_responses(self):
+        responses = {
+            "get_cases/123&suite_id=3&limit=2&offset=0": [_dummy_case(1), _dummy_case(2)],
+            "get_cases/123&suite_id=3&limit=2&offset=2": [_dummy_case(3), _dummy_case(4)],
+            "get_cases/123&suite_id=3&limit=2&offset=4": [_dummy_case(5)],
+        }
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: responses[uri])
+
+        suite = testrail.Suite(self.__client, self.__dict_data)
+        self.assertEqual([1, 2, 3, 4, 5], [c.id for c in suite.iter_cases(page_size=2)])
+        self.assertEqual(3, self.__client.send_get.call_count)
+
+    def test_iter_cases_pages_through_paginated_responses(self):
+        responses = {
+            "get_cases/123&suite_id=3&limit=2&offset=0": {
+                "cases": [_dummy_case(1), _dummy_case(2)], "_links": {"next": "/api/v2/get_cases/123&offset=2"}},
+            "get_cases/123&suite_id=3&limit=2&offset=2": {
+                "cases": [_dummy_case(3), _dummy_case(4)], "_links": {"next": None}},
+        }
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: responses[uri])
+
+        suite = testrail.Suite(self.__client, self.__dict_data)
+        self.assertEqual([1, 2, 3, 4], [c.id for c in suite.iter_cases(page_size=2)])
+        self.assertEqual(2, self.__client.send_get.call_count)
+
+    def test_iter_cases_stops_if_the_server_ignores_limit_and_offset(self):
+        suite = testrail.Suite(self.__client, self.__dict_data)
+        for count, requests in ((5, 1), (2, 2), (1, 1)):
+            cases = [_dummy_case(i) for i in range(1, count + 1)]
+            self.__client.send_get = mock.Mock(side_effect=lambda uri: list(cases))
+            self.assertEqual(range(1, count + 1), [c.id for c in suite.iter_cases(page_size=2)])
+            self.assertEqual(requests, self.__client.send_get.call_count)
+
+    def test_iter_cases_prefetches_one_page(self):
+        requested = []
+
+        def send_get(uri):
+            requested.append(uri)
+            return [_dummy_case(len(requested))] * 2
+
+        self.__client.send_get = send_get
+        suite = testrail.Suite(self.__client, self.__dict_data)
+        cases = suite.iter_cases(page_size=2)
+        next(cases)
+        time.sleep(0.05)
+        self.assertEqual(2, len(requested))
+        cases.close()
+
 
 class CaseTestCase(unittest.TestCase):
     def setUp(self):
@@ -324,6 +2211,45 @@ class RunTestCase(unittest.TestCase):
         self.assertEqual(7, tests[0].id)
         self.assertEqual(8, tests[1].id)
 
+    def test_iter_tests(self):
+        responses = {
+            "get_tests/5&limit=2&offset=0": [_dummy_test(7), _dummy_test(8)],
+            "get_tests/5&limit=2&offset=2": [],
+        }
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: responses[uri])
+
+        run = testrail.Run(self.__client, self.__dict_data)
+        self.assertEqual([7, 8], [t.id for t in run.iter_tests(page_size=2)])
+
+    def test_prefetch_cases(self):
+        responses = {
+            "get_cases/2&suite_id=3": [_dummy_case(3)],
+            "get_tests/5": [_dummy_test(7), _dummy_test(8)],
+        }
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: responses[uri])
+
+        run = testrail.Run(self.__client, self.__dict_data)
+        index = run.prefetch_cases()
+        tests = run.get_tests()
+        self.assertIs(index.get(3), tests[0].get_case())
+        self.assertIs(index.get(3), tests[1].get_case())
+        self.assertEqual(2, self.__client.send_get.call_count)
+
+    def test_empty_case_index_argument_is_used(self):
+        responses = {
+            "get_cases/2&suite_id=3": [_dummy_case(3)],
+            "get_tests/5": [_dummy_test(7)],
+            "get_case/3": [_dummy_case(3)],
+        }
+        self.__client.send_get = mock.Mock(side_effect=lambda uri: responses[uri])
+
+        run = testrail.Run(self.__client, self.__dict_data)
+        prefetched = run.prefetch_cases()
+        index = testrail.CaseIndex(self.__client)
+        case = run.get_tests(case_index=index)[0].get_case()
+        self.assertIs(index.get(3), case)
+        self.assertIsNot(prefetched.get(3), case)
+
 
 class TestTestCase(unittest.TestCase):
     def setUp(self):
@@ -353,6 +2279,24 @@ class TestTestCase(unittest.TestCase):
         assert "steps" in test.custom
         assert "preconds" in test.custom
 
+    def test_custom_data_is_decoded_once(self):
+        test = testrail.Test(self.__client, self.__dict_data)
+        self.assertIs(test.custom, test.custom)
+
+    def test_fields_are_slots(self):
+        test = testrail.Test(self.__client, self.__dict_data)
+        self.assertFalse(hasattr(test, '__dict__'))
+
+        test.status_id = 1
+        self.assertEqual(1, test.status_id)
+        self.assertRaises(AttributeError, setattr, test, "unknown", 1)
+
+    def test_custom_data_of_records_with_other_keys(self):
+        test = testrail.Test(self.__client, self.__dict_data)
+        other = testrail.Test(self.__client, dict(_dummy_test(6), custom_automated=True))
+        self.assertEqual({"steps": None, "preconds": None}, test.custom)
+        self.assertEqual({"steps": None, "preconds": None, "automated": True}, other.custom)
+
     def test_get_case(self):
         response = [
             _dummy_case(7)
@@ -368,6 +2312,26 @@ class TestTestCase(unittest.TestCase):
         test = testrail.Test(self.__client, self.__dict_data)
         self.assertRaises(testrail.APIError, test.get_case)
 
+    def test_get_case_from_case_index(self):
+        self.__client.send_get = mock.Mock(return_value=[_dummy_case(3)])
+        index = testrail.CaseIndex(self.__client)
+        index.load_suite(123, 3)
+
+        test = testrail.Test(self.__client, self.__dict_data, index)
+        case = test.get_case()
+        self.assertIs(case, test.get_case())
+        self.assertIs(case, index.get(3))
+        self.__client.send_get.assert_called_once_with("get_cases/123&suite_id=3")
+
+    def test_get_case_adds_missing_case_to_index(self):
+        self.__client.send_get = mock.Mock(return_value=[_dummy_case(3)])
+        index = testrail.CaseIndex(self.__client)
+
+        first = testrail.Test(self.__client, self.__dict_data, index).get_case()
+        second = testrail.Test(self.__client, _dummy_test(6), index).get_case()
+        self.assertIs(first, second)
+        self.__client.send_get.assert_called_once_with("get_case/3")
+
 
 class StatusTestCase(unittest.TestCase):
     def setUp(self):